@@ -0,0 +1,72 @@
+"""Store and hit latency of the in-process cache backends.
+
+Compares MemoryStorage with SQLiteStorage(":memory:") in both entry
+formats. SQLite serializes every stored flow and parses it on every hit,
+while MemoryStorage only copies the flow, so its hits should be several
+times faster.
+
+    uv run python -m benchmarks.backends
+    uv run python -m benchmarks.backends --repeat 20000 --body-size 65536
+"""
+
+from __future__ import annotations
+
+import argparse
+import itertools
+from collections.abc import Callable
+
+from mitmproxy import http
+
+from mitmcache.storage.cache_storage import CacheStorage
+from mitmcache.storage.memory import MemoryStorage
+from mitmcache.storage.sqlite3 import SQLiteStorage
+from tests.example_flow import example_flow
+
+from .common import measure, summarize
+
+BACKENDS: dict[str, Callable[[], CacheStorage]] = {
+    "memory": MemoryStorage,
+    "sqlite": lambda: SQLiteStorage(":memory:"),
+    "sqlite-compact": lambda: SQLiteStorage(":memory:", compact=True),
+}
+
+
+def flow_with_body(size: int) -> http.HTTPFlow:
+    flow = example_flow()
+    assert flow.response is not None
+    flow.response.content = b"x" * size
+    return flow
+
+
+def run(
+    create: Callable[[], CacheStorage], flow: http.HTTPFlow, repeat: int
+) -> tuple[dict[str, float], dict[str, float]]:
+    storage = create()
+    keys = (f"key-{i}" for i in itertools.count())
+    stores = measure(lambda: storage.upsert(next(keys), flow), repeat)
+    hits = measure(lambda: storage.get("key-0"), repeat)
+    storage.close()
+    return summarize(stores), summarize(hits)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5_000)
+    parser.add_argument("--body-size", type=int, default=4096)
+    args = parser.parse_args()
+
+    flow = flow_with_body(args.body_size)
+    print(
+        f"{'backend':>15} {'store_mean_us':>14} {'store_p99_us':>13}"
+        f" {'hit_mean_us':>12} {'hit_p99_us':>11}"
+    )
+    for name, create in BACKENDS.items():
+        store, hit = run(create, flow, args.repeat)
+        print(
+            f"{name:>15} {store['mean_us']:>14.1f} {store['p99_us']:>13.1f}"
+            f" {hit['mean_us']:>12.1f} {hit['p99_us']:>11.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+"""Helpers shared by the benchmark scripts."""
+
+from __future__ import annotations
+
+import itertools
+import random
+import statistics
+import time
+from collections.abc import Callable
+
+
+def measure(func: Callable[[], object], repeat: int) -> list[float]:
+    """Call func repeat times and return each latency in seconds."""
+    latencies = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+def percentile(latencies: list[float], fraction: float) -> float:
+    ordered = sorted(latencies)
+    index = min(len(ordered) - 1, int(len(ordered) * fraction))
+    return ordered[index]
+
+
+def summarize(latencies: list[float]) -> dict[str, float]:
+    """Return mean/p50/p99 latencies in microseconds."""
+    return {
+        "mean_us": statistics.fmean(latencies) * 1e6,
+        "p50_us": percentile(latencies, 0.50) * 1e6,
+        "p99_us": percentile(latencies, 0.99) * 1e6,
+    }
+
+
+def zipf_trace(
+    keys: int, exponent: float, requests: int, rng: random.Random
+) -> list[str]:
+    """Return requests keys of key-0..key-{keys-1}, key-0 most popular."""
+    weights = [1 / (rank**exponent) for rank in range(1, keys + 1)]
+    cum_weights = list(itertools.accumulate(weights))
+    ranks = rng.choices(range(keys), cum_weights=cum_weights, k=requests)
+    return [f"key-{rank}" for rank in ranks]
@@ -0,0 +1,114 @@
+"""Disk size versus CPU cost of at-rest compression.
+
+Stores the same set of text responses (HTML and JSON of a few sizes) in a
+temporary cache file once per codec, then reports the resulting file
+size, the mean upsert latency and the mean lookup latency. Compression
+should shrink the file several times over at the cost of some
+microseconds per write and read.
+
+    uv run python -m benchmarks.compression
+    uv run python -m benchmarks.compression --entries 2000 --body-kib 4 64
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import random
+import tempfile
+
+from mitmcache.storage.codecs import CODECS
+from mitmcache.storage.sqlite3 import SQLiteStorage
+from tests.example_flow import example_flow
+
+from .common import measure, summarize
+
+_WORDS = (
+    "cache proxy request response header body origin stale fresh entry"
+    " product price title description review rating category item list"
+).split()
+
+
+def html_body(size: int, rng: random.Random) -> bytes:
+    parts = ["<html><body><ul>\n"]
+    length = 0
+    while length < size:
+        words = " ".join(rng.choices(_WORDS, k=12))
+        row = f'<li><a href="/p/{rng.randrange(10**6)}">{words}</a></li>\n'
+        parts.append(row)
+        length += len(row)
+    return "".join(parts).encode()[:size]
+
+
+def json_body(size: int, rng: random.Random) -> bytes:
+    items = []
+    length = 0
+    while length < size:
+        title = " ".join(rng.choices(_WORDS, k=6))
+        items.append({"id": rng.randrange(10**6), "title": title})
+        length += len(title) + 30
+    return json.dumps(items).encode()[:size]
+
+
+def make_flows(entries: int, body_sizes: list[int]) -> list:
+    rng = random.Random(0)
+    flows = []
+    for i in range(entries):
+        flow = example_flow()
+        assert flow.response is not None
+        size = body_sizes[i % len(body_sizes)]
+        make_body = html_body if i % 2 else json_body
+        flow.response.raw_content = make_body(size, rng)
+        flows.append(flow)
+    return flows
+
+
+def run(codec: str | None, flows: list, min_size: int) -> dict[str, float]:
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "cache.db")
+        storage = SQLiteStorage(
+            db_path, compression=codec, compression_min_size=min_size
+        )
+        pending = iter(enumerate(flows))
+
+        def upsert() -> None:
+            i, flow = next(pending)
+            storage.upsert(f"key-{i}", flow)
+
+        writes = summarize(measure(upsert, len(flows)))
+        keys = iter(range(len(flows)))
+        reads = summarize(
+            measure(lambda: storage.get(f"key-{next(keys)}"), len(flows))
+        )
+        storage.close()
+        return {
+            "file_kib": os.path.getsize(db_path) / 1024,
+            "write_mean_us": writes["mean_us"],
+            "read_mean_us": reads["mean_us"],
+        }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--entries", type=int, default=1_000)
+    parser.add_argument(
+        "--body-kib", type=int, nargs="+", default=[2, 16, 128]
+    )
+    parser.add_argument("--min-size", type=int, default=1024)
+    args = parser.parse_args()
+
+    flows = make_flows(args.entries, [kib * 1024 for kib in args.body_kib])
+    codecs: list[str | None] = [None, *sorted(CODECS)]
+    print(f"{'codec':>8} {'file_kib':>10} {'write_us':>10} {'read_us':>10}")
+    for codec in codecs:
+        result = run(codec, flows, args.min_size)
+        print(
+            f"{codec or 'none':>8} {result['file_kib']:>10.0f}"
+            f" {result['write_mean_us']:>10.1f}"
+            f" {result['read_mean_us']:>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""Upsert latency of a full SQLiteStorage as the cache grows.
+
+Each run pre-fills the cache to max_entries with small filler rows, then
+times upserts of new keys, so every measured write pushes the cache over
+its limit. With index-backed batch eviction the latency should stay flat
+from ten thousand to a million entries.
+
+    uv run python -m benchmarks.eviction
+    uv run python -m benchmarks.eviction --sizes 10000 100000 --upserts 5000
+"""
+
+from __future__ import annotations
+
+import argparse
+import itertools
+import os
+import tempfile
+
+from mitmcache.storage.sqlite3 import SQLiteStorage
+from tests.example_flow import example_flow
+
+from .common import measure, summarize
+
+
+def prefill(storage: SQLiteStorage, entries: int) -> None:
+    """Insert filler rows directly; they are evicted, never read."""
+    rows = ((f"filler-{i}", i) for i in range(entries))
+    storage.conn.executemany(
+        "INSERT INTO cache (cache_key, flow, access_clock) VALUES (?, x'00', ?)",
+        rows,
+    )
+    storage.conn.commit()
+    storage._clock = entries
+
+
+def run(entries: int, upserts: int, on_disk: bool) -> dict[str, float]:
+    if not on_disk:
+        return run_with(":memory:", entries, upserts)
+    with tempfile.TemporaryDirectory() as tmp:
+        return run_with(os.path.join(tmp, "cache.db"), entries, upserts)
+
+
+def run_with(db_path: str, entries: int, upserts: int) -> dict[str, float]:
+    storage = SQLiteStorage(db_path, max_entries=entries)
+    prefill(storage, entries)
+    flow = example_flow()
+    keys = (f"key-{i}" for i in itertools.count())
+    latencies = measure(lambda: storage.upsert(next(keys), flow), upserts)
+    storage.close()
+    return summarize(latencies)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[10_000, 100_000, 1_000_000],
+    )
+    parser.add_argument("--upserts", type=int, default=2_000)
+    parser.add_argument(
+        "--on-disk",
+        action="store_true",
+        help="use a temporary cache file instead of :memory:",
+    )
+    args = parser.parse_args()
+
+    print(f"{'entries':>10} {'mean_us':>10} {'p50_us':>10} {'p99_us':>10}")
+    for entries in args.sizes:
+        result = run(entries, args.upserts, args.on_disk)
+        print(
+            f"{entries:>10} {result['mean_us']:>10.1f}"
+            f" {result['p50_us']:>10.1f} {result['p99_us']:>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
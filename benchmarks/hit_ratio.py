@@ -0,0 +1,105 @@
+"""Hit ratio of the eviction and admission policies on synthetic traces.
+
+Replays key streams against a SQLiteStorage bounded by max_entries: a
+lookup per request and an upsert on every miss, as the addon does. Traces
+are Zipf-distributed over a fixed key space, optionally interleaved with
+a scan of keys that are requested only once (as a crawler over many
+distinct pages produces). TinyLFU admission should hold up best when
+scans are mixed in; LFU and LRU should beat FIFO on skewed traces.
+
+    uv run python -m benchmarks.hit_ratio
+    uv run python -m benchmarks.hit_ratio --requests 200000 --capacity 2000
+"""
+
+from __future__ import annotations
+
+import argparse
+import itertools
+import random
+import time
+from collections.abc import Iterator
+
+from mitmcache.storage.policies import EVICTION_POLICIES
+from mitmcache.storage.sqlite3 import SQLiteStorage
+from tests.example_flow import example_flow
+
+from .common import zipf_trace
+
+POLICIES = [(policy, "always") for policy in EVICTION_POLICIES] + [
+    ("lru", "tinylfu")
+]
+
+
+def with_scans(trace: list[str], every: int) -> Iterator[str]:
+    """Insert a never-repeated key after every `every` requests."""
+    scan = (f"scan-{i}" for i in itertools.count())
+    for i, key in enumerate(trace, 1):
+        yield key
+        if i % every == 0:
+            yield next(scan)
+
+
+def hit_ratio(
+    trace: list[str], capacity: int, policy: str, admission: str
+) -> tuple[float, float]:
+    # The compact format keeps serialization from dominating the run.
+    storage = SQLiteStorage(
+        ":memory:",
+        max_entries=capacity,
+        compact=True,
+        eviction_policy=policy,
+        admission=admission,
+    )
+    flow = example_flow()
+    hits = 0
+    started = time.perf_counter()
+    for key in trace:
+        if storage.get(key) is not None:
+            hits += 1
+        else:
+            storage.upsert(key, flow)
+    elapsed = time.perf_counter() - started
+    storage.close()
+    return hits / len(trace), elapsed / len(trace) * 1e6
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--keys", type=int, default=20_000)
+    parser.add_argument("--requests", type=int, default=20_000)
+    parser.add_argument("--capacity", type=int, default=1_000)
+    parser.add_argument(
+        "--exponents", type=float, nargs="+", default=[0.8, 1.0]
+    )
+    parser.add_argument(
+        "--scan-every",
+        type=int,
+        default=2,
+        help="one single-use key per this many requests in scan traces",
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    print(f"{'trace':>14} {'policy':>12} {'hit_ratio':>10} {'us_per_req':>11}")
+    for exponent in args.exponents:
+        rng = random.Random(args.seed)
+        zipf = zipf_trace(args.keys, exponent, args.requests, rng)
+        traces = {
+            f"zipf-{exponent}": zipf,
+            f"zipf-{exponent}+scan": list(with_scans(zipf, args.scan_every)),
+        }
+        for name, trace in traces.items():
+            for policy, admission in POLICIES:
+                label = (
+                    policy
+                    if admission == "always"
+                    else f"{policy}+{admission}"
+                )
+                ratio, cost = hit_ratio(
+                    trace, args.capacity, policy, admission
+                )
+                print(f"{name:>14} {label:>12} {ratio:>10.3f} {cost:>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
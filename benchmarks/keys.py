@@ -0,0 +1,73 @@
+"""Cost of deriving a cache key per request.
+
+Times KeyDeriver.derive() for a few typical request shapes: a plain GET,
+a GET with a long query full of tracking parameters, a JSON POST (as sent
+by GraphQL clients) and a large binary POST. Derivation runs on every
+keyless request, so it should stay in the low tens of microseconds except
+for large bodies, whose cost is dominated by hashing.
+
+    uv run python -m benchmarks.keys
+    uv run python -m benchmarks.keys --repeat 50000
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+
+from mitmproxy import http
+from mitmproxy.test import tutils
+
+from mitmcache.keys import KeyDeriver
+
+from .common import measure, summarize
+
+
+def requests() -> dict[str, http.Request]:
+    query = "&".join(
+        [f"param{i}=value{i}" for i in range(20)]
+        + ["utm_source=news", "utm_medium=mail", "gclid=abc123"]
+    )
+    graphql = {
+        "operationName": "Products",
+        "query": "query Products($first: Int) { products(first: $first) "
+        "{ edges { node { id title price } } } }",
+        "variables": {"first": 50, "after": "cursor", "filters": ["a", "b"]},
+    }
+    json_headers = [(b"content-type", b"application/json")]
+    return {
+        "get": tutils.treq(path=b"/products/123", headers=[]),
+        "get-query": tutils.treq(path=f"/search?{query}".encode()),
+        "post-json": tutils.treq(
+            method=b"POST",
+            path=b"/graphql",
+            headers=json_headers,
+            content=json.dumps(graphql).encode(),
+        ),
+        "post-1mib": tutils.treq(
+            method=b"POST", path=b"/upload", content=os.urandom(1 << 20)
+        ),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=10_000)
+    args = parser.parse_args()
+
+    deriver = KeyDeriver(headers=["accept", "accept-language"])
+    print(f"{'request':>10} {'mean_us':>10} {'p50_us':>10} {'p99_us':>10}")
+    for name, request in requests().items():
+        repeat = (
+            args.repeat if len(request.raw_content or b"") < 1 << 16 else 100
+        )
+        result = summarize(measure(lambda: deriver.derive(request), repeat))
+        print(
+            f"{name:>10} {result['mean_us']:>10.1f}"
+            f" {result['p50_us']:>10.1f} {result['p99_us']:>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
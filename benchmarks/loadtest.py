@@ -0,0 +1,323 @@
+"""End-to-end load test of mitmdump running the cache addon.
+
+Starts a local origin stand-in, an asyncio HTTP/1.1 server answering
+every request with --body-size bytes after --origin-latency seconds, runs
+`mitmdump -s inject.py` in front of it and drives the proxy with an
+open-loop client. Requests are scheduled at --rps over --connections
+keep-alive connections, so a proxy that falls behind shows up as latency
+instead of lowering the offered load; latency is measured from the
+scheduled send time.
+
+Of the keyed requests, --hit-ratio reuse keys cached during a warm-up and
+the rest use new keys; --keyless of all requests carry no key. Throughput
+and p50/p95/p99 latency are reported per kind, along with the number of
+requests that reached the origin. Everything runs on localhost.
+
+    uv run python -m benchmarks.loadtest
+    uv run python -m benchmarks.loadtest --rps 500 --duration 30 \\
+        --set cache_backend=sqlite --set cache_async_storage=true
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import contextlib
+import json
+import random
+import re
+import signal
+import socket
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from collections.abc import Iterator
+from pathlib import Path
+
+from .common import percentile
+
+KINDS = ("hit", "miss", "keyless")
+
+INJECT = Path(__file__).resolve().parent.parent / "inject.py"
+
+_CONTENT_LENGTH = re.compile(rb"\r\ncontent-length:\s*(\d+)", re.IGNORECASE)
+
+Request = tuple[str, str | None]
+
+
+async def read_head(reader: asyncio.StreamReader) -> bytes:
+    """Read a message head; empty once the peer closed the connection."""
+    try:
+        return await reader.readuntil(b"\r\n\r\n")
+    except asyncio.IncompleteReadError:
+        return b""
+
+
+class Origin:
+    """Answers every GET with the same body after a fixed delay."""
+
+    def __init__(self, latency: float, body_size: int) -> None:
+        self.latency = latency
+        self.response = (
+            b"HTTP/1.1 200 OK\r\ncontent-type: text/plain\r\n"
+            b"content-length: %d\r\n\r\n" % body_size + b"x" * body_size
+        )
+        self.requests = 0
+        self.writers: set[asyncio.StreamWriter] = set()
+
+    async def start(self) -> int:
+        """Start listening on a free port and return it."""
+        self.server = await asyncio.start_server(self.serve, "127.0.0.1", 0)
+        return int(self.server.sockets[0].getsockname()[1])
+
+    async def serve(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        self.writers.add(writer)
+        try:
+            while await read_head(reader):
+                self.requests += 1
+                await asyncio.sleep(self.latency)
+                writer.write(self.response)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+    def stop(self) -> None:
+        """Stop listening and close the open connections."""
+        self.server.close()
+        for writer in self.writers:
+            writer.close()
+
+
+class Client:
+    """Sends requests through the proxy over a pool of connections."""
+
+    def __init__(self, proxy_port: int, origin_port: int) -> None:
+        self.proxy_port = proxy_port
+        self.origin = f"127.0.0.1:{origin_port}"
+        self.pool: asyncio.Queue[
+            tuple[asyncio.StreamReader, asyncio.StreamWriter]
+        ] = asyncio.Queue()
+
+    async def open(self, connections: int) -> None:
+        for _ in range(connections):
+            self.pool.put_nowait(await self.connect())
+
+    async def connect(
+        self,
+    ) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        return await asyncio.open_connection("127.0.0.1", self.proxy_port)
+
+    async def fetch(self, path: str, key: str | None) -> None:
+        connection = await self.pool.get()
+        try:
+            await self.exchange(*connection, self.request(path, key))
+        except BaseException:
+            connection[1].close()
+            connection = await self.connect()
+            raise
+        finally:
+            self.pool.put_nowait(connection)
+
+    def request(self, path: str, key: str | None) -> bytes:
+        header = "" if key is None else f"Mitm-Cache-Key: {key}\r\n"
+        return (
+            f"GET http://{self.origin}{path} HTTP/1.1\r\n"
+            f"Host: {self.origin}\r\n{header}\r\n"
+        ).encode()
+
+    async def exchange(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        request: bytes,
+    ) -> None:
+        writer.write(request)
+        await writer.drain()
+        head = await read_head(reader)
+        if not head.startswith(b"HTTP/1.1 200"):
+            raise ConnectionError(f"unexpected response: {head[:40]!r}")
+        length = _CONTENT_LENGTH.search(head)
+        await reader.readexactly(int(length[1]) if length else 0)
+
+    def close(self) -> None:
+        while not self.pool.empty():
+            self.pool.get_nowait()[1].close()
+
+
+def plan(args: argparse.Namespace) -> list[Request]:
+    """Return the kind and key of every request of the run."""
+    rng = random.Random(args.seed)
+    requests: list[Request] = []
+    for i in range(int(args.rps * args.duration)):
+        if rng.random() < args.keyless:
+            requests.append(("keyless", None))
+        elif rng.random() < args.hit_ratio:
+            requests.append(("hit", f"warm-{rng.randrange(args.warm_keys)}"))
+        else:
+            requests.append(("miss", f"new-{i}"))
+    return requests
+
+
+class Run:
+    """Latencies and errors of the requests of one run, by kind."""
+
+    def __init__(self) -> None:
+        self.latencies: defaultdict[str, list[float]] = defaultdict(list)
+        self.errors: defaultdict[str, int] = defaultdict(int)
+        self.elapsed = 0.0
+
+    async def send(
+        self, client: Client, request: Request, scheduled: float
+    ) -> None:
+        kind, key = request
+        try:
+            await client.fetch(f"/{kind}/{key}", key)
+        except (OSError, asyncio.IncompleteReadError):
+            self.errors[kind] += 1
+            return
+        self.latencies[kind].append(time.perf_counter() - scheduled)
+
+    async def drive(
+        self, client: Client, requests: list[Request], rps: float
+    ) -> None:
+        started = time.perf_counter()
+        tasks = []
+        for i, request in enumerate(requests):
+            scheduled = started + i / rps
+            await asyncio.sleep(max(0.0, scheduled - time.perf_counter()))
+            tasks.append(
+                asyncio.create_task(self.send(client, request, scheduled))
+            )
+        await asyncio.gather(*tasks)
+        self.elapsed = time.perf_counter() - started
+
+    def report(self) -> dict[str, dict[str, float]]:
+        return {kind: self.summary(kind) for kind in KINDS}
+
+    def summary(self, kind: str) -> dict[str, float]:
+        latencies = self.latencies[kind] or [float("nan")]
+        return {
+            "requests": len(self.latencies[kind]),
+            "errors": self.errors[kind],
+            "throughput_rps": len(self.latencies[kind]) / self.elapsed,
+            "p50_ms": percentile(latencies, 0.50) * 1e3,
+            "p95_ms": percentile(latencies, 0.95) * 1e3,
+            "p99_ms": percentile(latencies, 0.99) * 1e3,
+        }
+
+
+def free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return int(probe.getsockname()[1])
+
+
+@contextlib.contextmanager
+def mitmdump(args: argparse.Namespace, port: int) -> Iterator[None]:
+    command = [args.mitmdump, "-q", "-s", str(INJECT)]
+    command += ["--listen-host", "127.0.0.1", "--listen-port", str(port)]
+    for option in args.set:
+        command += ["--set", option]
+    process = subprocess.Popen(command)
+    try:
+        yield
+    finally:
+        process.send_signal(signal.SIGINT)
+        process.wait(timeout=30)
+
+
+async def wait_for_port(port: int, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+            continue
+        writer.close()
+        return
+
+
+async def warm_up(client: Client, args: argparse.Namespace) -> None:
+    """Request every warm key once, so later requests for it hit."""
+    keys = [f"warm-{i}" for i in range(args.warm_keys)]
+    await asyncio.gather(*(client.fetch(f"/hit/{key}", key) for key in keys))
+
+
+async def load_test(args: argparse.Namespace, origin: Origin) -> Run:
+    client = Client(free_port(), await origin.start())
+    run = Run()
+    with mitmdump(args, client.proxy_port):
+        await wait_for_port(client.proxy_port, timeout=30)
+        await client.open(args.connections)
+        await warm_up(client, args)
+        warm_requests = origin.requests
+        await run.drive(client, plan(args), args.rps)
+        # Close every connection before stopping mitmdump: it logs the
+        # cancellation of each one still open when it shuts down.
+        client.close()
+        origin.stop()
+        await asyncio.sleep(0.5)
+    origin.requests -= warm_requests
+    return run
+
+
+def print_report(report: dict[str, dict[str, float]], origin: int) -> None:
+    print(
+        f"{'kind':>8} {'requests':>9} {'errors':>7} {'rps':>8}"
+        f" {'p50_ms':>8} {'p95_ms':>8} {'p99_ms':>8}"
+    )
+    for kind, row in report.items():
+        print(
+            f"{kind:>8} {row['requests']:>9} {row['errors']:>7}"
+            f" {row['throughput_rps']:>8.1f} {row['p50_ms']:>8.2f}"
+            f" {row['p95_ms']:>8.2f} {row['p99_ms']:>8.2f}"
+        )
+    print(f"origin requests during the run: {origin}")
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rps", type=float, default=200)
+    parser.add_argument("--duration", type=float, default=10, help="seconds")
+    parser.add_argument("--connections", type=int, default=32)
+    parser.add_argument("--hit-ratio", type=float, default=0.8)
+    parser.add_argument("--keyless", type=float, default=0.1)
+    parser.add_argument("--warm-keys", type=int, default=100)
+    parser.add_argument("--origin-latency", type=float, default=0.05)
+    parser.add_argument("--body-size", type=int, default=4096)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--mitmdump", default="mitmdump")
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        help="option=value passed on to mitmdump, e.g. cache_backend=sqlite",
+    )
+    parser.add_argument("--output", help="write the report as JSON here")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    origin = Origin(args.origin_latency, args.body_size)
+    run = asyncio.run(load_test(args, origin))
+    report = run.report()
+    print_report(report, origin.requests)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump({"parameters": vars(args), "results": report}, output)
+    if any(run.errors.values()):
+        sys.exit("some requests failed")
+
+
+if __name__ == "__main__":
+    main()
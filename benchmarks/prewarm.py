@@ -0,0 +1,85 @@
+"""Throughput of importing a flow dump with mitmcache.prewarm.
+
+Writes a temporary dump of --flows captured-looking flows, then imports
+it into a fresh cache file per entry format and reports flows per second,
+including reading and parsing the dump. The upsert-per-flow baseline
+commits every flow on its own, as replaying the traffic through the proxy
+would.
+
+    uv run python -m benchmarks.prewarm
+    uv run python -m benchmarks.prewarm --flows 200000
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import tempfile
+import time
+
+import mitmproxy.io as mio
+
+from mitmcache.prewarm import import_flows, read_flows
+from mitmcache.storage.sqlite3 import SQLiteStorage
+from tests.example_flow import example_flow
+
+
+def write_dump(path: str, flows: int) -> None:
+    template = example_flow()
+    with open(path, "wb") as dump:
+        writer = mio.FlowWriter(dump)
+        for i in range(flows):
+            flow = template.copy()
+            flow.request.path = f"/items/{i}"
+            writer.add(flow)
+
+
+def entries(path: str):
+    for flow in read_flows(path):
+        yield flow.request.path, flow
+
+
+def bulk(path: str, cache_file: str, compact: bool) -> int:
+    # Like the CLI, which has the cache file to itself.
+    storage = SQLiteStorage(cache_file, compact=compact)
+    with storage.deferred_indexes():
+        count = import_flows(storage, entries(path))
+    storage.close()
+    return count
+
+
+def one_by_one(path: str, cache_file: str, compact: bool) -> int:
+    storage = SQLiteStorage(cache_file, compact=compact)
+    count = 0
+    for cache_key, flow in entries(path):
+        storage.upsert(cache_key, flow)
+        count += 1
+    storage.close()
+    return count
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--flows", type=int, default=20_000)
+    args = parser.parse_args()
+
+    print(f"{'method':>12} {'format':>8} {'flows':>8} {'flows_per_s':>12}")
+    with tempfile.TemporaryDirectory() as tmp:
+        dump = os.path.join(tmp, "capture.mitm")
+        write_dump(dump, args.flows)
+        for method in (bulk, one_by_one):
+            for compact in (False, True):
+                cache_file = os.path.join(tmp, f"{method.__name__}.db")
+                started = time.perf_counter()
+                count = method(dump, cache_file, compact)
+                elapsed = time.perf_counter() - started
+                os.remove(cache_file)
+                name = "compact" if compact else "flow"
+                print(
+                    f"{method.__name__:>12} {name:>8} {count:>8}"
+                    f" {count / elapsed:>12.0f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,358 @@
+"""Benchmark suite of the cache hot paths with JSON results.
+
+Runs a fixed set of cases, each timing one operation --repeat times:
+
+- sqlite.get / sqlite.upsert: SQLiteStorage lookups and writes of a Zipf
+  key stream, for every body size and number of cached entries;
+- sqlite.evict: upserts of new keys into a full SQLiteStorage, each of
+  which has to evict;
+- serialize / deserialize: encoding a flow into a stored entry and back,
+  in both entry formats;
+- cache.round_trip: Cache.request plus, on a miss, Cache.response on
+  synthetic flows with Zipf-distributed keys, per backend.
+
+Key streams and flows are derived from --seed, so every run measures the
+same work; each case runs --rounds times and the best round counts.
+--output writes the results (mean, p50 and p99 in µs per case,
+plus the environment) as JSON. --baseline compares them with an earlier
+result file and exits with status 1 if --metric of any case got slower by
+more than --threshold, so upgrades can be gated on it:
+
+    uv run python -m benchmarks.suite --output baseline.json
+    uv run python -m benchmarks.suite --baseline baseline.json
+    uv run python -m benchmarks.suite --quick --filter sqlite.get
+"""
+
+from __future__ import annotations
+
+import argparse
+import gc
+import importlib.metadata
+import json
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import time
+from collections.abc import Callable, Iterator
+from typing import Any
+
+from mitmproxy import http
+from mitmproxy.test import taddons, tflow, tutils
+
+from mitmcache.cache import Cache
+from mitmcache.storage.sqlite3 import SQLiteStorage, _decode_payload, _encode
+from tests.example_flow import example_flow
+
+from .common import measure, summarize, zipf_trace
+from .eviction import prefill
+
+Case = tuple[str, Callable[[argparse.Namespace], dict[str, float]]]
+
+
+def flow_with_body(size: int) -> http.HTTPFlow:
+    flow = example_flow()
+    assert flow.response is not None
+    flow.response.content = b"x" * size
+    return flow
+
+
+def keys(args: argparse.Namespace, count: int) -> Iterator[str]:
+    rng = random.Random(args.seed)
+    return iter(zipf_trace(count, args.exponent, args.repeat, rng))
+
+
+def filled(entries: int, hot: int, body_size: int) -> SQLiteStorage:
+    """A cache of entries rows: hot real entries, the rest filler."""
+    storage = SQLiteStorage(":memory:")
+    prefill(storage, entries - hot)
+    flow = flow_with_body(body_size)
+    storage.upsert_many((f"key-{i}", flow) for i in range(hot))
+    return storage
+
+
+def storage_case(
+    operation: str, entries: int, body_size: int
+) -> Callable[[argparse.Namespace], dict[str, float]]:
+    def run(args: argparse.Namespace) -> dict[str, float]:
+        hot = min(entries, args.keys)
+        storage = filled(entries, hot, body_size)
+        stream = keys(args, hot)
+        flow = flow_with_body(body_size)
+        if operation == "get":
+            latencies = measure(lambda: storage.get(next(stream)), args.repeat)
+        else:
+            latencies = measure(
+                lambda: storage.upsert(next(stream), flow), args.repeat
+            )
+        storage.close()
+        return summarize(latencies)
+
+    return run
+
+
+def evict_case(
+    entries: int,
+) -> Callable[[argparse.Namespace], dict[str, float]]:
+    def run(args: argparse.Namespace) -> dict[str, float]:
+        storage = SQLiteStorage(":memory:", max_entries=entries)
+        prefill(storage, entries)
+        flow = example_flow()
+        new_keys = (f"new-{i}" for i in range(args.repeat))
+        latencies = measure(
+            lambda: storage.upsert(next(new_keys), flow), args.repeat
+        )
+        storage.close()
+        return summarize(latencies)
+
+    return run
+
+
+def serialize_case(
+    compact: bool, body_size: int
+) -> Callable[[argparse.Namespace], dict[str, float]]:
+    def run(args: argparse.Namespace) -> dict[str, float]:
+        flow = flow_with_body(body_size)
+        return summarize(measure(lambda: _encode(flow, compact), args.repeat))
+
+    return run
+
+
+def deserialize_case(
+    compact: bool, body_size: int
+) -> Callable[[argparse.Namespace], dict[str, float]]:
+    def run(args: argparse.Namespace) -> dict[str, float]:
+        flow = flow_with_body(body_size)
+        payload, version = _encode(flow, compact)
+        # _decode_payload only indexes the row, so a dict stands in.
+        row: Any = {
+            "flow": payload,
+            "flow_format_version": version,
+            "codec": None,
+            "method": flow.request.method,
+            "url": flow.request.url,
+        }
+        return summarize(measure(lambda: _decode_payload(row), args.repeat))
+
+    return run
+
+
+def round_trip_case(
+    backend: str,
+) -> Callable[[argparse.Namespace], dict[str, float]]:
+    def run(args: argparse.Namespace) -> dict[str, float]:
+        addon = Cache()
+        with taddons.context(addon) as tctx:
+            tctx.configure(addon, cache_backend=backend)
+            addon.configure({"cache_backend"})
+            flows = iter([request_flow(key) for key in keys(args, args.keys)])
+            response = tutils.tresp(content=b"x" * 4096)
+            latencies = measure(
+                lambda: round_trip(addon, next(flows), response), args.repeat
+            )
+            counters = addon.metrics.counters
+            addon.done()
+        summary = summarize(latencies)
+        summary["hit_ratio"] = counters["hit"] / args.repeat
+        return summary
+
+    return run
+
+
+def request_flow(key: str) -> http.HTTPFlow:
+    return tflow.tflow(
+        req=tutils.treq(headers=[(b"Mitm-Cache-Key", key.encode())]),
+        resp=False,
+    )
+
+
+def round_trip(
+    addon: Cache, flow: http.HTTPFlow, response: http.Response
+) -> None:
+    addon.request(flow)
+    if flow.response is None:
+        flow.response = response.copy()
+        addon.response(flow)
+
+
+def storage_cases(args: argparse.Namespace) -> Iterator[Case]:
+    for entries in args.entries:
+        for body_size in args.body_sizes:
+            suffix = f"[entries={entries},body={body_size}]"
+            for operation in ("get", "upsert"):
+                run = storage_case(operation, entries, body_size)
+                yield f"sqlite.{operation}{suffix}", run
+        yield f"sqlite.evict[entries={entries}]", evict_case(entries)
+
+
+def format_cases(args: argparse.Namespace) -> Iterator[Case]:
+    for body_size in args.body_sizes:
+        for name, compact in (("flow", False), ("compact", True)):
+            suffix = f"[format={name},body={body_size}]"
+            yield f"serialize{suffix}", serialize_case(compact, body_size)
+            yield f"deserialize{suffix}", deserialize_case(compact, body_size)
+
+
+def cases(args: argparse.Namespace) -> list[Case]:
+    found = [*storage_cases(args), *format_cases(args)]
+    for backend in ("memory", "sqlite"):
+        run = round_trip_case(backend)
+        found.append((f"cache.round_trip[backend={backend}]", run))
+    return [case for case in found if args.filter in case[0]]
+
+
+def environment() -> dict[str, str]:
+    return {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "platform": platform.platform(),
+        "mitmproxy": importlib.metadata.version("mitmproxy"),
+        "sqlite": sqlite3.sqlite_version,
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(
+    results: dict[str, dict[str, float]],
+    baseline: dict[str, Any],
+    metric: str,
+    threshold: float,
+) -> list[str]:
+    """Print the change of metric per case; return the regressed cases."""
+    regressed = []
+    print(f"\n{'case':<52} {'baseline':>10} {'current':>10} {'change':>8}")
+    for name, current in results.items():
+        before = baseline["results"].get(name)
+        if before is None:
+            continue
+        change = current[metric] / before[metric] - 1
+        flag = " !" if change > threshold else ""
+        print(
+            f"{name:<52} {before[metric]:>10.1f} {current[metric]:>10.1f}"
+            f" {change:>+8.1%}{flag}"
+        )
+        if flag:
+            regressed.append(name)
+    return regressed
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=2_000)
+    parser.add_argument(
+        "--entries", type=int, nargs="+", default=[1_000, 100_000]
+    )
+    parser.add_argument(
+        "--body-sizes", type=int, nargs="+", default=[1024, 65536]
+    )
+    parser.add_argument(
+        "--keys", type=int, default=1_000, help="distinct keys requested"
+    )
+    parser.add_argument("--exponent", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--rounds", type=int, default=3, help="runs per case; best is kept"
+    )
+    parser.add_argument(
+        "--quick",
+        action="store_true",
+        help="fewer repeats, one entry count and body size",
+    )
+    parser.add_argument(
+        "--filter", default="", help="only cases containing this"
+    )
+    parser.add_argument("--output", help="write the results as JSON here")
+    parser.add_argument("--baseline", help="JSON results to compare with")
+    parser.add_argument(
+        "--metric", default="p50_us", choices=["mean_us", "p50_us", "p99_us"]
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.15,
+        help="fail if a case is this much slower than the baseline",
+    )
+    args = parser.parse_args()
+    if args.quick:
+        args.repeat, args.rounds = 300, 1
+        args.entries = args.entries[:1]
+        args.body_sizes = args.body_sizes[:1]
+    return args
+
+
+def best_of(
+    run: Callable[[argparse.Namespace], dict[str, float]],
+    args: argparse.Namespace,
+) -> dict[str, float]:
+    """Run a case --rounds times and keep the round best in --metric;
+    slower rounds are mostly noise from the rest of the machine."""
+    rounds = []
+    for _ in range(args.rounds):
+        gc.collect()
+        rounds.append(run(args))
+    return min(rounds, key=lambda summary: summary[args.metric])
+
+
+def write_report(
+    args: argparse.Namespace, results: dict[str, dict[str, float]]
+) -> None:
+    ignored = ("output", "baseline")
+    report = {
+        "environment": environment(),
+        "parameters": {
+            key: value
+            for key, value in vars(args).items()
+            if key not in ignored
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as output:
+        json.dump(report, output, indent=2)
+
+
+def check_baseline(
+    args: argparse.Namespace, results: dict[str, dict[str, float]]
+) -> None:
+    with open(args.baseline) as baseline:
+        regressed = compare(
+            results, json.load(baseline), args.metric, args.threshold
+        )
+    if regressed:
+        sys.exit(
+            f"{len(regressed)} cases regressed by more than"
+            f" {args.threshold:.0%}"
+        )
+
+
+def main() -> None:
+    args = parse_args()
+    results = {}
+    print(f"{'case':<52} {'mean_us':>10} {'p50_us':>10} {'p99_us':>10}")
+    for name, run in cases(args):
+        results[name] = summary = best_of(run, args)
+        print(
+            f"{name:<52} {summary['mean_us']:>10.1f}"
+            f" {summary['p50_us']:>10.1f} {summary['p99_us']:>10.1f}"
+        )
+    if args.output:
+        write_report(args, results)
+    if args.baseline:
+        check_baseline(args, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+"""Online snapshots and flow exports of a live cache.
+
+Copying a cache file while the proxy writes to it can produce a corrupt
+copy. snapshot() copies the SQLite databases behind a storage through the
+backup API instead (see SQLiteStorage.snapshot), and export_flows()
+streams the entries of any SQLite or in-memory cache to a mitmproxy flow
+file, optionally filtered by key prefix, host and age. Exported flows
+carry their cache key in flow.metadata, so mitmcache.prewarm imports them
+under the same keys.
+
+The Cache addon offers both as the cache.snapshot and cache.export
+commands. This module is also a CLI for caches of other processes:
+
+    python -m mitmcache.backup snapshot cache.db copy.db
+    python -m mitmcache.backup export cache.db api.mitm \\
+        --key-prefix api: --host example.com --max-age 3600
+"""
+
+from __future__ import annotations
+
+import argparse
+import itertools
+import logging
+import os
+import threading
+import time
+from collections.abc import Callable, Iterable, Iterator
+from typing import TypeVar
+
+import mitmproxy.io as mio
+from mitmproxy import http
+
+from mitmcache.storage.cache_storage import CacheStorage
+from mitmcache.storage.memory import MemoryStorage
+from mitmcache.storage.memory_tier import MemoryTierStorage
+from mitmcache.storage.sharded import ShardedStorage, shard_path
+from mitmcache.storage.sqlite3 import SQLiteStorage
+from mitmcache.storage.write_behind import WriteBehindStorage
+
+logger = logging.getLogger(__name__)
+
+_Entry = tuple[str, http.HTTPFlow]
+
+T = TypeVar("T")
+
+
+def _backing(storage: CacheStorage) -> CacheStorage:
+    """Return the storage below the write-behind queue and memory tier,
+    writing out the queued entries first."""
+    while isinstance(storage, (WriteBehindStorage, MemoryTierStorage)):
+        if isinstance(storage, WriteBehindStorage):
+            storage.flush()
+        storage = storage.storage
+    return storage
+
+
+def _databases(storage: CacheStorage) -> list[CacheStorage]:
+    backing = _backing(storage)
+    if isinstance(backing, ShardedStorage):
+        return backing.shards
+    return [backing]
+
+
+def snapshot_targets(
+    storage: CacheStorage, path: str
+) -> list[tuple[SQLiteStorage, str]]:
+    """Pair each database of storage with the file to copy it to.
+
+    A sharded cache is copied shard by shard, to the shard files of path.
+    Raises ValueError if the cache is not kept in SQLite.
+    """
+    databases = _databases(storage)
+    paths = [path]
+    if len(databases) > 1:
+        paths = [shard_path(path, index) for index in range(len(databases))]
+    targets = []
+    for database, target in zip(databases, paths):
+        if not isinstance(database, SQLiteStorage):
+            raise ValueError("only SQLite caches can be snapshotted")
+        targets.append((database, target))
+    return targets
+
+
+def snapshot(
+    targets: list[tuple[SQLiteStorage, str]],
+    pages: int = 1024,
+    progress: Callable[[int, int], None] | None = None,
+) -> None:
+    for database, path in targets:
+        started = time.monotonic()
+        database.snapshot(path, pages, progress)
+        logger.info(
+            "Snapshot of the cache written to %s in %.1fs",
+            path,
+            time.monotonic() - started,
+        )
+
+
+def cache_entries(
+    storage: CacheStorage, key_prefix: str = ""
+) -> Iterator[_Entry]:
+    """Stream the live entries of storage whose key starts with key_prefix.
+
+    Raises ValueError if the storage cannot list its entries.
+    """
+    sources = []
+    for database in _databases(storage):
+        if not isinstance(database, (SQLiteStorage, MemoryStorage)):
+            raise ValueError(
+                "only SQLite and in-memory caches can be exported"
+            )
+        sources.append(database.entries(key_prefix))
+    return itertools.chain.from_iterable(sources)
+
+
+def matches(flow: http.HTTPFlow, host: str, max_age: float) -> bool:
+    """Whether the flow is for host and its response at most max_age
+    seconds old; an empty host or a max_age of 0 match every flow."""
+    assert flow.response is not None
+    if host and flow.request.pretty_host.lower() != host.lower():
+        return False
+    age = time.time() - flow.response.timestamp_start
+    return not max_age or age <= max_age
+
+
+def export_flows(
+    entries: Iterator[_Entry],
+    path: str,
+    key_header: str,
+    accept: Callable[[http.HTTPFlow], bool] = lambda flow: True,
+) -> int:
+    """Write the accepted flows of entries to a flow file at path.
+
+    Each flow's cache key is stored in flow.metadata[key_header]. The file
+    is written next to path and renamed into place when complete. Returns
+    the number of exported flows.
+    """
+    count = 0
+    partial = f"{path}.partial"
+    try:
+        with open(partial, "wb") as dump:
+            writer = mio.FlowWriter(dump)
+            for cache_key, flow in entries:
+                if accept(flow):
+                    flow.metadata[key_header] = cache_key
+                    writer.add(flow)
+                    count += 1
+    except BaseException:
+        os.remove(partial)
+        raise
+    os.replace(partial, path)
+    return count
+
+
+class Cancelled(Exception):
+    """Raised in a background job that was asked to stop."""
+
+
+class Job:
+    """A task run in a daemon thread that logs its failure.
+
+    The task is called with the job and passes what it works through to
+    job.until_cancelled(), which raises Cancelled once cancel() is called,
+    so that the job stops after the item or batch at hand.
+    """
+
+    def __init__(self, name: str, task: Callable[[Job], object]) -> None:
+        self.name = name
+        self.task = task
+        self._cancelled = threading.Event()
+        self.thread = threading.Thread(
+            target=self._run, name=f"mitmcache-{name}", daemon=True
+        )
+        self.thread.start()
+
+    def _run(self) -> None:
+        try:
+            self.task(self)
+        except Cancelled:
+            logger.info("Cache %s cancelled", self.name)
+        except Exception:
+            logger.exception("Cache %s failed", self.name)
+
+    def until_cancelled(self, items: Iterable[T]) -> Iterator[T]:
+        for item in items:
+            self.check()
+            yield item
+
+    def check(self) -> None:
+        if self._cancelled.is_set():
+            raise Cancelled(self.name)
+
+    def cancel(self) -> None:
+        self._cancelled.set()
+
+    def is_alive(self) -> bool:
+        return self.thread.is_alive()
+
+    def join(self, timeout: float | None = None) -> None:
+        self.thread.join(timeout)
+
+
+def stop_jobs(jobs: list[Job], timeout: float) -> None:
+    """Give jobs timeout seconds to finish, then cancel those still running
+    and give them as long again to stop."""
+    _join(jobs, timeout)
+    for job in jobs:
+        job.cancel()
+    _join(jobs, timeout)
+
+
+def _join(jobs: list[Job], timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    for job in jobs:
+        job.join(max(0.0, deadline - time.monotonic()))
+
+
+def _snapshot_command(args: argparse.Namespace) -> None:
+    storage = SQLiteStorage(args.cache_file)
+    try:
+        snapshot(snapshot_targets(storage, args.target), args.pages)
+    finally:
+        storage.close()
+
+
+def _export_command(args: argparse.Namespace) -> None:
+    storage = SQLiteStorage(args.cache_file)
+    try:
+        count = export_flows(
+            cache_entries(storage, args.key_prefix),
+            args.target,
+            args.key_header,
+            lambda flow: matches(flow, args.host, args.max_age),
+        )
+    finally:
+        storage.close()
+    logger.info("Exported %d flows to %s", count, args.target)
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Snapshot or export a mitmcache SQLite cache in use."
+    )
+    commands = parser.add_subparsers(required=True)
+    copy = commands.add_parser("snapshot", help="copy the database")
+    copy.add_argument("cache_file")
+    copy.add_argument("target")
+    copy.add_argument(
+        "--pages", type=int, default=1024, help="pages copied per step"
+    )
+    copy.set_defaults(command=_snapshot_command)
+    export = commands.add_parser("export", help="write entries to a flow file")
+    export.add_argument("cache_file")
+    export.add_argument("target")
+    export.add_argument("--key-prefix", default="")
+    export.add_argument("--host", default="", help="only flows for host")
+    export.add_argument(
+        "--max-age",
+        type=float,
+        default=0,
+        help="only responses at most this many seconds old",
+    )
+    export.add_argument("--key-header", default="Mitm-Cache-Key")
+    export.set_defaults(command=_export_command)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    args.command(args)
+
+
+if __name__ == "__main__":
+    main()
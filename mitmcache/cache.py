@@ -2,20 +2,74 @@ from __future__ import annotations
 
 import logging
 import re
+import time
+from collections.abc import (
+    Callable,
+    Coroutine,
+    Iterable,
+    Iterator,
+    Sequence,
+)
+from typing import Any
 
-from mitmproxy import ctx, exceptions, http
+from mitmproxy import command, ctx, exceptions, http, types
 from mitmproxy.addonmanager import Loader
 from mitmproxy.http import HTTPFlow
 
-from mitmcache.storage.cache_storage import CacheStorage
-from mitmcache.storage.factory import StorageFactory
+from mitmcache import backup
+from mitmcache.expiry import origin_ttl, parse_ttl
+from mitmcache.keys import DEFAULT_IGNORED_PARAMS, DEFAULT_METHODS, KeyDeriver
+from mitmcache.metrics import Metrics, MetricsDump
+from mitmcache.prewarm import import_flows, log_progress, read_flows
+from mitmcache.revalidation import (
+    REFRESH,
+    is_not_modified,
+    refresh_flow,
+    replay,
+)
+from mitmcache.single_flight import SingleFlight
+from mitmcache.storage.cache_storage import (
+    EXPIRES_AT,
+    STALE_AT,
+    AsyncCacheStorage,
+    CacheStorage,
+)
+from mitmcache.storage.factory import STORAGE_OPTIONS, StorageFactory
 
 logger = logging.getLogger(__name__)
 
+# flow.metadata key carrying the TTL requested by the client from the
+# request hook to the response hook.
+_REQUEST_TTL = "mitmcache.request_ttl"
+
+# Seconds done() waits for background jobs to finish, and again for those
+# it then cancels to stop, before closing the storage.
+JOB_SHUTDOWN_TIMEOUT = 5.0
+
 
 class Cache:
     storage_factory: StorageFactory
     storage: CacheStorage
+    # Set when cache_async_storage is enabled; the hooks then await storage
+    # operations through it instead of calling storage directly.
+    async_storage: AsyncCacheStorage | None = None
+    # Set when cache_derive_keys is enabled; derives keys for requests
+    # without a cache key header.
+    key_deriver: KeyDeriver | None = None
+
+    def __init__(self) -> None:
+        # Origin requests in progress, used to coalesce concurrent misses
+        # when cache_single_flight is enabled.
+        self.single_flight = SingleFlight()
+        # Background refreshes of stale entries in progress, one per key.
+        self.refreshes = SingleFlight()
+        # Prewarms, snapshots and exports running in the background with
+        # the storage they were started on, which is only closed once they
+        # have finished.
+        self.jobs: list[backup.Job] = []
+        # Kept for the lifetime of the addon, across storage changes.
+        self.metrics = Metrics()
+        self.metrics_dump: MetricsDump | None = None
 
     def load(self, loader: Loader) -> None:
         loader.add_option(
@@ -41,7 +95,127 @@ class Cache:
                 "0 means no limit. Responses larger than this are skipped."
             ),
         )
-        self.storage_factory = StorageFactory()
+        loader.add_option(
+            name="cache_ttl",
+            typespec=int,
+            default=0,
+            help=(
+                "Seconds after which stored responses expire unless the "
+                "request or origin sets a TTL. 0 means never."
+            ),
+        )
+        loader.add_option(
+            name="cache_ttl_header",
+            typespec=str,
+            default="Mitm-Cache-TTL",
+            help=(
+                "Request header with the TTL in seconds of the response "
+                "to store. It is never forwarded to the origin."
+            ),
+        )
+        loader.add_option(
+            name="cache_origin_ttl",
+            typespec=bool,
+            default=False,
+            help=(
+                "Expire responses as the origin's Cache-Control max-age, "
+                "s-maxage or Expires headers say, unless the request sets "
+                "a TTL."
+            ),
+        )
+        loader.add_option(
+            name="cache_stale_while_revalidate",
+            typespec=int,
+            default=0,
+            help=(
+                "Seconds after expiry during which a stale entry is still "
+                "served while it is refreshed in the background."
+            ),
+        )
+        loader.add_option(
+            name="cache_stale_if_error",
+            typespec=int,
+            default=0,
+            help=(
+                "Seconds after expiry during which a stale entry is served "
+                "when refreshing it fails with a 5xx, an error or a timeout."
+            ),
+        )
+        loader.add_option(
+            name="cache_revalidate_timeout",
+            typespec=float,
+            default=10.0,
+            help=(
+                "Seconds to wait for the refresh of a stale entry before "
+                "serving it under cache_stale_if_error."
+            ),
+        )
+        loader.add_option(
+            name="cache_single_flight",
+            typespec=bool,
+            default=False,
+            help=(
+                "Send only the first of concurrent misses for a cache key "
+                "to the origin; the others wait for its response."
+            ),
+        )
+        loader.add_option(
+            name="cache_single_flight_timeout",
+            typespec=float,
+            default=30.0,
+            help=(
+                "Seconds a coalesced request waits for the in-flight "
+                "response before going to the origin itself."
+            ),
+        )
+        loader.add_option(
+            name="cache_derive_keys",
+            typespec=bool,
+            default=False,
+            help=(
+                "Derive a cache key from method, normalized URL, "
+                "cache_key_headers and body for requests without the "
+                "cache key header. Requests with Authorization or Cookie "
+                "headers get no key unless those are in cache_key_headers."
+            ),
+        )
+        loader.add_option(
+            name="cache_key_headers",
+            typespec=Sequence[str],
+            default=[],
+            help="Request headers whose values are part of derived keys.",
+        )
+        loader.add_option(
+            name="cache_key_ignored_params",
+            typespec=Sequence[str],
+            default=list(DEFAULT_IGNORED_PARAMS),
+            help=(
+                "Query parameters left out of derived keys. A trailing * "
+                "matches by prefix."
+            ),
+        )
+        loader.add_option(
+            name="cache_key_methods",
+            typespec=Sequence[str],
+            default=list(DEFAULT_METHODS),
+            help="Request methods for which keys are derived.",
+        )
+        loader.add_option(
+            name="cache_metrics_file",
+            typespec=str,
+            default="",
+            help=(
+                "File to write the cache metrics to in the Prometheus text "
+                "format every cache_metrics_interval seconds."
+            ),
+        )
+        loader.add_option(
+            name="cache_metrics_interval",
+            typespec=float,
+            default=15.0,
+            help="Seconds between writes of cache_metrics_file.",
+        )
+        self.storage_factory = StorageFactory(self.metrics)
         self.storage_factory.load(loader)
 
     def configure(self, updated: set[str]) -> None:
@@ -50,18 +224,32 @@ class Cache:
                 "cache_from_origin must differ from cache_key because it is "
                 "used as an internal flow.metadata key."
             )
+        self.key_deriver = _key_deriver()
+        if updated & {"cache_metrics_file", "cache_metrics_interval"}:
+            self._start_metrics_dump()
         existing = getattr(self, "storage", None)
-        if (
-            existing is not None
-            and "cache_file" not in updated
-            and "cache_max_entries" not in updated
-        ):
+        if existing is not None and updated.isdisjoint(STORAGE_OPTIONS):
             return
+        existing_async = getattr(self, "async_storage", None)
         self.storage = self.storage_factory.create()
-        if existing is not None:
-            existing.close()
+        self.async_storage = self.storage_factory.create_async(self.storage)
+        self._close_after_jobs(existing, existing_async)
         self._closed = False
 
+    def _start_metrics_dump(self) -> None:
+        self._stop_metrics_dump()
+        if ctx.options.cache_metrics_file:
+            self.metrics_dump = MetricsDump(
+                self.metrics,
+                ctx.options.cache_metrics_file,
+                float(ctx.options.cache_metrics_interval),
+            )
+
+    def _stop_metrics_dump(self) -> None:
+        if self.metrics_dump is not None:
+            self.metrics_dump.stop()
+            self.metrics_dump = None
+
     @property
     def cache_key(self) -> str:
         return str(ctx.options.cache_key)
@@ -70,7 +258,7 @@ class Cache:
     def cache_from_origin(self) -> str:
         return str(ctx.options.cache_from_origin)
 
-    def request(self, flow: HTTPFlow) -> None:
+    def request(self, flow: HTTPFlow) -> Coroutine[Any, Any, None] | None:
         """request
 
         1. If the request has a cache key and already exists in the cache,
@@ -78,31 +266,153 @@ class Cache:
         2. If the request has a cache key but doesn't exist in the cache,
           request to the origin server without cache key header.
         3. If the request doesn't have a cache key, forward to origin without
-          caching (no UUID fallback — keyless requests are not cacheable).
+          caching (no UUID fallback — keyless requests are not cacheable),
+          unless cache_derive_keys is enabled: then a key is derived from
+          the request and it is handled as in 1. and 2.
+
+        With async storage the lookup is returned as a coroutine, which
+        mitmproxy awaits before the flow continues. So is waiting for an
+        in-flight request for the same key when cache_single_flight is
+        enabled, and for the refresh of a stale entry that is only served
+        if the refresh fails (cache_stale_if_error).
         """
-        if getattr(self, "_closed", False):
-            logger.warning("Cache.request() called after done(); skipping.")
-            return
+        if self._bypasses(flow):
+            return None
         # Get cache key from request headers
-        cache_key = self.get_cache_key_from_flow(flow)
+        cache_key = self._request_cache_key(flow)
         # Cache key header is a proxy-internal hint; never forward it to the
         # origin regardless of cache hit / miss / no-key. Pop once here so
         # all branches stay symmetric and a future branch cannot leak it.
         flow.request.headers.pop(self.cache_key, None)
+        self._pop_request_ttl(flow)
 
-        cache_from_origin = True
+        if cache_key is None:
+            self._mark_request(flow, None, False)
+            return None
+        if self.async_storage is not None:
+            return self._request_async(flow, cache_key)
+        return self._lookup(flow, cache_key)
 
+    def _lookup(
+        self, flow: HTTPFlow, cache_key: str
+    ) -> Coroutine[Any, Any, None] | None:
         # Get response from cache
-        if cache_key is not None and self._set_cached_response(
-            flow, cache_key
+        if self._set_cached_response(flow, cache_key):
+            return self._hit(flow, cache_key)
+        return self._miss(flow, cache_key)
+
+    def _bypasses(self, flow: HTTPFlow) -> bool:
+        if getattr(self, "_closed", False):
+            logger.warning("Cache.request() called after done(); skipping.")
+            return True
+        # Refreshes were marked by _refresh() to go to the origin.
+        return bool(flow.metadata.get(REFRESH))
+
+    def _pop_request_ttl(self, flow: HTTPFlow) -> None:
+        value = flow.request.headers.pop(ctx.options.cache_ttl_header, None)
+        ttl = parse_ttl(value)
+        if ttl is not None:
+            flow.metadata[_REQUEST_TTL] = ttl
+
+    def _request_cache_key(self, flow: HTTPFlow) -> str | None:
+        cache_key = self.get_cache_key_from_flow(flow)
+        if cache_key is None and self.key_deriver is not None:
+            return self.key_deriver.derive(flow.request)
+        return cache_key
+
+    async def _request_async(self, flow: HTTPFlow, cache_key: str) -> None:
+        if await self._set_cached_response_async(flow, cache_key):
+            waiting = self._hit(flow, cache_key)
+        else:
+            waiting = self._miss(flow, cache_key)
+        if waiting is not None:
+            await waiting
+
+    def _hit(
+        self, flow: HTTPFlow, cache_key: str
+    ) -> Coroutine[Any, Any, None] | None:
+        """Serve a hit; stale ones are refreshed from the origin."""
+        self._mark_request(flow, cache_key, True)
+        stale_at = flow.metadata.pop(STALE_AT, None)
+        now = time.time()
+        if stale_at is None or now < stale_at:
+            return None
+        if now < stale_at + ctx.options.cache_stale_while_revalidate:
+            logger.info(
+                f"Cache hit (stale, refreshing): {_sanitize_for_log(cache_key)}"
+            )
+            self._refresh(flow, cache_key)
+            return None
+        return self._refresh_or_serve_stale(flow, cache_key)
+
+    def _refresh(self, flow: HTTPFlow, cache_key: str) -> None:
+        """Replay the request to the origin unless a refresh is running."""
+        refresh = refresh_flow(flow)
+        timeout = float(ctx.options.cache_revalidate_timeout)
+        if not self.refreshes.lead(cache_key, refresh.id, timeout):
+            return
+        refresh.metadata[self.cache_key] = cache_key
+        refresh.metadata[self.cache_from_origin] = True
+        try:
+            replay(refresh)
+        except Exception:
+            logger.exception(
+                "Could not refresh %s", _sanitize_for_log(cache_key)
+            )
+            self.refreshes.release(cache_key, refresh.id, None)
+
+    async def _refresh_or_serve_stale(
+        self, flow: HTTPFlow, cache_key: str
+    ) -> None:
+        self._refresh(flow, cache_key)
+        response = await self.refreshes.wait(
+            cache_key, float(ctx.options.cache_revalidate_timeout)
+        )
+        if response is None:
+            logger.warning(
+                "Refresh failed; serving stale entry %s",
+                _sanitize_for_log(cache_key),
+            )
+        elif response.status_code != 304:
+            flow.response = response
+
+    def _miss(
+        self, flow: HTTPFlow, cache_key: str
+    ) -> Coroutine[Any, Any, None] | None:
+        """Send a miss to the origin, or wait for an in-flight request."""
+        timeout = float(ctx.options.cache_single_flight_timeout)
+        if ctx.options.cache_single_flight and not self.single_flight.lead(
+            cache_key, flow.id, timeout
         ):
-            cache_from_origin = False
+            return self._wait_for_flight(flow, cache_key, timeout)
+        self._mark_request(flow, cache_key, False)
+        return None
+
+    async def _wait_for_flight(
+        self, flow: HTTPFlow, cache_key: str, timeout: float
+    ) -> None:
+        response = await self.single_flight.wait(cache_key, timeout)
+        if response is not None:
+            logger.info(
+                f"Cache hit (coalesced): {_sanitize_for_log(cache_key)}"
+            )
+            flow.response = response
+        self._mark_request(flow, cache_key, response is not None)
 
+    def _mark_request(
+        self, flow: HTTPFlow, cache_key: str | None, hit: bool
+    ) -> None:
         # Set cache key to flow
         flow.metadata[self.cache_key] = cache_key
-        flow.metadata[self.cache_from_origin] = cache_from_origin
+        flow.metadata[self.cache_from_origin] = not hit
+        if cache_key is None:
+            self.metrics.count("keyless")
+        else:
+            self.metrics.count("hit" if hit else "miss")
 
-    def response(self, flow: http.HTTPFlow) -> None:
+    def response(
+        self, flow: http.HTTPFlow
+    ) -> Coroutine[Any, Any, None] | None:
         """response
 
         1. If the response has a cache key, do nothing.
@@ -111,33 +421,109 @@ class Cache:
         """
         if getattr(self, "_closed", False):
             logger.warning("Cache.response() called after done(); skipping.")
-            return
+            return None
 
         # Strip internal header so it never reaches the downstream client.
         if flow.response is not None:
             flow.response.headers.pop(self.cache_key, None)
 
+        cache_key = self._cache_key_to_store(flow)
+        self._end_flight(flow, cached=cache_key is not None)
+        if cache_key is None:
+            return None
+        return self._store(cache_key, flow)
+
+    def error(self, flow: http.HTTPFlow) -> None:
+        """Release requests waiting on a flow that failed at the origin."""
+        self._end_flight(flow, cached=False)
+
+    def _end_flight(self, flow: http.HTTPFlow, cached: bool) -> None:
+        # Only the leader's flow ends a flight (a coalesced miss or a
+        # refresh); release() ignores others.
+        cache_key = flow.metadata.get(self.cache_key)
+        if cache_key is None:
+            return
+        response = flow.response if cached else None
+        for flights in (self.single_flight, self.refreshes):
+            flights.release(cache_key, flow.id, response)
+
+    def _cache_key_to_store(self, flow: http.HTTPFlow) -> str | None:
+        """Return the key to store a fetched response under, if any."""
         # Check if the response has a cache key
         cache_key = self.get_cache_key_from_flow(flow)
-        if flow.metadata.get(self.cache_from_origin, False) and cache_key is not None:
-            self._store_response(cache_key, flow)
+        if not flow.metadata.get(self.cache_from_origin, False):
+            return None
+        if cache_key is None:
+            return None
+        skipped = self._skip_reason(flow, cache_key)
+        if skipped is not None:
+            self.metrics.count(skipped)
+            return None
+        return cache_key
 
-    def _store_response(self, cache_key: str, flow: http.HTTPFlow) -> None:
-        """Best-effort cache write; storage failures leave the flow uncached."""
+    def _is_cacheable(self, flow: http.HTTPFlow, cache_key: str) -> bool:
+        return self._skip_reason(flow, cache_key) is None
+
+    def _skip_reason(self, flow: http.HTTPFlow, cache_key: str) -> str | None:
+        """Return the metrics counter of the reason not to cache a
+        response, or None if it is cached."""
         # Do not cache error responses; a cached 4xx/5xx would be served
         # indefinitely even after the origin recovers.
         if flow.response is None or flow.response.status_code >= 400:
-            return
+            return "skipped_status"
         if self._response_body_exceeds_limit(flow, cache_key):
+            return "skipped_body_size"
+        return None
+
+    def _store(
+        self, cache_key: str, flow: http.HTTPFlow
+    ) -> Coroutine[Any, Any, None] | None:
+        _set_expiry(flow, _ttl(flow))
+        # A 304 to a conditional refresh only renews the stored entry.
+        renew = is_not_modified(flow)
+        if self.async_storage is not None:
+            return self._store_response_async(cache_key, flow, renew)
+        self._store_response(cache_key, flow, renew)
+        return None
+
+    def _store_response(
+        self, cache_key: str, flow: http.HTTPFlow, renew: bool
+    ) -> None:
+        """Best-effort cache write; storage failures leave the flow uncached."""
+        started = time.perf_counter()
+        try:
+            if renew:
+                self.storage.revalidate(cache_key, flow)
+            else:
+                self.storage.upsert(cache_key, flow)
+        except Exception:
+            self._write_failed(cache_key)
             return
+        self._written(cache_key, renew, started)
+
+    async def _store_response_async(
+        self, cache_key: str, flow: http.HTTPFlow, renew: bool
+    ) -> None:
+        assert self.async_storage is not None
+        started = time.perf_counter()
         try:
-            self.storage.upsert(cache_key, flow)
-            logger.info(f"Cache stored: {_sanitize_for_log(cache_key)}")
+            if renew:
+                await self.async_storage.revalidate(cache_key, flow)
+            else:
+                await self.async_storage.upsert(cache_key, flow)
         except Exception:
-            logger.exception(
-                "Cache storage write failed for key %s; response not cached",
-                _sanitize_for_log(cache_key),
-            )
+            self._write_failed(cache_key)
+            return
+        self._written(cache_key, renew, started)
+
+    def _written(self, cache_key: str, renew: bool, started: float) -> None:
+        self.metrics.observe("write", time.perf_counter() - started)
+        self.metrics.count("revalidate" if renew else "store")
+        _log_write(cache_key, renew)
+
+    def _write_failed(self, cache_key: str) -> None:
+        self.metrics.count("write_error")
+        _log_write_failure(cache_key)
 
     def _response_body_exceeds_limit(
         self, flow: http.HTTPFlow, cache_key: str
@@ -159,27 +545,50 @@ class Cache:
 
     def _set_cached_response(self, flow: HTTPFlow, cache_key: str) -> bool:
         """Best-effort cache read; storage failures bypass the cache."""
+        started = time.perf_counter()
         try:
             cache = self.storage.get(cache_key)
         except Exception:
-            logger.exception(
-                "Cache storage read failed for key %s; bypassing cache",
-                _sanitize_for_log(cache_key),
-            )
-            return False
-        if cache is None:
+            self._read_failed(cache_key)
             return False
-        if cache.response is None:
-            logger.warning(
-                "Ignoring cached flow without response: %s",
-                _sanitize_for_log(cache_key),
-            )
+        self.metrics.observe("lookup", time.perf_counter() - started)
+        if cache is not None and cache.response is None:
+            _log_missing_response(cache_key)
             self.storage.purge(cache_key)
             return False
+        return self._use_cached_flow(flow, cache_key, cache)
+
+    async def _set_cached_response_async(
+        self, flow: HTTPFlow, cache_key: str
+    ) -> bool:
+        assert self.async_storage is not None
+        started = time.perf_counter()
+        try:
+            cache = await self.async_storage.get(cache_key)
+        except Exception:
+            self._read_failed(cache_key)
+            return False
+        self.metrics.observe("lookup", time.perf_counter() - started)
+        if cache is not None and cache.response is None:
+            _log_missing_response(cache_key)
+            await self.async_storage.purge(cache_key)
+            return False
+        return self._use_cached_flow(flow, cache_key, cache)
+
+    def _read_failed(self, cache_key: str) -> None:
+        self.metrics.count("read_error")
+        _log_read_failure(cache_key)
 
+    def _use_cached_flow(
+        self, flow: HTTPFlow, cache_key: str, cache: HTTPFlow | None
+    ) -> bool:
+        if cache is None or cache.response is None:
+            return False
         logger.info(f"Cache hit: {_sanitize_for_log(cache_key)}")
         flow.response = cache.response
         flow.metadata[self.cache_key] = cache_key
+        if STALE_AT in cache.metadata:
+            flow.metadata[STALE_AT] = cache.metadata[STALE_AT]
         return True
 
     def get_cache_key_from_flow(self, flow: HTTPFlow) -> str | None:
@@ -197,13 +606,196 @@ class Cache:
             candidates.append(flow.response.headers.get(self.cache_key))
         return candidates
 
+    @command.command("cache.prewarm")
+    def prewarm(self, path: types.Path) -> None:
+        """Import the responses of a flow dump written with -w into the
+        cache in the background, keyed and expired as if they had passed
+        through the proxy."""
+        storage = self.storage
+
+        def prewarm(job: backup.Job) -> None:
+            flows = job.until_cancelled(
+                self._prewarm_entries(read_flows(path))
+            )
+            count = import_flows(storage, flows, progress=log_progress)
+            logger.info("Prewarm: %d flows imported from %s", count, path)
+
+        self._start_job("prewarm", prewarm)
+
+    def _prewarm_entries(
+        self, flows: Iterable[HTTPFlow]
+    ) -> Iterator[tuple[str, HTTPFlow]]:
+        for flow in flows:
+            cache_key = self._request_cache_key(flow)
+            if cache_key is None or not self._is_cacheable(flow, cache_key):
+                continue
+            self._pop_request_ttl(flow)
+            assert flow.response is not None
+            flow.response.headers.pop(self.cache_key, None)
+            _set_expiry(flow, _ttl(flow))
+            yield cache_key, flow
+
+    @command.command("cache.snapshot")
+    def snapshot(self, path: types.Path) -> None:
+        """Copy the cache database to path in the background, without
+        stopping the proxy. A sharded cache is copied to one file per
+        shard."""
+        try:
+            targets = backup.snapshot_targets(self.storage, path)
+        except ValueError as e:
+            raise exceptions.CommandError(str(e)) from e
+
+        def snapshot(job: backup.Job) -> None:
+            backup.snapshot(targets, progress=lambda *_: job.check())
+
+        self._start_job("snapshot", snapshot)
+
+    @command.command("cache.export")
+    def export(
+        self,
+        path: types.Path,
+        key_prefix: str = "",
+        host: str = "",
+        max_age: int = 0,
+    ) -> None:
+        """Write the cached flows to a flow file in the background, only
+        those whose key starts with key_prefix, for host and at most
+        max_age seconds old if given."""
+        try:
+            entries = backup.cache_entries(self.storage, key_prefix)
+        except ValueError as e:
+            raise exceptions.CommandError(str(e)) from e
+
+        def export(job: backup.Job) -> None:
+            count = backup.export_flows(
+                job.until_cancelled(entries),
+                path,
+                self.cache_key,
+                lambda flow: backup.matches(flow, host, max_age),
+            )
+            logger.info("Exported %d cached flows to %s", count, path)
+
+        self._start_job("export", export)
+
+    def _start_job(
+        self, name: str, task: Callable[[backup.Job], object]
+    ) -> None:
+        self.jobs = [job for job in self.jobs if job.is_alive()]
+        self.jobs.append(backup.Job(name, task))
+
+    def _close_after_jobs(
+        self,
+        storage: CacheStorage | None,
+        async_storage: AsyncCacheStorage | None,
+    ) -> None:
+        """Close a replaced storage once the running jobs, which may use
+        it, have finished, without blocking the event loop."""
+        jobs = [job for job in self.jobs if job.is_alive()]
+        if not jobs:
+            _close_storage(storage, async_storage)
+            return
+
+        def close(_: backup.Job) -> None:
+            for job in jobs:
+                job.join()
+            _close_storage(storage, async_storage)
+
+        self._start_job("close", close)
+
+    @command.command("cache.metrics")
+    def metrics_text(self) -> str:
+        """Return the cache metrics in the Prometheus text format: requests
+        by result, writes, skipped responses, storage errors and storage
+        latency histograms."""
+        return self.metrics.render()
+
     def done(self) -> None:
-        storage = getattr(self, "storage", None)
-        if storage is not None:
-            storage.close()
+        self.single_flight.release_all()
+        self.refreshes.release_all()
+        backup.stop_jobs(self.jobs, JOB_SHUTDOWN_TIMEOUT)
+        self.jobs = []
+        self._stop_metrics_dump()
+        _close_storage(getattr(self, "storage", None), self.async_storage)
         self._closed = True
 
 
+def _ttl(flow: HTTPFlow) -> int | None:
+    """Return the TTL of a response to store: request, origin, default."""
+    ttl: int | None = flow.metadata.get(_REQUEST_TTL)
+    if ttl is None and ctx.options.cache_origin_ttl:
+        assert flow.response is not None
+        ttl = origin_ttl(flow.response, time.time())
+    if ttl is None and ctx.options.cache_ttl > 0:
+        ttl = int(ctx.options.cache_ttl)
+    return ttl
+
+
+def _set_expiry(flow: HTTPFlow, ttl: int | None) -> None:
+    """Set when the response to store goes stale and when it expires.
+
+    With stale windows configured an entry stays servable for the longer
+    window after its TTL; STALE_AT then marks the end of its TTL.
+    """
+    flow.metadata.pop(EXPIRES_AT, None)
+    flow.metadata.pop(STALE_AT, None)
+    if ttl is None:
+        return
+    fresh_until = int(time.time()) + ttl
+    grace = max(
+        ctx.options.cache_stale_while_revalidate,
+        ctx.options.cache_stale_if_error,
+    )
+    flow.metadata[EXPIRES_AT] = fresh_until + grace
+    if grace > 0:
+        flow.metadata[STALE_AT] = fresh_until
+
+
+def _key_deriver() -> KeyDeriver | None:
+    if not ctx.options.cache_derive_keys:
+        return None
+    return KeyDeriver(
+        headers=ctx.options.cache_key_headers,
+        ignored_params=ctx.options.cache_key_ignored_params,
+        methods=ctx.options.cache_key_methods,
+    )
+
+
+def _close_storage(
+    storage: CacheStorage | None, async_storage: AsyncCacheStorage | None
+) -> None:
+    """Close storage, through its async adapter when it has one."""
+    if async_storage is not None:
+        async_storage.close()
+    elif storage is not None:
+        storage.close()
+
+
+def _log_read_failure(cache_key: str) -> None:
+    logger.exception(
+        "Cache storage read failed for key %s; bypassing cache",
+        _sanitize_for_log(cache_key),
+    )
+
+
+def _log_write(cache_key: str, renew: bool) -> None:
+    action = "revalidated" if renew else "stored"
+    logger.info(f"Cache {action}: {_sanitize_for_log(cache_key)}")
+
+
+def _log_write_failure(cache_key: str) -> None:
+    logger.exception(
+        "Cache storage write failed for key %s; response not cached",
+        _sanitize_for_log(cache_key),
+    )
+
+
+def _log_missing_response(cache_key: str) -> None:
+    logger.warning(
+        "Ignoring cached flow without response: %s",
+        _sanitize_for_log(cache_key),
+    )
+
+
 _CONTROL_CHARS_RE = re.compile(r"[\x00-\x1f\x7f]")
 
 
@@ -0,0 +1,69 @@
+"""Time-to-live of cached responses.
+
+A TTL can come from a request header set by the client, from the origin's
+Cache-Control/Expires headers, or from a global default; Cache picks the
+first one available in that order.
+"""
+
+from __future__ import annotations
+
+from email.utils import parsedate_to_datetime
+
+from mitmproxy import http
+
+
+def parse_ttl(value: str | None) -> int | None:
+    """Parse a TTL in whole seconds; None if missing or invalid."""
+    if value is None:
+        return None
+    try:
+        ttl = int(value.strip())
+    except ValueError:
+        return None
+    return ttl if ttl >= 0 else None
+
+
+def origin_ttl(response: http.Response, now: float) -> int | None:
+    """Return the freshness lifetime the origin granted, in seconds.
+
+    s-maxage takes precedence over max-age (the proxy is a shared cache),
+    and both over Expires. The response's Age is subtracted. None means the
+    origin did not say.
+    """
+    directives = _cache_control(response.headers.get("cache-control", ""))
+    ttl = parse_ttl(directives.get("s-maxage", directives.get("max-age")))
+    if ttl is None:
+        ttl = _expires_ttl(response, now)
+    if ttl is None:
+        return None
+    age = parse_ttl(response.headers.get("age")) or 0
+    return max(0, ttl - age)
+
+
+def _cache_control(value: str) -> dict[str, str | None]:
+    directives: dict[str, str | None] = {}
+    for directive in value.split(","):
+        name, sep, argument = directive.partition("=")
+        name = name.strip().lower()
+        if name:
+            directives[name] = argument.strip().strip('"') if sep else None
+    return directives
+
+
+def _expires_ttl(response: http.Response, now: float) -> int | None:
+    expires = response.headers.get("expires")
+    if expires is None:
+        return None
+    expires_at = _parse_http_date(expires)
+    if expires_at is None:
+        # An invalid Expires means "already expired" (RFC 9111 5.3).
+        return 0
+    date = _parse_http_date(response.headers.get("date", ""))
+    return max(0, int(expires_at - (now if date is None else date)))
+
+
+def _parse_http_date(value: str) -> float | None:
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,128 @@
+"""Derivation of cache keys for requests without a cache key header.
+
+A derived key is the SHA-256 hex digest of the request's method, its
+normalized URL, a configurable set of header values and a digest of the
+body. URLs are normalized by lowercasing scheme and host, dropping the
+default port, removing empty and tracking parameters and sorting the
+query. JSON bodies (including GraphQL over JSON) are canonicalized first,
+so key order and whitespace do not produce different keys.
+
+Requests carrying credentials (Authorization or Cookie headers) get no
+derived key unless those headers are among the key headers: their
+responses may be personal, and a key without them would serve one user's
+response to another.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+from collections.abc import Iterable, Iterator
+
+from mitmproxy import http
+
+# Query parameters that identify a campaign or click rather than the
+# resource. A trailing "*" matches by prefix.
+DEFAULT_IGNORED_PARAMS = (
+    "utm_*",
+    "gclid",
+    "fbclid",
+    "msclkid",
+    "mc_cid",
+    "mc_eid",
+    "_ga",
+)
+DEFAULT_METHODS = ("GET", "HEAD", "POST")
+CREDENTIAL_HEADERS = ("authorization", "cookie")
+_DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+class KeyDeriver:
+    def __init__(
+        self,
+        headers: Iterable[str] = (),
+        ignored_params: Iterable[str] = DEFAULT_IGNORED_PARAMS,
+        methods: Iterable[str] = DEFAULT_METHODS,
+    ) -> None:
+        self.headers = tuple(name.lower() for name in headers)
+        ignored = tuple(ignored_params)
+        self.ignored_params = frozenset(
+            p for p in ignored if not p.endswith("*")
+        )
+        self.ignored_prefixes = tuple(
+            p[:-1] for p in ignored if p.endswith("*")
+        )
+        self.methods = frozenset(method.upper() for method in methods)
+        self.credential_headers = tuple(
+            name for name in CREDENTIAL_HEADERS if name not in self.headers
+        )
+
+    def derive(self, request: http.Request) -> str | None:
+        """Return the key for a request, or None if its method is excluded
+        or it carries credentials that are not part of the key."""
+        method = request.method.upper()
+        if method not in self.methods or self._has_credentials(request):
+            return None
+        digest = hashlib.sha256()
+        for part in (
+            method,
+            self.normalize_url(request),
+            *self._header_values(request),
+            _body_digest(request),
+        ):
+            digest.update(part.encode())
+            digest.update(b"\n")
+        return digest.hexdigest()
+
+    def normalize_url(self, request: http.Request) -> str:
+        scheme = request.scheme.lower()
+        authority = request.host.lower()
+        if request.port != _DEFAULT_PORTS.get(scheme):
+            authority = f"{authority}:{request.port}"
+        path, _, query = request.path.partition("?")
+        if query:
+            path = f"{path}?{self._normalize_query(query)}"
+        return f"{scheme}://{authority}{path}"
+
+    def _normalize_query(self, query: str) -> str:
+        # Parameters are compared in their encoded form; decoding and
+        # re-encoding them would triple the cost of a derivation.
+        params = [
+            param
+            for param in query.split("&")
+            if param and self._keeps(param.partition("=")[0])
+        ]
+        params.sort()
+        return "&".join(params)
+
+    def _keeps(self, param: str) -> bool:
+        return param not in self.ignored_params and not param.startswith(
+            self.ignored_prefixes
+        )
+
+    def _has_credentials(self, request: http.Request) -> bool:
+        return any(name in request.headers for name in self.credential_headers)
+
+    def _header_values(self, request: http.Request) -> Iterator[str]:
+        for name in self.headers:
+            values = request.headers.get_all(name)
+            yield f"{name}:{','.join(values)}"
+
+
+def _body_digest(request: http.Request) -> str:
+    body = request.get_content(strict=False)
+    if not body:
+        return ""
+    if "json" in request.headers.get("content-type", ""):
+        body = _canonical_json(body)
+    return hashlib.sha256(body).hexdigest()
+
+
+def _canonical_json(body: bytes) -> bytes:
+    try:
+        document = json.loads(body)
+    except ValueError:
+        return body
+    return json.dumps(
+        document, sort_keys=True, separators=(",", ":"), ensure_ascii=False
+    ).encode()
@@ -0,0 +1,174 @@
+"""Counters and latency histograms of the cache.
+
+Metrics are kept in memory: a few integer increments and a bisect into
+fixed bucket bounds per request. They are rendered in the Prometheus text
+exposition format, both for the cache.metrics command and for
+MetricsDump, which writes them to a file periodically, e.g. for the
+node_exporter textfile collector.
+"""
+
+from __future__ import annotations
+
+import bisect
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the latency buckets in seconds, from 25µs to 1s.
+BUCKETS = (
+    0.000025,
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+)
+
+# Counter names and the Prometheus series they are exposed as.
+COUNTERS = {
+    "hit": ("mitmcache_requests_total", 'result="hit"'),
+    "miss": ("mitmcache_requests_total", 'result="miss"'),
+    "keyless": ("mitmcache_requests_total", 'result="keyless"'),
+    "store": ("mitmcache_writes_total", 'kind="store"'),
+    "revalidate": ("mitmcache_writes_total", 'kind="revalidate"'),
+    "skipped_status": ("mitmcache_skipped_total", 'reason="status"'),
+    "skipped_body_size": ("mitmcache_skipped_total", 'reason="body_size"'),
+    "read_error": ("mitmcache_storage_errors_total", 'operation="read"'),
+    "write_error": ("mitmcache_storage_errors_total", 'operation="write"'),
+}
+
+# Timed operations: the storage lookup and write as seen by the addon,
+# and decoding a stored entry into a flow within the lookup.
+OPERATIONS = ("lookup", "deserialize", "write")
+
+_HELP = {
+    "mitmcache_requests_total": "Requests by cache result.",
+    "mitmcache_writes_total": "Responses written to the cache.",
+    "mitmcache_skipped_total": "Responses not cached, by reason.",
+    "mitmcache_storage_errors_total": "Failed storage operations.",
+}
+
+
+class Histogram:
+    def __init__(self) -> None:
+        # counts[i] observations fell into BUCKETS[i]; the last count is
+        # for those above every bound.
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+
+class Metrics:
+    """Counters of COUNTERS and a latency histogram per OPERATIONS entry.
+
+    The addon records from the event loop thread; storages running in
+    worker threads record deserialization times concurrently. Updates are
+    not locked, which would cost more than recording itself: an increment
+    racing with another one can get lost, so histograms under concurrent
+    lookups are very slightly approximate.
+    """
+
+    def __init__(self) -> None:
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.histograms = {operation: Histogram() for operation in OPERATIONS}
+
+    def count(self, name: str) -> None:
+        self.counters[name] += 1
+
+    def observe(self, operation: str, seconds: float) -> None:
+        self.histograms[operation].observe(seconds)
+
+    def render(self) -> str:
+        """Return the metrics in the Prometheus text exposition format."""
+        lines = self._counter_lines() + self._histogram_lines()
+        return "\n".join(lines) + "\n"
+
+    def _counter_lines(self) -> list[str]:
+        lines = []
+        for metric, help_text in _HELP.items():
+            lines += [
+                f"# HELP {metric} {help_text}",
+                f"# TYPE {metric} counter",
+            ]
+            lines += [
+                f"{metric}{{{labels}}} {self.counters[name]}"
+                for name, (series, labels) in COUNTERS.items()
+                if series == metric
+            ]
+        return lines
+
+    def _histogram_lines(self) -> list[str]:
+        metric = "mitmcache_storage_seconds"
+        lines = [
+            f"# HELP {metric} Latency of storage operations.",
+            f"# TYPE {metric} histogram",
+        ]
+        for operation, histogram in self.histograms.items():
+            label = f'operation="{operation}"'
+            counts, total = list(histogram.counts), histogram.sum
+            cumulative = 0
+            for bound, count in zip((*BUCKETS, "+Inf"), counts):
+                cumulative += count
+                lines.append(
+                    f'{metric}_bucket{{{label},le="{bound}"}} {cumulative}'
+                )
+            lines.append(f"{metric}_sum{{{label}}} {total}")
+            lines.append(f"{metric}_count{{{label}}} {cumulative}")
+        return lines
+
+
+class MetricsDump:
+    """Write the metrics to path every interval seconds from a thread.
+
+    The file is replaced atomically, so readers never see a partial one;
+    stop() writes it one last time.
+    """
+
+    def __init__(self, metrics: Metrics, path: str, interval: float) -> None:
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="mitmcache-metrics", daemon=True
+        )
+        self._thread.start()
+
+    def write(self) -> None:
+        partial = f"{self.path}.partial"
+        with open(partial, "w") as dump:
+            dump.write(self.metrics.render())
+        os.replace(partial, self.path)
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+        self._write_logged()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self._write_logged()
+
+    def _write_logged(self) -> None:
+        try:
+            self.write()
+        except OSError:
+            logger.exception("Writing cache metrics to %s failed", self.path)
@@ -0,0 +1,150 @@
+"""Bulk import of mitmproxy flow dumps into the cache.
+
+Responses captured with `mitmdump -w` can prewarm a cache without
+replaying the traffic through the proxy. Flows are streamed from the dump
+and written in batches of upsert_many() calls, one transaction each for
+SQLite.
+
+The Cache addon offers this as the cache.prewarm command, which imports
+in the background while the proxy serves from the cache. This module is
+also a standalone CLI for importing into a cache file offline; as nothing
+else uses the file then, it drops the secondary indexes for the import
+and rebuilds them once it is done:
+
+    python -m mitmcache.prewarm capture.mitm --cache-file cache.db
+    python -m mitmcache.prewarm a.mitm b.mitm --cache-file cache.db \\
+        --derive-keys --compact --ttl 86400
+"""
+
+from __future__ import annotations
+
+import argparse
+import itertools
+import logging
+import time
+from collections.abc import Callable, Iterable, Iterator
+
+import mitmproxy.io as mio
+from mitmproxy import http
+
+from mitmcache.keys import KeyDeriver
+from mitmcache.storage.cache_storage import EXPIRES_AT, CacheStorage
+from mitmcache.storage.sqlite3 import SQLiteStorage
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 10_000
+
+_Entry = tuple[str, http.HTTPFlow]
+
+
+def read_flows(path: str) -> Iterator[http.HTTPFlow]:
+    """Stream the HTTP flows that have a response from a flow dump."""
+    with open(path, "rb") as dump:
+        for flow in mio.FlowReader(dump).stream():
+            if isinstance(flow, http.HTTPFlow) and flow.response is not None:
+                yield flow
+
+
+def import_flows(
+    storage: CacheStorage,
+    entries: Iterable[_Entry],
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    progress: Callable[[int], None] | None = None,
+) -> int:
+    """Upsert entries in batches; return how many were written.
+
+    progress(count) is called after every batch.
+    """
+    count = 0
+    for batch in _batches(entries, batch_size):
+        storage.upsert_many(batch)
+        count += len(batch)
+        if progress is not None:
+            progress(count)
+    return count
+
+
+def _batches(entries: Iterable[_Entry], size: int) -> Iterator[list[_Entry]]:
+    iterator = iter(entries)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+
+def log_progress(count: int) -> None:
+    logger.info("Prewarm: %d flows imported", count)
+
+
+def _cli_entries(
+    flows: Iterable[http.HTTPFlow],
+    key_header: str,
+    deriver: KeyDeriver | None,
+    ttl: int | None,
+) -> Iterator[_Entry]:
+    """Key the cacheable flows like the addon does and set their expiry."""
+    for flow in flows:
+        cache_key = _cli_key(flow, key_header, deriver)
+        assert flow.response is not None
+        if cache_key is None or flow.response.status_code >= 400:
+            continue
+        flow.response.headers.pop(key_header, None)
+        if ttl is not None:
+            flow.metadata[EXPIRES_AT] = int(time.time()) + ttl
+        yield cache_key, flow
+
+
+def _cli_key(
+    flow: http.HTTPFlow, key_header: str, deriver: KeyDeriver | None
+) -> str | None:
+    assert flow.response is not None
+    candidates = (
+        flow.metadata.get(key_header),
+        flow.request.headers.get(key_header),
+        flow.response.headers.get(key_header),
+    )
+    cache_key: str | None = next(
+        (key for key in candidates if key is not None), None
+    )
+    if cache_key is None and deriver is not None:
+        return deriver.derive(flow.request)
+    return cache_key
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Import the responses of mitmproxy flow dumps into a "
+        "mitmcache SQLite cache."
+    )
+    parser.add_argument("dumps", nargs="+", help="files written by -w")
+    parser.add_argument("--cache-file", required=True)
+    parser.add_argument("--key-header", default="Mitm-Cache-Key")
+    parser.add_argument(
+        "--derive-keys",
+        action="store_true",
+        help="derive keys for flows without a cache key, as with "
+        "cache_derive_keys",
+    )
+    parser.add_argument(
+        "--compact", action="store_true", help="store compact entries"
+    )
+    parser.add_argument("--ttl", type=int, help="expire entries after TTL s")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    deriver = KeyDeriver() if args.derive_keys else None
+    flows = itertools.chain.from_iterable(map(read_flows, args.dumps))
+    entries = _cli_entries(flows, args.key_header, deriver, args.ttl)
+    storage = SQLiteStorage(args.cache_file, compact=args.compact)
+    try:
+        with storage.deferred_indexes():
+            count = import_flows(
+                storage, entries, args.batch_size, log_progress
+            )
+    finally:
+        storage.close()
+    logger.info("Prewarm: done, %d flows imported", count)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""Background refreshes of stale cache entries.
+
+A refresh is a copy of the client request that hit a stale entry. It is
+sent to the origin through mitmproxy's client replay, so it passes through
+the addon's hooks like any other request and its response is stored the
+usual way.
+
+Refreshes are conditional when the cached response has validators: its
+ETag is sent as If-None-Match and its Last-Modified as If-Modified-Since.
+A 304 Not Modified then only renews the stored entry's expiry.
+"""
+
+from __future__ import annotations
+
+from mitmproxy import ctx, http
+
+# flow.metadata marker of refresh flows; the request hook sends them
+# straight to the origin.
+REFRESH = "mitmcache.refresh"
+_VALIDATORS = (
+    ("etag", "if-none-match"),
+    ("last-modified", "if-modified-since"),
+)
+
+
+def refresh_flow(flow: http.HTTPFlow) -> http.HTTPFlow:
+    """Return a copy of flow's request, ready to be replayed.
+
+    flow.response is the cached response; its validators replace any
+    conditional headers the client sent, which the origin would otherwise
+    compare against the client's copy instead of the cache's.
+    """
+    refresh = flow.copy()
+    cached, refresh.response = refresh.response, None
+    for validator, condition in _VALIDATORS:
+        refresh.request.headers.pop(condition, None)
+        value = None if cached is None else cached.headers.get(validator)
+        if value is not None:
+            refresh.request.headers[condition] = value
+    refresh.metadata[REFRESH] = True
+    return refresh
+
+
+def is_not_modified(flow: http.HTTPFlow) -> bool:
+    """Whether flow is a refresh the origin answered with 304."""
+    return (
+        bool(flow.metadata.get(REFRESH))
+        and flow.response is not None
+        and flow.response.status_code == 304
+    )
+
+
+def replay(flow: http.HTTPFlow) -> None:
+    ctx.master.commands.call("replay.client", [flow])
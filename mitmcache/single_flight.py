@@ -0,0 +1,86 @@
+"""Coalescing of concurrent cache misses for the same key.
+
+The first miss for a key becomes the leader of a flight and goes to the
+origin. Later misses for the key wait for the leader's response instead of
+sending their own request. The leader finishing with a response that is
+not cached, failing, or the wait timing out releases the waiters with
+nothing, and they go to the origin themselves.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+
+from mitmproxy import http
+
+logger = logging.getLogger(__name__)
+
+
+class _Flight:
+    def __init__(self, leader: str) -> None:
+        self.leader = leader
+        self.started = time.monotonic()
+        self.result: asyncio.Future[http.Response | None] = (
+            asyncio.get_running_loop().create_future()
+        )
+
+
+class SingleFlight:
+    """Tracks in-flight origin requests by cache key.
+
+    All methods must be called from the event loop thread.
+    """
+
+    def __init__(self) -> None:
+        self._flights: dict[str, _Flight] = {}
+
+    def __len__(self) -> int:
+        return len(self._flights)
+
+    def lead(self, cache_key: str, flow_id: str, timeout: float) -> bool:
+        """Start a flight for the key unless one is in progress.
+
+        Returns True if the flow became the leader and should go to the
+        origin, False if it should wait(). A flight older than timeout is
+        taken over, so a leader that never finishes cannot hold the key.
+        """
+        flight = self._flights.get(cache_key)
+        if flight is not None:
+            if time.monotonic() - flight.started < timeout:
+                return False
+            flight.result.set_result(None)
+        self._flights[cache_key] = _Flight(flow_id)
+        return True
+
+    async def wait(
+        self, cache_key: str, timeout: float
+    ) -> http.Response | None:
+        """Wait for the leader's response; None if there is none."""
+        flight = self._flights.get(cache_key)
+        if flight is None:
+            return None
+        try:
+            response = await asyncio.wait_for(
+                asyncio.shield(flight.result), timeout
+            )
+        except TimeoutError:
+            logger.warning("Timed out waiting for an in-flight request.")
+            return None
+        return None if response is None else response.copy()
+
+    def release(
+        self, cache_key: str, flow_id: str, response: http.Response | None
+    ) -> None:
+        """End the flight led by flow_id, handing waiters the response."""
+        flight = self._flights.get(cache_key)
+        if flight is None or flight.leader != flow_id:
+            return
+        del self._flights[cache_key]
+        flight.result.set_result(None if response is None else response.copy())
+
+    def release_all(self) -> None:
+        flights, self._flights = self._flights, {}
+        for flight in flights.values():
+            flight.result.set_result(None)
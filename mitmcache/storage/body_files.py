@@ -0,0 +1,83 @@
+"""Content-named files holding large response bodies.
+
+Bodies are stored under a directory sharded by the first two byte pairs of
+their content hash (``ab/cd/abcd...``), so no directory grows too large.
+Files are written to a temporary name and renamed into place, so a reader
+never sees a partially written body, and are read back through mmap.
+"""
+
+from __future__ import annotations
+
+import logging
+import mmap
+import os
+import tempfile
+from collections.abc import Iterator
+
+logger = logging.getLogger(__name__)
+
+_TMP_PREFIX = ".tmp-"
+
+
+class BodyFileStore:
+    def __init__(self, directory: str) -> None:
+        # Created on the first write, so caches that never store a file
+        # body get no directory.
+        self.directory = directory
+
+    def path_for(self, body_hash: str) -> str:
+        """Return the path of a body, relative to the store directory."""
+        return os.path.join(body_hash[:2], body_hash[2:4], body_hash)
+
+    def write(self, body_hash: str, data: bytes) -> str:
+        """Store data under its hash and return the relative path.
+
+        An existing file is kept: files are named by content, and complete
+        ones are only ever created by rename.
+        """
+        path = self.path_for(body_hash)
+        target = os.path.join(self.directory, path)
+        if os.path.exists(target):
+            return path
+        shard = os.path.dirname(target)
+        os.makedirs(shard, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=shard, prefix=_TMP_PREFIX)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, target)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        return path
+
+    def read(self, path: str) -> bytes:
+        with (
+            open(os.path.join(self.directory, path), "rb") as f,
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped,
+        ):
+            return mapped[:]
+
+    def delete(self, path: str) -> None:
+        try:
+            os.unlink(os.path.join(self.directory, path))
+        except FileNotFoundError:
+            pass
+
+    def remove_orphans(self, referenced: set[str]) -> int:
+        """Delete files not in referenced, including stale temp files.
+
+        Returns the number of files removed.
+        """
+        orphans = [p for p in self._walk() if p not in referenced]
+        for path in orphans:
+            self.delete(path)
+        removed = len(orphans)
+        if removed:
+            logger.info("Removed %d orphaned body files.", removed)
+        return removed
+
+    def _walk(self) -> Iterator[str]:
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                yield os.path.relpath(os.path.join(root, name), self.directory)
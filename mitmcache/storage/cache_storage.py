@@ -1,9 +1,23 @@
 from __future__ import annotations
 
+from collections.abc import Iterable
 from typing import Protocol
 
 from mitmproxy import http
 
+# flow.metadata key holding the Unix time (in seconds) at which an entry
+# expires. The addon sets it before a write and storages set it on the
+# flows they return; entries without it never expire.
+EXPIRES_AT = "mitmcache.expires_at"
+# flow.metadata key holding the Unix time after which an entry, while it
+# can still be served until EXPIRES_AT, should be revalidated.
+STALE_AT = "mitmcache.stale_at"
+
+
+def is_expired(flow: http.HTTPFlow, now: float) -> bool:
+    expires_at = flow.metadata.get(EXPIRES_AT)
+    return expires_at is not None and expires_at <= now
+
 
 class CacheStorage(Protocol):
     def get(self, cache_key: str) -> http.HTTPFlow | None:
@@ -21,5 +35,41 @@ class CacheStorage(Protocol):
     def upsert(self, cache_key: str, flow: http.HTTPFlow) -> None:
         """Insert or replace flow in cache atomically."""
 
+    def upsert_many(
+        self, entries: Iterable[tuple[str, http.HTTPFlow]]
+    ) -> None:
+        """Insert or replace several flows in one transaction."""
+
+    def revalidate(self, cache_key: str, flow: http.HTTPFlow) -> None:
+        """Renew an entry's expiry from flow, keeping the stored response."""
+
+    def touch_many(self, hits: Iterable[tuple[str, int]]) -> None:
+        """Count (cache_key, count) hits that were served without get()."""
+
     def close(self) -> None:
         """Close cache storage."""
+
+
+class AsyncCacheStorage(Protocol):
+    """CacheStorage counterpart whose operations can be awaited."""
+
+    async def get(self, cache_key: str) -> http.HTTPFlow | None:
+        """Get response from cache with specified cache key."""
+
+    async def store(self, cache_key: str, flow: http.HTTPFlow) -> None:
+        """Store flow in cache with specified cache key."""
+
+    async def purge(self, cache_key: str) -> None:
+        """Remove flow from cache with specified cache key."""
+
+    async def update(self, cache_key: str, flow: http.HTTPFlow) -> None:
+        """Update flow in cache with specified cache key."""
+
+    async def upsert(self, cache_key: str, flow: http.HTTPFlow) -> None:
+        """Insert or replace flow in cache atomically."""
+
+    async def revalidate(self, cache_key: str, flow: http.HTTPFlow) -> None:
+        """Renew an entry's expiry from flow, keeping the stored response."""
+
+    def close(self) -> None:
+        """Close cache storage once pending operations have finished."""
@@ -0,0 +1,72 @@
+"""Compression codecs for stored cache payloads.
+
+zlib from the standard library is always available. zstd is registered
+when the optional ``zstandard`` package can be imported; further codecs can
+be added with register_codec(). The name of the codec that compressed a
+row is stored next to it, so rows written with different codecs (or none)
+can share one cache file.
+"""
+
+from __future__ import annotations
+
+import zlib
+from collections.abc import Callable
+from typing import NamedTuple
+
+# Content-Encoding values that mean the body is already compressed; such
+# payloads would barely shrink and are stored as they are.
+COMPRESSED_ENCODINGS = frozenset({"gzip", "x-gzip", "deflate", "br", "zstd"})
+
+
+class Codec(NamedTuple):
+    name: str
+    compress: Callable[[bytes], bytes]
+    decompress: Callable[[bytes], bytes]
+
+
+CODECS: dict[str, Codec] = {}
+
+
+def register_codec(codec: Codec) -> None:
+    CODECS[codec.name] = codec
+
+
+def get_codec(name: str) -> Codec:
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError(f"unknown compression codec: {name!r}") from None
+
+
+def compress(
+    payload: bytes, codec: Codec, min_size: int
+) -> tuple[bytes, str | None]:
+    """Compress payload, returning the stored bytes and the codec name.
+
+    Payloads below min_size, or that do not shrink, are returned raw with a
+    codec of None.
+    """
+    if len(payload) < min_size:
+        return payload, None
+    compressed = codec.compress(payload)
+    if len(compressed) >= len(payload):
+        return payload, None
+    return compressed, codec.name
+
+
+def decompress(payload: bytes, codec_name: str | None) -> bytes:
+    if codec_name is None:
+        return payload
+    return get_codec(codec_name).decompress(payload)
+
+
+register_codec(Codec("zlib", zlib.compress, zlib.decompress))
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - depends on the environment
+    pass
+else:
+    # The module-level functions use a fresh context per call; shared
+    # ZstdCompressor objects are not safe across the storage threads.
+    register_codec(Codec("zstd", zstandard.compress, zstandard.decompress))
@@ -0,0 +1,167 @@
+"""Compact, response-only encoding of cached entries.
+
+The cache only ever serves `flow.response`, yet the mitmproxy flow format
+stores the whole flow (request, connection state, TLS details, ...) and
+ties every entry to the exact mitmproxy version that wrote it. This module
+encodes just the response: status, reason, HTTP version, timestamps,
+headers, trailers and the raw (still content-encoded) body.
+
+Layout of version 1, all integers big-endian::
+
+    b"MCR" version:u8
+    status_code:u16 timestamp_start:f64 timestamp_end:f64
+    http_version:bytes reason:bytes
+    header_count:u32 (name:bytes value:bytes)*
+    trailer_count:i32 (name:bytes value:bytes)*   -1 means no trailers
+    content:bytes
+
+where ``bytes`` is a u64 length followed by the data. timestamp_end is NaN
+when the response had none.
+"""
+
+from __future__ import annotations
+
+import math
+import struct
+
+from mitmproxy import connection, http
+from mitmproxy.net.http import url
+
+# Stored in the flow_format_version column of compact rows. Bump the
+# version byte and this name together when the layout changes.
+COMPACT_FORMAT = "mitmcache-compact/1"
+
+_MAGIC = b"MCR\x01"
+_HEAD = struct.Struct(">Hdd")
+_LENGTH = struct.Struct(">Q")
+_COUNT = struct.Struct(">i")
+
+
+class CompactFormatError(ValueError):
+    """Raised when a blob is not a valid compact entry."""
+
+
+def encode_response(
+    response: http.Response, include_body: bool = True
+) -> bytes:
+    """Encode a response; include_body=False stores an empty body."""
+    timestamp_end = response.timestamp_end
+    parts = [
+        _MAGIC,
+        _HEAD.pack(
+            response.status_code,
+            response.timestamp_start,
+            math.nan if timestamp_end is None else timestamp_end,
+        ),
+        _pack_bytes(response.data.http_version),
+        _pack_bytes(response.data.reason),
+        _pack_fields(response.headers.fields),
+        _pack_fields(
+            None if response.trailers is None else response.trailers.fields
+        ),
+        _pack_bytes((include_body and response.raw_content) or b""),
+    ]
+    return b"".join(parts)
+
+
+def decode_response(blob: bytes) -> http.Response:
+    if blob[: len(_MAGIC)] != _MAGIC:
+        raise CompactFormatError("not a compact cache entry")
+    reader = _Reader(blob, len(_MAGIC))
+    status_code, timestamp_start, timestamp_end = reader.unpack(_HEAD)
+    http_version = reader.read_bytes()
+    reason = reader.read_bytes()
+    headers = reader.read_fields()
+    trailers = reader.read_fields()
+    content = reader.read_bytes()
+    return http.Response(
+        http_version=http_version,
+        status_code=status_code,
+        reason=reason,
+        headers=headers or (),
+        content=content,
+        trailers=trailers,
+        timestamp_start=timestamp_start,
+        timestamp_end=None if math.isnan(timestamp_end) else timestamp_end,
+    )
+
+
+def placeholder_flow() -> http.HTTPFlow:
+    """Return an empty flow whose connections are placeholders."""
+    return http.HTTPFlow(
+        connection.Client(
+            peername=("", 0), sockname=("", 0), timestamp_start=0.0
+        ),
+        connection.Server(address=None),
+    )
+
+
+def decode_flow(blob: bytes, method: str, request_url: str) -> http.HTTPFlow:
+    """Rebuild a minimal flow around a compact response.
+
+    Only the method and URL of the request are known; connections are
+    placeholders. This is all the addon needs to serve a cache hit.
+    """
+    scheme, host, port, path = url.parse(request_url)
+    flow = placeholder_flow()
+    flow.request = http.Request(
+        host.decode("idna"),
+        port,
+        method.encode(),
+        scheme,
+        b"",
+        path,
+        b"HTTP/1.1",
+        (),
+        None,
+        None,
+        0.0,
+        0.0,
+    )
+    flow.response = decode_response(blob)
+    return flow
+
+
+def _pack_bytes(data: bytes) -> bytes:
+    return _LENGTH.pack(len(data)) + data
+
+
+def _pack_fields(fields: tuple[tuple[bytes, bytes], ...] | None) -> bytes:
+    if fields is None:
+        return _COUNT.pack(-1)
+    packed = [_COUNT.pack(len(fields))]
+    for name, value in fields:
+        packed.append(_pack_bytes(name))
+        packed.append(_pack_bytes(value))
+    return b"".join(packed)
+
+
+class _Reader:
+    def __init__(self, blob: bytes, offset: int) -> None:
+        self.blob = blob
+        self.offset = offset
+
+    def unpack(self, fmt: struct.Struct) -> tuple:
+        try:
+            values = fmt.unpack_from(self.blob, self.offset)
+        except struct.error as e:
+            raise CompactFormatError("truncated compact cache entry") from e
+        self.offset += fmt.size
+        return values
+
+    def read_bytes(self) -> bytes:
+        (length,) = self.unpack(_LENGTH)
+        end = self.offset + length
+        if end > len(self.blob):
+            raise CompactFormatError("truncated compact cache entry")
+        data = self.blob[self.offset : end]
+        self.offset = end
+        return data
+
+    def read_fields(self) -> tuple[tuple[bytes, bytes], ...] | None:
+        (count,) = self.unpack(_COUNT)
+        if count < 0:
+            return None
+        return tuple(
+            (self.read_bytes(), self.read_bytes()) for _ in range(count)
+        )
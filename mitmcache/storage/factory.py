@@ -1,25 +1,139 @@
 """Factory for Storage initialization.
 
-Currently only SQLiteStorage is supported.
+SQLiteStorage is the backing store, optionally split into several files
+by ShardedStorage; a cache that is not kept in a file can use the
+serialization-free MemoryStorage instead.
 StorageFactory initializes it from mitmproxy options, so callers do not
-need to know the constructor details.
+need to know the constructor details, and layers the optional
+write-behind queue, in-memory hot tier and threaded async adapter on top.
 """
 
 from __future__ import annotations
 
 import logging
+import os
 
-from mitmproxy import ctx
+from mitmproxy import ctx, exceptions
 from mitmproxy.addonmanager import Loader
 
-from .cache_storage import CacheStorage
+from ..metrics import Metrics
+from .cache_storage import AsyncCacheStorage, CacheStorage
+from .codecs import CODECS
+from .memory import MemoryStorage
+from .memory_tier import MemoryTierStorage
+from .policies import ADMISSION_POLICIES, EVICTION_POLICIES
+from .sharded import ShardedStorage, shard_path
 from .sqlite3 import SQLiteStorage
+from .threaded import ThreadedStorage
+from .write_behind import QUEUE_FULL_POLICIES, WriteBehindStorage
 
 logger = logging.getLogger(__name__)
 
+BACKENDS = ("auto", "sqlite", "memory")
+ENTRY_FORMATS = ("flow", "compact")
+COMPRESSION_CHOICES = ("none", "zlib", "zstd")
+
+# Access-time updates are deferred in batches of this size when
+# cache_async_storage is on and cache_touch_batch_size is 0: a hit that
+# wrote its access time on the reader thread would wait for the writer
+# thread's database lock.
+ASYNC_TOUCH_BATCH_SIZE = 100
+
+# Options whose change requires the storage to be recreated.
+STORAGE_OPTIONS = frozenset(
+    {
+        "cache_file",
+        "cache_max_entries",
+        "cache_max_bytes",
+        "cache_eviction_policy",
+        "cache_admission",
+        "cache_memory_tier_bytes",
+        "cache_touch_batch_size",
+        "cache_touch_flush_interval",
+        "cache_async_storage",
+        "cache_write_behind",
+        "cache_write_batch_size",
+        "cache_write_flush_interval",
+        "cache_write_queue_size",
+        "cache_write_queue_full",
+        "cache_entry_format",
+        "cache_compression",
+        "cache_compression_min_size",
+        "cache_dedup_bodies",
+        "cache_external_body_size",
+        "cache_body_dir",
+        "cache_sweep_interval",
+        "cache_sweep_batch_size",
+        "cache_shards",
+        "cache_wal",
+        "cache_busy_timeout",
+        "cache_lock_retries",
+        "cache_migrate",
+        "cache_backend",
+    }
+)
+
+
+def _log_migration(done: int, total: int) -> None:
+    logger.info("Migrating cache entries: %d/%d", done, total)
+
 
 class StorageFactory:
+    def __init__(self, metrics: Metrics | None = None) -> None:
+        # Passed to the backing storages, which time deserialization.
+        self.metrics = metrics
+
     def create(self) -> CacheStorage:
+        write_behind = bool(ctx.options.cache_write_behind)
+        storage = self._backing_storage()
+        if write_behind:
+            storage = WriteBehindStorage(
+                storage,
+                batch_size=int(ctx.options.cache_write_batch_size),
+                flush_interval=float(ctx.options.cache_write_flush_interval),
+                queue_size=int(ctx.options.cache_write_queue_size),
+                queue_full=ctx.options.cache_write_queue_full,
+            )
+        tier_bytes = int(ctx.options.cache_memory_tier_bytes)
+        if tier_bytes > 0:
+            storage = MemoryTierStorage(storage, max_bytes=tier_bytes)
+        return storage
+
+    def _backing_storage(self) -> CacheStorage:
+        max_entries = self._max_entries()
+        max_bytes = int(ctx.options.cache_max_bytes) or None
+        shards = max(1, int(ctx.options.cache_shards))
+        if self._backend() == "memory":
+            return MemoryStorage(max_entries, max_bytes, self.metrics)
+        if shards > 1:
+            return self._sharded(shards, max_entries, max_bytes)
+        return self._sqlite(
+            ctx.options.cache_file,
+            max_entries,
+            max_bytes,
+            ctx.options.cache_body_dir or None,
+        )
+
+    def _backend(self) -> str:
+        """Resolve cache_backend=auto: the memory backend for :memory:,
+        unless an option only SQLiteStorage supports is set."""
+        backend = str(ctx.options.cache_backend)
+        sqlite_only = (
+            ctx.options.cache_eviction_policy != "lru"
+            or ctx.options.cache_admission != "always"
+            or int(ctx.options.cache_external_body_size) > 0
+        )
+        if backend == "memory" and sqlite_only:
+            raise exceptions.OptionsError(
+                "cache_backend=memory only supports lru eviction, no "
+                "admission policy and no external bodies."
+            )
+        if backend == "auto":
+            in_memory = ctx.options.cache_file == ":memory:"
+            return "memory" if in_memory and not sqlite_only else "sqlite"
+        return backend
+
+    def _max_entries(self) -> int | None:
         try:
             raw = int(ctx.options.cache_max_entries)
         except (ValueError, TypeError):
@@ -27,8 +141,104 @@ class StorageFactory:
                 "cache_max_entries is not a valid integer; defaulting to unlimited."
             )
             raw = 0
-        max_entries = raw if raw > 0 else None
-        return SQLiteStorage(ctx.options.cache_file, max_entries=max_entries)
+        return raw if raw > 0 else None
+
+    def _sharded(
+        self, shards: int, max_entries: int | None, max_bytes: int | None
+    ) -> ShardedStorage:
+        # Each shard gets an equal part of the limits; keys are spread
+        # evenly, so the total stays close to the configured one.
+        body_dir = ctx.options.cache_body_dir
+        return ShardedStorage(
+            [
+                self._sqlite(
+                    shard_path(ctx.options.cache_file, index),
+                    max_entries and max(1, max_entries // shards),
+                    max_bytes and max(1, max_bytes // shards),
+                    os.path.join(body_dir, str(index)) if body_dir else None,
+                )
+                for index in range(shards)
+            ]
+        )
+
+    def _sqlite(
+        self,
+        path: str,
+        max_entries: int | None,
+        max_bytes: int | None,
+        body_dir: str | None,
+    ) -> SQLiteStorage:
+        # Always threaded: besides the async adapter, write-behind queue
+        # and sweeper, the cache commands run their jobs on threads of
+        # their own.
+        storage = SQLiteStorage(
+            path,
+            max_entries=max_entries,
+            max_bytes=max_bytes,
+            eviction_policy=ctx.options.cache_eviction_policy,
+            admission=ctx.options.cache_admission,
+            touch_batch_size=self._touch_batch_size(),
+            touch_flush_interval=float(ctx.options.cache_touch_flush_interval),
+            threaded=True,
+            compact=ctx.options.cache_entry_format == "compact",
+            compression=self._compression(),
+            compression_min_size=int(ctx.options.cache_compression_min_size),
+            dedup_bodies=bool(ctx.options.cache_dedup_bodies),
+            external_body_size=self._external_body_size(),
+            body_dir=body_dir,
+            sweep_interval=float(ctx.options.cache_sweep_interval),
+            sweep_batch_size=int(ctx.options.cache_sweep_batch_size),
+            wal=bool(ctx.options.cache_wal),
+            busy_timeout=float(ctx.options.cache_busy_timeout),
+            lock_retries=int(ctx.options.cache_lock_retries),
+            metrics=self.metrics,
+        )
+        if ctx.options.cache_migrate:
+            migrated, dropped = storage.migrate(progress=_log_migration)
+            if migrated or dropped:
+                logger.info(
+                    "Migrated %d cache entries of %s; dropped %d unreadable.",
+                    migrated,
+                    path,
+                    dropped,
+                )
+        return storage
+
+    def _touch_batch_size(self) -> int:
+        size = int(ctx.options.cache_touch_batch_size)
+        if size <= 0 and ctx.options.cache_async_storage:
+            return ASYNC_TOUCH_BATCH_SIZE
+        return size
+
+    def _compression(self) -> str | None:
+        name = ctx.options.cache_compression
+        if name == "none":
+            return None
+        if name not in CODECS:
+            raise exceptions.OptionsError(
+                f"cache_compression={name} is not available; "
+                "install the zstandard package to use zstd."
+            )
+        return str(name)
+
+    def _external_body_size(self) -> int:
+        size = int(ctx.options.cache_external_body_size)
+        in_memory = ctx.options.cache_file == ":memory:"
+        if size > 0 and in_memory and not ctx.options.cache_body_dir:
+            raise exceptions.OptionsError(
+                "cache_external_body_size needs cache_file or cache_body_dir."
+            )
+        return size
+
+    def create_async(self, storage: CacheStorage) -> AsyncCacheStorage | None:
+        """Wrap storage for awaiting from the hooks, if enabled."""
+        if not ctx.options.cache_async_storage:
+            return None
+        # One lane per shard lets the shards be read and written in
+        # parallel.
+        return ThreadedStorage(
+            storage, lanes=max(1, int(ctx.options.cache_shards))
+        )
 
     def load(self, loader: Loader) -> None:
         loader.add_option(
@@ -43,3 +253,237 @@ class StorageFactory:
             default=0,
             help="Maximum number of entries in the SQLite cache. 0 = unlimited.",
         )
+        loader.add_option(
+            name="cache_max_bytes",
+            typespec=int,
+            default=0,
+            help=(
+                "Maximum total size in bytes of the entries in the SQLite "
+                "cache. 0 = unlimited."
+            ),
+        )
+        loader.add_option(
+            name="cache_eviction_policy",
+            typespec=str,
+            default="lru",
+            choices=EVICTION_POLICIES,
+            help=(
+                "Which entries are evicted first when a limit is exceeded: "
+                "least recently used, least frequently used or first in."
+            ),
+        )
+        loader.add_option(
+            name="cache_admission",
+            typespec=str,
+            default="always",
+            choices=ADMISSION_POLICIES,
+            help=(
+                "Admission policy for new keys. tinylfu only admits keys "
+                "requested more often than the next eviction victim once "
+                "the cache is full."
+            ),
+        )
+        loader.add_option(
+            name="cache_memory_tier_bytes",
+            typespec=int,
+            default=0,
+            help=(
+                "Size in bytes of the in-process LRU tier kept in front of "
+                "the cache storage. 0 disables the tier."
+            ),
+        )
+        loader.add_option(
+            name="cache_touch_batch_size",
+            typespec=int,
+            default=0,
+            help=(
+                "Defer access-time updates on cache hits and write them in "
+                "one transaction once this many are pending. 0 writes on "
+                "every hit, or every 100 hits with cache_async_storage."
+            ),
+        )
+        loader.add_option(
+            name="cache_touch_flush_interval",
+            typespec=float,
+            default=5.0,
+            help=(
+                "Seconds after which deferred access-time updates are "
+                "flushed even if cache_touch_batch_size is not reached."
+            ),
+        )
+        loader.add_option(
+            name="cache_async_storage",
+            typespec=bool,
+            default=False,
+            help=(
+                "Run cache storage I/O on dedicated threads and await it "
+                "from the hooks instead of blocking the event loop."
+            ),
+        )
+        loader.add_option(
+            name="cache_write_behind",
+            typespec=bool,
+            default=False,
+            help=(
+                "Queue cache writes and commit them in batches from a "
+                "background thread."
+            ),
+        )
+        loader.add_option(
+            name="cache_write_batch_size",
+            typespec=int,
+            default=100,
+            help="Maximum number of queued writes committed together.",
+        )
+        loader.add_option(
+            name="cache_write_flush_interval",
+            typespec=float,
+            default=0.1,
+            help=(
+                "Seconds the write-behind thread waits to fill a batch "
+                "after the first queued write."
+            ),
+        )
+        loader.add_option(
+            name="cache_write_queue_size",
+            typespec=int,
+            default=1000,
+            help="Maximum number of writes waiting in the write-behind queue.",
+        )
+        loader.add_option(
+            name="cache_write_queue_full",
+            typespec=str,
+            default="block",
+            choices=QUEUE_FULL_POLICIES,
+            help=(
+                "What to do when the write-behind queue is full: block "
+                "until there is room, or drop the write."
+            ),
+        )
+        loader.add_option(
+            name="cache_entry_format",
+            typespec=str,
+            default="flow",
+            choices=ENTRY_FORMATS,
+            help=(
+                "Format of newly stored entries: the full mitmproxy flow, "
+                "or a compact response-only encoding that is smaller, "
+                "faster to decode and survives mitmproxy upgrades."
+            ),
+        )
+        loader.add_option(
+            name="cache_compression",
+            typespec=str,
+            default="none",
+            choices=COMPRESSION_CHOICES,
+            help=(
+                "Codec used to compress stored entries. zstd requires the "
+                "zstandard package."
+            ),
+        )
+        loader.add_option(
+            name="cache_compression_min_size",
+            typespec=int,
+            default=1024,
+            help="Entries smaller than this many bytes are stored uncompressed.",
+        )
+        loader.add_option(
+            name="cache_dedup_bodies",
+            typespec=bool,
+            default=False,
+            help=(
+                "Store each distinct response body once, shared by all "
+                "cache keys whose responses have identical bodies."
+            ),
+        )
+        loader.add_option(
+            name="cache_external_body_size",
+            typespec=int,
+            default=0,
+            help=(
+                "Store response bodies of at least this many bytes in "
+                "separate files instead of the database. 0 disables."
+            ),
+        )
+        loader.add_option(
+            name="cache_body_dir",
+            typespec=str,
+            default="",
+            help=(
+                "Directory for externally stored bodies. Defaults to "
+                "<cache_file>.bodies."
+            ),
+        )
+        loader.add_option(
+            name="cache_sweep_interval",
+            typespec=float,
+            default=60.0,
+            help=(
+                "Seconds between background sweeps deleting expired "
+                "entries. 0 disables the sweeper."
+            ),
+        )
+        loader.add_option(
+            name="cache_sweep_batch_size",
+            typespec=int,
+            default=1000,
+            help="Maximum number of expired entries deleted per transaction.",
+        )
+        loader.add_option(
+            name="cache_shards",
+            typespec=int,
+            default=1,
+            help=(
+                "Number of SQLite files the cache is split into by key "
+                "hash. Writes to different shards run in parallel. "
+                "Changing it empties the cache."
+            ),
+        )
+        loader.add_option(
+            name="cache_wal",
+            typespec=bool,
+            default=False,
+            help=(
+                "Put the cache file into write-ahead-log mode, so that "
+                "several proxy processes can share it without blocking "
+                "lookups in the other processes."
+            ),
+        )
+        loader.add_option(
+            name="cache_busy_timeout",
+            typespec=float,
+            default=5.0,
+            help=(
+                "Seconds a cache write waits for another process to "
+                "release the database before the attempt fails."
+            ),
+        )
+        loader.add_option(
+            name="cache_lock_retries",
+            typespec=int,
+            default=5,
+            help=(
+                "How often a cache write that found the database locked "
+                "is retried, with exponential backoff."
+            ),
+        )
+        loader.add_option(
+            name="cache_migrate",
+            typespec=bool,
+            default=True,
+            help=(
+                "On startup, convert entries stored by other mitmproxy "
+                "versions instead of discarding them on access."
+            ),
+        )
+        loader.add_option(
+            name="cache_backend",
+            typespec=str,
+            default="auto",
+            choices=BACKENDS,
+            help=(
+                "Cache storage backend. auto keeps a cache_file=:memory: "
+                "cache in the native memory backend unless an option only "
+                "SQLite supports is set, and uses SQLite otherwise."
+            ),
+        )
@@ -0,0 +1,209 @@
+"""CacheStorage keeping flows in process memory.
+
+An in-memory SQLite database still serializes every stored flow with
+mitmproxy's flow format and parses it back on every hit. MemoryStorage
+skips both: it keeps a snapshot of each flow's request, response and
+metadata in an OrderedDict, and a hit copies them into a new flow. The
+connections of the stored flow, whose TLS state makes copying a whole
+flow slow, are not kept; returned flows carry placeholders, like those
+of compact SQLite entries. The contents are lost when the process exits.
+"""
+
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Iterable, Iterator
+from typing import Any, NamedTuple
+
+from mitmproxy import http
+
+from ..metrics import Metrics
+from .cache_storage import EXPIRES_AT, STALE_AT
+from .compact import placeholder_flow
+from .memory_tier import estimate_flow_size
+
+logger = logging.getLogger(__name__)
+
+
+class _Snapshot(NamedTuple):
+    """Private copies of the parts of a flow that a hit serves."""
+
+    request: http.Request
+    response: http.Response | None
+    metadata: dict[str, Any]
+    size: int
+
+    @classmethod
+    def of(cls, flow: http.HTTPFlow) -> _Snapshot:
+        response = None if flow.response is None else flow.response.copy()
+        return cls(
+            flow.request.copy(),
+            response,
+            dict(flow.metadata),
+            estimate_flow_size(flow),
+        )
+
+    def thaw(self) -> http.HTTPFlow:
+        flow = placeholder_flow()
+        flow.request = self.request.copy()
+        if self.response is not None:
+            flow.response = self.response.copy()
+        flow.metadata = dict(self.metadata)
+        return flow
+
+    def is_expired(self, now: float) -> bool:
+        expires_at = self.metadata.get(EXPIRES_AT)
+        return expires_at is not None and expires_at <= now
+
+
+class MemoryStorage:
+    """LRU-ordered dict of flow snapshots.
+
+    Flows are copied when stored and again on every hit, so addons that
+    mutate a flow after storing it, or a response they were served, cannot
+    change the cached entry; snapshots are never modified in place.
+
+    Once max_entries or max_bytes is exceeded, the least recently used
+    entries are evicted, as with SQLiteStorage's default policy. max_bytes
+    bounds the estimated size of the cached messages (estimate_flow_size).
+    Expired entries are dropped when they are hit.
+    """
+
+    def __init__(
+        self,
+        max_entries: int | None = None,
+        max_bytes: int | None = None,
+        metrics: Metrics | None = None,
+    ) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # Receives the time spent copying hits out of their snapshots.
+        self.metrics = metrics
+        self.current_bytes = 0
+        self._entries: OrderedDict[str, _Snapshot] = OrderedDict()
+        # ThreadedStorage and WriteBehindStorage call in from other threads.
+        self._lock = threading.Lock()
+
+    def entry_count(self) -> int:
+        return len(self._entries)
+
+    def byte_count(self) -> int:
+        """Return the estimated size of all cached messages."""
+        return self.current_bytes
+
+    def get(self, cache_key: str) -> http.HTTPFlow | None:
+        with self._lock:
+            snapshot = self._entries.get(cache_key)
+            if snapshot is None:
+                return None
+            if snapshot.is_expired(time.time()):
+                self._remove(cache_key)
+                return None
+            self._entries.move_to_end(cache_key)
+        if self.metrics is None:
+            return snapshot.thaw()
+        started = time.perf_counter()
+        flow = snapshot.thaw()
+        self.metrics.observe("deserialize", time.perf_counter() - started)
+        return flow
+
+    def store(self, cache_key: str, flow: http.HTTPFlow) -> None:
+        self._put(cache_key, flow)
+
+    def update(self, cache_key: str, flow: http.HTTPFlow) -> None:
+        snapshot = _Snapshot.of(flow)
+        # Checked under the lock of the write, so a concurrent purge cannot
+        # land in between and be undone.
+        with self._lock:
+            if cache_key not in self._entries:
+                logger.warning(
+                    "update() noop: cache_key %r not found", cache_key
+                )
+                return
+            self._insert(cache_key, snapshot)
+
+    def upsert(self, cache_key: str, flow: http.HTTPFlow) -> None:
+        self._put(cache_key, flow)
+
+    def upsert_many(
+        self, entries: Iterable[tuple[str, http.HTTPFlow]]
+    ) -> None:
+        for cache_key, flow in entries:
+            self._put(cache_key, flow)
+
+    def revalidate(self, cache_key: str, flow: http.HTTPFlow) -> None:
+        """Take the flow's expiry and count it as an access."""
+        with self._lock:
+            snapshot = self._entries.get(cache_key)
+            if snapshot is None:
+                logger.warning(
+                    "revalidate() noop: cache_key %r not found", cache_key
+                )
+                return
+            metadata = dict(snapshot.metadata)
+            for key in (EXPIRES_AT, STALE_AT):
+                metadata.pop(key, None)
+                if flow.metadata.get(key) is not None:
+                    metadata[key] = flow.metadata[key]
+            self._entries[cache_key] = snapshot._replace(metadata=metadata)
+            self._entries.move_to_end(cache_key)
+
+    def touch_many(self, hits: Iterable[tuple[str, int]]) -> None:
+        """Move the entries hit elsewhere to the recent end of the LRU."""
+        with self._lock:
+            for cache_key, _ in hits:
+                if cache_key in self._entries:
+                    self._entries.move_to_end(cache_key)
+
+    def purge(self, cache_key: str) -> None:
+        with self._lock:
+            self._remove(cache_key)
+
+    def entries(
+        self, key_prefix: str = ""
+    ) -> Iterator[tuple[str, http.HTTPFlow]]:
+        """Yield the live entries whose key starts with key_prefix.
+
+        Only the matching keys are collected up front; each flow is copied
+        when it is reached. Reading does not change the LRU order.
+        """
+        with self._lock:
+            keys = [key for key in self._entries if key.startswith(key_prefix)]
+        now = time.time()
+        for cache_key in keys:
+            snapshot = self._entries.get(cache_key)
+            if snapshot is not None and not snapshot.is_expired(now):
+                yield cache_key, snapshot.thaw()
+
+    def close(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def _put(self, cache_key: str, flow: http.HTTPFlow) -> None:
+        snapshot = _Snapshot.of(flow)
+        with self._lock:
+            self._insert(cache_key, snapshot)
+
+    def _insert(self, cache_key: str, snapshot: _Snapshot) -> None:
+        """Replace the entry and evict down to the limits; needs _lock."""
+        self._remove(cache_key)
+        self._entries[cache_key] = snapshot
+        self.current_bytes += snapshot.size
+        while self._entries and self._exceeds_limits():
+            _, evicted = self._entries.popitem(last=False)
+            self.current_bytes -= evicted.size
+
+    def _exceeds_limits(self) -> bool:
+        entries, size = self.max_entries, self.max_bytes
+        return (entries is not None and len(self._entries) > entries) or (
+            size is not None and self.current_bytes > size
+        )
+
+    def _remove(self, cache_key: str) -> None:
+        snapshot = self._entries.pop(cache_key, None)
+        if snapshot is not None:
+            self.current_bytes -= snapshot.size
@@ -0,0 +1,225 @@
+"""In-process hot tier in front of another CacheStorage.
+
+MemoryTierStorage keeps recently read flows in memory so repeated hits are
+served without touching the wrapped storage (no SELECT, no access-time
+UPDATE, no FlowReader parse). The tier is bounded by an estimate of the
+bytes it holds rather than by entry count, because cached responses vary
+from a few hundred bytes to many megabytes.
+"""
+
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Iterable
+
+from mitmproxy import http
+
+from .cache_storage import CacheStorage, is_expired
+
+logger = logging.getLogger(__name__)
+
+
+def estimate_flow_size(flow: http.HTTPFlow) -> int:
+    """Approximate the memory held by a flow's messages in bytes."""
+    size = _message_size(flow.request)
+    if flow.response is not None:
+        size += _message_size(flow.response)
+    return size
+
+
+def _message_size(message: http.Message) -> int:
+    size = len(message.raw_content or b"")
+    for name, value in message.headers.fields:
+        size += len(name) + len(value)
+    return size
+
+
+class MemoryTierStorage:
+    """Byte-bounded LRU cache of flows in front of another storage.
+
+    Hits are served from memory without a lookup in the wrapped storage.
+    They are counted per key, and a background thread forwards them to its
+    touch_many() once hit_batch_size are pending or every
+    hit_flush_interval seconds, so the backend's eviction still sees hot
+    keys as recently and frequently used. Pending hits are also forwarded
+    before every insert and on close(). Every write or purge is forwarded
+    and then drops the key from the tier.
+    Flows are copied both on admission and on every hit, so addons that
+    mutate a served response cannot corrupt the cached copy.
+
+    Expired flows are dropped when they are hit and looked up in the
+    wrapped storage instead.
+
+    Invalidation happens after the backend write has finished so that a
+    concurrent read can never re-admit the value being replaced.
+    """
+
+    def __init__(
+        self,
+        storage: CacheStorage,
+        max_bytes: int,
+        hit_batch_size: int = 1000,
+        hit_flush_interval: float = 5.0,
+    ) -> None:
+        self.storage = storage
+        self.max_bytes = max_bytes
+        self.hit_batch_size = hit_batch_size
+        self.hit_flush_interval = hit_flush_interval
+        self._hits: dict[str, int] = {}
+        self._hit_count = 0
+        self.current_bytes = 0
+        self._entries: OrderedDict[str, tuple[http.HTTPFlow, int]] = (
+            OrderedDict()
+        )
+        # Reads and invalidations may come from different threads when the
+        # storage is driven from a thread pool. The generation counter lets
+        # a slow backend read detect that a write raced with it, so a stale
+        # flow is never admitted after its invalidation.
+        self._lock = threading.Lock()
+        self._generation = 0
+        # Serializes forwarding, so that hits taken by the flusher have
+        # reached the backend before an insert that may evict.
+        self._flush_lock = threading.Lock()
+        self._hits_due = threading.Event()
+        self._closing = threading.Event()
+        self._flusher = threading.Thread(
+            target=self._run_flusher, name="mitmcache-tier-hits", daemon=True
+        )
+        self._flusher.start()
+
+    def get(self, cache_key: str) -> http.HTTPFlow | None:
+        flow, generation = self._get_cached(cache_key)
+        if flow is not None:
+            return flow
+        flow = self.storage.get(cache_key)
+        if flow is not None:
+            self._admit(cache_key, flow, generation)
+        return flow
+
+    def _get_cached(self, cache_key: str) -> tuple[http.HTTPFlow | None, int]:
+        """Return a copy of the tier's flow, if it has a live one, and the
+        generation a backend read starts from."""
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is not None and is_expired(entry[0], time.time()):
+                self._remove(cache_key)
+                entry = None
+            if entry is None:
+                return None, self._generation
+            self._entries.move_to_end(cache_key)
+            self._record_hit(cache_key)
+            return entry[0].copy(), self._generation
+
+    def _record_hit(self, cache_key: str) -> None:
+        """Count a tier hit and wake the flusher once a batch is pending."""
+        self._hits[cache_key] = self._hits.get(cache_key, 0) + 1
+        self._hit_count += 1
+        if self._hit_count == self.hit_batch_size:
+            self._hits_due.set()
+
+    def _run_flusher(self) -> None:
+        while not self._closing.is_set():
+            self._hits_due.wait(self.hit_flush_interval)
+            self._hits_due.clear()
+            self.flush_hits()
+
+    def flush_hits(self) -> None:
+        """Forward the pending tier hits to the wrapped storage."""
+        with self._flush_lock:
+            with self._lock:
+                hits, self._hits = self._hits, {}
+                self._hit_count = 0
+            if not hits:
+                return
+            try:
+                self.storage.touch_many(hits.items())
+            except Exception:
+                # Only the backend's eviction order suffers; the hits were
+                # served.
+                logger.exception("Forwarding %d cache hits failed", len(hits))
+
+    def store(self, cache_key: str, flow: http.HTTPFlow) -> None:
+        self.flush_hits()
+        try:
+            self.storage.store(cache_key, flow)
+        finally:
+            self._invalidate(cache_key)
+
+    def update(self, cache_key: str, flow: http.HTTPFlow) -> None:
+        try:
+            self.storage.update(cache_key, flow)
+        finally:
+            self._invalidate(cache_key)
+
+    def upsert(self, cache_key: str, flow: http.HTTPFlow) -> None:
+        self.flush_hits()
+        try:
+            self.storage.upsert(cache_key, flow)
+        finally:
+            self._invalidate(cache_key)
+
+    def upsert_many(
+        self, entries: Iterable[tuple[str, http.HTTPFlow]]
+    ) -> None:
+        entries = list(entries)
+        self.flush_hits()
+        try:
+            self.storage.upsert_many(entries)
+        finally:
+            for cache_key, _ in entries:
+                self._invalidate(cache_key)
+
+    def revalidate(self, cache_key: str, flow: http.HTTPFlow) -> None:
+        try:
+            self.storage.revalidate(cache_key, flow)
+        finally:
+            self._invalidate(cache_key)
+
+    def purge(self, cache_key: str) -> None:
+        try:
+            self.storage.purge(cache_key)
+        finally:
+            self._invalidate(cache_key)
+
+    def touch_many(self, hits: Iterable[tuple[str, int]]) -> None:
+        self.storage.touch_many(hits)
+
+    def close(self) -> None:
+        self._closing.set()
+        self._hits_due.set()
+        self._flusher.join()
+        self.flush_hits()
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+        self.storage.close()
+
+    def _admit(
+        self, cache_key: str, flow: http.HTTPFlow, generation: int
+    ) -> None:
+        size = estimate_flow_size(flow)
+        if size > self.max_bytes:
+            return
+        snapshot = flow.copy()
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._remove(cache_key)
+            self._entries[cache_key] = (snapshot, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted
+
+    def _invalidate(self, cache_key: str) -> None:
+        with self._lock:
+            self._generation += 1
+            self._remove(cache_key)
+
+    def _remove(self, cache_key: str) -> None:
+        entry = self._entries.pop(cache_key, None)
+        if entry is not None:
+            self.current_bytes -= entry[1]
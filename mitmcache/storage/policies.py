@@ -0,0 +1,87 @@
+"""Eviction and admission policies of SQLiteStorage.
+
+An eviction policy decides which entries are removed first once a limit
+is exceeded:
+
+- lru: least recently accessed;
+- lfu: fewest hits, least recently accessed among equals, with dynamic
+  aging (LFU-DA): a new entry starts at the hit count of the last
+  eviction victim plus one, so counts earned long ago lose their weight
+  against recent ones instead of pinning entries forever;
+- fifo: oldest inserted.
+
+An admission policy decides whether a new key may enter a full cache at
+all. With tinylfu, the access frequency of every looked-up key is
+estimated by a FrequencySketch; a new key is only stored if it was
+requested more often than the entry eviction would remove next. This
+keeps one-hit wonders, such as a crawl over many distinct pages, from
+flushing the working set.
+"""
+
+from __future__ import annotations
+
+EVICTION_POLICIES = ("lru", "lfu", "fifo")
+ADMISSION_POLICIES = ("always", "tinylfu")
+
+# ORDER BY clause listing eviction victims first, per policy.
+_VICTIM_ORDER = {
+    "lru": "access_clock",
+    "lfu": "hits, access_clock",
+    "fifo": "id",
+}
+
+_MASK64 = (1 << 64) - 1
+# Odd 64-bit multipliers; each row of the sketch takes the top bits of
+# the key's hash multiplied by its own seed.
+_SEEDS = (
+    0x9E3779B97F4A7C15,
+    0xC2B2AE3D27D4EB4F,
+    0x165667B19E3779F9,
+    0xD6E8FEB86659FD93,
+)
+_MAX_COUNT = 15
+
+
+def victim_order(policy: str) -> str:
+    try:
+        return _VICTIM_ORDER[policy]
+    except KeyError:
+        raise ValueError(f"unknown eviction policy: {policy!r}") from None
+
+
+class FrequencySketch:
+    """Count-min sketch estimating how often each key was seen.
+
+    Counters saturate at 15. After ten times the width increments, all
+    counters are halved, so estimates follow recent popularity. Keys are
+    hashed with hash(), so estimates are only meaningful within one
+    process.
+    """
+
+    def __init__(self, capacity: int) -> None:
+        width = 1 << max(10, (max(capacity, 1) - 1).bit_length())
+        self._shift = 64 - (width.bit_length() - 1)
+        self._rows = [bytearray(width) for _ in _SEEDS]
+        self.sample_size = 10 * width
+        self.additions = 0
+
+    def increment(self, key: str, count: int = 1) -> None:
+        for row, index in zip(self._rows, self._indexes(key)):
+            if row[index] < _MAX_COUNT:
+                row[index] = min(_MAX_COUNT, row[index] + count)
+        self.additions += count
+        if self.additions >= self.sample_size:
+            self._age()
+
+    def estimate(self, key: str) -> int:
+        return min(
+            row[index] for row, index in zip(self._rows, self._indexes(key))
+        )
+
+    def _indexes(self, key: str) -> list[int]:
+        h = hash(key)
+        return [((h * seed) & _MASK64) >> self._shift for seed in _SEEDS]
+
+    def _age(self) -> None:
+        self._rows = [bytearray(c >> 1 for c in row) for row in self._rows]
+        self.additions //= 2
@@ -0,0 +1,104 @@
+"""CacheStorage spreading keys over several independent storages.
+
+Every SQLite database serializes its writers behind one lock. Sharding
+splits the cache into N databases, each with its own connection, lock and
+eviction budget, and routes each key to one of them by a stable hash, so
+writes of keys in different shards do not wait for each other.
+
+Keys map to shards by CRC-32, which is the same in every process and
+across restarts. Changing the number of shards remaps most keys, so the
+cache effectively starts empty.
+"""
+
+from __future__ import annotations
+
+import os
+import zlib
+from collections import defaultdict
+from collections.abc import Iterable, Sequence
+from concurrent.futures import ThreadPoolExecutor
+
+from mitmproxy import http
+
+from .cache_storage import CacheStorage
+
+_Entry = tuple[str, http.HTTPFlow]
+
+
+def shard_index(cache_key: str, shards: int) -> int:
+    return zlib.crc32(cache_key.encode()) % shards
+
+
+def shard_path(path: str, index: int) -> str:
+    """Return the file of shard index: cache.db -> cache-0.db."""
+    if path == ":memory:":
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}-{index}{ext}"
+
+
+class ShardedStorage:
+    """Route each operation to the shard owning its key.
+
+    upsert_many() writes the entries of different shards in parallel, one
+    thread per shard, so a write-behind batch is not serialized behind a
+    single database lock. The shards must accept calls from several
+    threads; see SQLiteStorage(threaded=True).
+    """
+
+    def __init__(self, shards: Sequence[CacheStorage]) -> None:
+        if not shards:
+            raise ValueError("ShardedStorage needs at least one shard")
+        self.shards = list(shards)
+        self._writers = ThreadPoolExecutor(
+            max_workers=len(self.shards), thread_name_prefix="mitmcache-shard"
+        )
+
+    def shard_for(self, cache_key: str) -> CacheStorage:
+        return self.shards[shard_index(cache_key, len(self.shards))]
+
+    def get(self, cache_key: str) -> http.HTTPFlow | None:
+        return self.shard_for(cache_key).get(cache_key)
+
+    def store(self, cache_key: str, flow: http.HTTPFlow) -> None:
+        self.shard_for(cache_key).store(cache_key, flow)
+
+    def update(self, cache_key: str, flow: http.HTTPFlow) -> None:
+        self.shard_for(cache_key).update(cache_key, flow)
+
+    def upsert(self, cache_key: str, flow: http.HTTPFlow) -> None:
+        self.shard_for(cache_key).upsert(cache_key, flow)
+
+    def upsert_many(self, entries: Iterable[_Entry]) -> None:
+        groups: defaultdict[int, list[_Entry]] = defaultdict(list)
+        for cache_key, flow in entries:
+            index = shard_index(cache_key, len(self.shards))
+            groups[index].append((cache_key, flow))
+        futures = [
+            self._writers.submit(self.shards[index].upsert_many, group)
+            for index, group in groups.items()
+        ]
+        # result() re-raises the first failure, after all shards finished.
+        for future in futures:
+            future.exception()
+        for future in futures:
+            future.result()
+
+    def revalidate(self, cache_key: str, flow: http.HTTPFlow) -> None:
+        self.shard_for(cache_key).revalidate(cache_key, flow)
+
+    def touch_many(self, hits: Iterable[tuple[str, int]]) -> None:
+        groups: defaultdict[int, list[tuple[str, int]]] = defaultdict(list)
+        for cache_key, count in hits:
+            index = shard_index(cache_key, len(self.shards))
+            groups[index].append((cache_key, count))
+        for index, group in groups.items():
+            self.shards[index].touch_many(group)
+
+    def purge(self, cache_key: str) -> None:
+        self.shard_for(cache_key).purge(cache_key)
+
+    def close(self) -> None:
+        self._writers.shutdown(wait=True)
+        for shard in self.shards:
+            shard.close()
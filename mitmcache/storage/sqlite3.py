@@ -1,17 +1,196 @@
 from __future__ import annotations
 
+import contextlib
+import hashlib
 import importlib.metadata
 import io
 import logging
+import os
 import sqlite3
+import threading
+import time
+import uuid
+from collections.abc import Callable, Iterable, Iterator
 from datetime import datetime, timezone
+from typing import TypeVar
 
 import mitmproxy.io as mio
 from mitmproxy import http
+from mitmproxy.io import tnetstring
+
+from ..metrics import Metrics
+from .body_files import BodyFileStore
+from .cache_storage import EXPIRES_AT, STALE_AT
+from .codecs import COMPRESSED_ENCODINGS, compress, decompress, get_codec
+from .compact import COMPACT_FORMAT, decode_flow, encode_response
+from .policies import ADMISSION_POLICIES, FrequencySketch, victim_order
 
 _MITMPROXY_VERSION = importlib.metadata.version("mitmproxy")
 logger = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
+
+def _serialize(flow: http.HTTPFlow, strip_body: bool = False) -> bytes:
+    # Same bytes as mio.FlowWriter, but the state can be edited first.
+    state = flow.get_state()
+    if strip_body and state["response"] is not None:
+        state["response"]["content"] = b""
+    payload: bytes = tnetstring.dumps(state)
+    return payload
+
+
+def _encode(
+    flow: http.HTTPFlow, compact: bool, strip_body: bool = False
+) -> tuple[bytes, str]:
+    """Return the stored payload of a flow and its format version.
+
+    strip_body=True leaves the response body out; it is then stored in the
+    bodies table.
+    """
+    # Flows without a response cannot be represented compactly; they keep
+    # the full mitmproxy format.
+    if compact and flow.response is not None:
+        payload = encode_response(flow.response, include_body=not strip_body)
+        return payload, COMPACT_FORMAT
+    return _serialize(flow, strip_body), _MITMPROXY_VERSION
+
+
+def _is_precompressed(flow: http.HTTPFlow) -> bool:
+    """Whether the response body already carries a compressing encoding."""
+    if flow.response is None:
+        return False
+    encoding = flow.response.headers.get("content-encoding", "")
+    return encoding.strip().lower() in COMPRESSED_ENCODINGS
+
+
+def _load_row(
+    row: sqlite3.Row, body_files: BodyFileStore | None
+) -> http.HTTPFlow | None:
+    """Decode a cache row, or return None if it cannot be read."""
+    try:
+        return _decode_row(row, body_files)
+    except Exception:
+        return None
+
+
+def _decode_row(
+    row: sqlite3.Row, body_files: BodyFileStore | None
+) -> http.HTTPFlow | None:
+    flow = _decode_payload(row)
+    if flow is not None and row["body_hash"] is not None:
+        assert flow.response is not None
+        flow.response.raw_content = _row_body(row, body_files)
+    return flow
+
+
+def _row_body(row: sqlite3.Row, body_files: BodyFileStore | None) -> bytes:
+    if row["body"] is None:
+        raise LookupError(f"missing body {row['body_hash']}")
+    data = row["body"]
+    if row["body_path"] is not None:
+        data = _read_body_file(body_files, row["body_path"])
+    return decompress(data, row["body_codec"])
+
+
+def _read_body_file(body_files: BodyFileStore | None, path: str) -> bytes:
+    if body_files is None:
+        raise LookupError(f"no body directory to read {path}")
+    return body_files.read(path)
+
+
+def _decode_payload(row: sqlite3.Row) -> http.HTTPFlow | None:
+    version = row["flow_format_version"]
+    payload = decompress(row["flow"], row["codec"])
+    if version == COMPACT_FORMAT:
+        return decode_flow(payload, row["method"], row["url"])
+    # Skip entries whose BLOB was written by a different mitmproxy
+    # version; deserialization may silently fail or raise.
+    if version != _MITMPROXY_VERSION:
+        return None
+    with io.BytesIO(payload) as buf:
+        return next(  # type: ignore[return-value]
+            iter(mio.FlowReader(buf).stream()),
+            None,
+        )
+
+
+def _upgrade_payload(row: sqlite3.Row) -> http.HTTPFlow:
+    """Decode the flow of a row written by another mitmproxy version.
+
+    mitmproxy's FlowReader migrates the flow state to the running format;
+    raises if the state cannot be migrated, e.g. because it is newer.
+    """
+    payload = decompress(row["flow"], row["codec"])
+    with io.BytesIO(payload) as buf:
+        flow = next(iter(mio.FlowReader(buf).stream()))
+    if not isinstance(flow, http.HTTPFlow):
+        raise ValueError(f"not an HTTP flow: {flow!r}")
+    return flow
+
+
+def _set_expiry_metadata(flow: http.HTTPFlow, row: sqlite3.Row) -> None:
+    """Replace the flow's expiry metadata with the row's columns."""
+    for key, column in ((EXPIRES_AT, "expires_at"), (STALE_AT, "stale_at")):
+        flow.metadata.pop(key, None)
+        if row[column] is not None:
+            flow.metadata[key] = row[column]
+
+
+def _admission_sketch(
+    admission: str, max_entries: int | None
+) -> FrequencySketch | None:
+    if admission not in ADMISSION_POLICIES:
+        raise ValueError(f"unknown admission policy: {admission!r}")
+    if admission == "tinylfu":
+        return FrequencySketch(max_entries or 0)
+    return None
+
+
+def _connect(
+    db_path: str, threaded: bool, busy_timeout: float, wal: bool
+) -> sqlite3.Connection:
+    conn = sqlite3.connect(
+        db_path, timeout=busy_timeout, check_same_thread=not threaded
+    )
+    conn.row_factory = sqlite3.Row
+    if wal and db_path != ":memory:":
+        # Persistent: the file stays in WAL mode for every process.
+        conn.execute("PRAGMA journal_mode = WAL")
+    return conn
+
+
+class _BackupProgress:
+    """sqlite3 backup callback reporting progress(copied, total) that gives
+    up once the copy has restarted more than restarts times."""
+
+    def __init__(
+        self, progress: Callable[[int, int], None] | None, restarts: int
+    ) -> None:
+        self.progress = progress
+        self.restarts = restarts
+        self.copied = 0
+
+    def __call__(self, status: int, remaining: int, total: int) -> None:
+        copied = total - remaining
+        if copied <= self.copied:
+            # Another connection wrote to the database between two steps.
+            self.restarts -= 1
+            if self.restarts < 0:
+                raise sqlite3.OperationalError("snapshot restarted too often")
+        self.copied = copied
+        if self.progress is not None:
+            self.progress(copied, total)
+
+
+def _is_locked(error: sqlite3.OperationalError) -> bool:
+    message = str(error)
+    return "database is locked" in message or "database is busy" in message
+
+
+def _unix_now() -> int:
+    return int(time.time())
+
 
 def _now() -> str:
     # mypy.ini pins python_version=3.10 where datetime.UTC is unavailable,
@@ -19,82 +198,747 @@ def _now() -> str:
     return datetime.now(tz=timezone.utc).isoformat()  # noqa: UP017
 
 
+def _open_body_files(
+    db_path: str, body_dir: str | None
+) -> BodyFileStore | None:
+    if body_dir is None and db_path != ":memory:":
+        body_dir = f"{db_path}.bodies"
+    return None if body_dir is None else BodyFileStore(body_dir)
+
+
+# Evicting down to a low watermark this fraction below max_entries turns
+# eviction into an occasional batch delete instead of a one-row delete on
+# every insert.
+_EVICTION_BATCH_FRACTION = 0.1
+
+# First delay between retries of a transaction that found the database
+# locked; it doubles with every retry.
+_RETRY_DELAY = 0.05
+
+# Restarts of a snapshot, each caused by a write during the copy, after
+# which a snapshot of a database not in WAL mode gives up.
+_SNAPSHOT_RESTARTS = 100
+
+# Indexes of the cache table besides the unique index on cache_key.
+_SECONDARY_INDEXES = ("cache_access_clock", "cache_expires_at", "cache_hits")
+
+# Columns added after the first release, applied to existing databases.
+_MIGRATED_COLUMNS = (
+    "flow_format_version TEXT",
+    "last_accessed_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP",
+    "codec TEXT",
+    "body_hash TEXT",
+    "expires_at INTEGER",
+    "stale_at INTEGER",
+    "access_clock INTEGER NOT NULL DEFAULT 0",
+    "size INTEGER NOT NULL DEFAULT 0",
+    "hits INTEGER NOT NULL DEFAULT 0",
+)
+
+
 class SQLiteStorage:
-    def __init__(self, db_path: str, max_entries: int | None = None) -> None:
+    def __init__(
+        self,
+        db_path: str,
+        max_entries: int | None = None,
+        max_bytes: int | None = None,
+        touch_batch_size: int = 0,
+        touch_flush_interval: float = 5.0,
+        threaded: bool = False,
+        compact: bool = False,
+        compression: str | None = None,
+        compression_min_size: int = 1024,
+        dedup_bodies: bool = False,
+        external_body_size: int = 0,
+        body_dir: str | None = None,
+        sweep_interval: float = 0.0,
+        sweep_batch_size: int = 1000,
+        eviction_policy: str = "lru",
+        admission: str = "always",
+        wal: bool = False,
+        busy_timeout: float = 5.0,
+        lock_retries: int = 5,
+        metrics: Metrics | None = None,
+    ) -> None:
         self.max_entries = max_entries
-        self.conn = sqlite3.connect(db_path)
-        self.conn.row_factory = sqlite3.Row
+        # See .policies: eviction_policy orders the victims of eviction,
+        # admission="tinylfu" keeps new keys that were requested less
+        # often than the next victim out of a full cache.
+        self.eviction_policy = eviction_policy
+        self._victim_order = victim_order(eviction_policy)
+        self.sketch = _admission_sketch(admission, max_entries)
+        # compact=True stores responses in the version-independent compact
+        # format; rows in either format are always readable.
+        self.compact = compact
+        # compression names a codec from .codecs applied to payloads of at
+        # least compression_min_size bytes. Rows record their codec, so
+        # changing it never makes existing rows unreadable.
+        self.codec = None if compression is None else get_codec(compression)
+        self.compression_min_size = compression_min_size
+        # dedup_bodies=True stores response bodies once per content hash in
+        # the bodies table; cache rows reference them and triggers keep a
+        # reference count, releasing a body with its last reference.
+        self.dedup_bodies = dedup_bodies
+        # Bodies of at least external_body_size bytes (0 = never) are kept
+        # in content-named files under body_dir, which defaults to a
+        # directory next to the database file. Their bodies rows only hold
+        # the file path.
+        self.external_body_size = external_body_size
+        self.body_files = _open_body_files(db_path, body_dir)
+        if external_body_size > 0 and self.body_files is None:
+            raise ValueError("external bodies need a cache file or body_dir")
+        # touch_batch_size > 0 defers access-time updates on hits: they are
+        # flushed once that many are pending, touch_flush_interval seconds
+        # after the previous flush, before any eviction, and on close().
+        self.touch_batch_size = touch_batch_size
+        self.touch_flush_interval = touch_flush_interval
+        self._pending_touches: dict[str, tuple[int, str, int]] = {}
+        self._pending_touch_hits = 0
+        self._last_touch_flush = time.monotonic()
+        self.low_watermark = (
+            None
+            if max_entries is None
+            else max_entries - int(max_entries * _EVICTION_BATCH_FRACTION)
+        )
+        # max_bytes bounds the total stored size of the entries: payload
+        # plus body, with a shared body counted once per entry using it.
+        self.max_bytes = max_bytes
+        self.bytes_low_watermark = (
+            None
+            if max_bytes is None
+            else max_bytes - int(max_bytes * _EVICTION_BATCH_FRACTION)
+        )
+        # Expired entries are skipped by get() and deleted by sweep(), which
+        # a background thread runs every sweep_interval seconds (0 = never)
+        # in batches of sweep_batch_size rows.
+        self.sweep_interval = sweep_interval
+        self.sweep_batch_size = sweep_batch_size
+        threaded = threaded or sweep_interval > 0
+        # Several processes may share the file: wal=True lets readers
+        # proceed while one process writes, and every write transaction
+        # takes the write lock up front (BEGIN IMMEDIATE), waiting up to
+        # busy_timeout seconds for it. A transaction that still finds the
+        # database locked is retried lock_retries times with exponential
+        # backoff. The sweeper runs in one process at a time; see claim().
+        self.wal = wal
+        self.busy_timeout = busy_timeout
+        self.lock_retries = lock_retries
+        self._owner = f"{os.getpid()}-{uuid.uuid4().hex}"
+        # Receives the time spent decoding entries on hits.
+        self.metrics = metrics
+        # threaded=True allows the storage to be shared by a reader thread
+        # and a writer thread: writes are serialized by _lock and, for
+        # file-backed caches, lookups use their own read connection so they
+        # do not wait behind writes.
+        self.db_path = db_path
+        self.conn = _connect(db_path, threaded, busy_timeout, wal)
+        self._lock = threading.RLock()
         try:
-            cursor = self.conn.cursor()
-            cursor.execute(
-                """
-                CREATE TABLE IF NOT EXISTS cache (
-                    id INTEGER PRIMARY KEY,
-                    cache_key TEXT UNIQUE,
-                    url TEXT,
-                    method TEXT,
-                    flow BLOB,
-                    flow_format_version TEXT,
-                    last_accessed_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
-                )
-                """
-            )
-            # Migrate existing databases that lack the
-            # flow_format_version column.
-            try:
-                cursor.execute(
-                    "ALTER TABLE cache ADD COLUMN flow_format_version TEXT"
-                )
-            except sqlite3.OperationalError:
-                pass  # column already exists
-            self.conn.commit()
-            # Migrate existing databases that predate last_accessed_at.
-            try:
-                cursor.execute(
-                    "ALTER TABLE cache ADD COLUMN "
-                    "last_accessed_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP"
-                )
-                self.conn.commit()
-            except sqlite3.OperationalError:
-                pass  # column already exists
+            self._transaction(self._create_schema)
         except Exception:
             self.conn.close()
             raise
+        self._clock = self._max_clock()
+        self._clock_synced = True
+        # Hit count new entries start from; see _age().
+        self._hits_base = self._initial_hits()
+        self._remove_orphan_files()
+        self.read_conn = self.conn
+        self._read_lock = self._lock
+        if threaded and db_path != ":memory:":
+            self.read_conn = self._connect_reader(db_path)
+            self._read_lock = threading.RLock()
+        self._sweeper_stop = threading.Event()
+        self._sweeper = self._start_sweeper()
 
-    def get(self, cache_key: str) -> http.HTTPFlow | None:
+    def _start_sweeper(self) -> threading.Thread | None:
+        if self.sweep_interval <= 0:
+            return None
+        sweeper = threading.Thread(
+            target=self._run_sweeper, name="mitmcache-sweeper", daemon=True
+        )
+        sweeper.start()
+        return sweeper
+
+    def _connect_reader(self, db_path: str) -> sqlite3.Connection:
+        conn = _connect(db_path, True, self.busy_timeout, wal=False)
+        conn.execute("PRAGMA query_only = ON")
+        return conn
+
+    def _transaction(self, operation: Callable[..., T], *args: object) -> T:
+        """Run operation(*args) in one write transaction and commit it.
+
+        Lock errors roll the transaction back and retry it after a growing
+        delay; other errors roll back and propagate.
+        """
+        delay = _RETRY_DELAY
+        retries = self.lock_retries
+        while True:
+            try:
+                return self._attempt(operation, *args)
+            except sqlite3.OperationalError as error:
+                if not _is_locked(error) or retries <= 0:
+                    raise
+            retries -= 1
+            logger.debug("Cache database locked; retrying in %.2fs", delay)
+            time.sleep(delay)
+            delay *= 2
+
+    def _attempt(self, operation: Callable[..., T], *args: object) -> T:
+        with self._lock:
+            if not self.conn.in_transaction:
+                self.conn.execute("BEGIN IMMEDIATE")
+            self._clock_synced = False
+            try:
+                result = operation(*args)
+                self._commit()
+            except BaseException:
+                self.conn.rollback()
+                raise
+            return result
+
+    def _create_schema(self) -> None:
         cursor = self.conn.cursor()
-        cursor.execute("SELECT * FROM cache WHERE cache_key=?", (cache_key,))
-        row = cursor.fetchone()
-        if row:
-            stored_version = row["flow_format_version"]
-            # Skip entries whose BLOB was written by a different mitmproxy
-            # version; deserialization may silently fail or raise.
-            if stored_version != _MITMPROXY_VERSION:
-                self._purge_with_cursor(cursor, cache_key)
-                return None
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS cache (
+                id INTEGER PRIMARY KEY,
+                cache_key TEXT UNIQUE,
+                url TEXT,
+                method TEXT,
+                flow BLOB,
+                flow_format_version TEXT,
+                last_accessed_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                codec TEXT,
+                body_hash TEXT,
+                expires_at INTEGER,
+                stale_at INTEGER,
+                access_clock INTEGER NOT NULL DEFAULT 0,
+                size INTEGER NOT NULL DEFAULT 0,
+                hits INTEGER NOT NULL DEFAULT 0
+            )
+            """
+        )
+        added = {
+            c.split()[0]: self._add_column(cursor, c)
+            for c in _MIGRATED_COLUMNS
+        }
+        if added["access_clock"]:
+            self._backfill_access_clock(cursor)
+        self._create_indexes(cursor)
+        self._create_bodies(cursor)
+        if added["size"]:
+            self._backfill_sizes(cursor)
+        self._create_stats(cursor)
+        # Leases of maintenance tasks that only one process should run;
+        # see _claim().
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS maintenance (
+                task TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                until REAL NOT NULL
+            )
+            """
+        )
+
+    def _create_indexes(self, cursor: sqlite3.Cursor) -> None:
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS cache_access_clock"
+            " ON cache (access_clock)"
+        )
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS cache_expires_at ON cache (expires_at)"
+        )
+        if self.eviction_policy == "lfu":
             cursor.execute(
-                "UPDATE cache SET last_accessed_at = ? WHERE cache_key = ?",
-                (_now(), cache_key),
+                "CREATE INDEX IF NOT EXISTS cache_hits"
+                " ON cache (hits, access_clock)"
             )
-            self.conn.commit()
-            try:
-                with io.BytesIO(row["flow"]) as buf:
-                    return next(  # type: ignore[return-value]
-                        iter(mio.FlowReader(buf).stream()),
-                        None,
-                    )
-            except Exception:
-                self._purge_with_cursor(cursor, cache_key)
-                return None
 
-        return None
+    def _drop_indexes(self) -> None:
+        for index in _SECONDARY_INDEXES:
+            self.conn.execute(f"DROP INDEX IF EXISTS {index}")
+
+    @contextlib.contextmanager
+    def deferred_indexes(self) -> Iterator[None]:
+        """Drop the secondary indexes for a bulk load, rebuild them after.
+
+        Each index is then built once from the loaded table instead of
+        being updated row by row. The unique index on cache_key stays, as
+        upserts look keys up in it.
+        """
+        self._transaction(self._drop_indexes)
+        try:
+            yield
+        finally:
+            self._transaction(self._create_indexes, self.conn.cursor())
+
+    def _add_column(
+        self, cursor: sqlite3.Cursor, definition: str, table: str = "cache"
+    ) -> bool:
+        """Add a column to an existing table; False if present."""
+        try:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {definition}")
+        except sqlite3.OperationalError:
+            return False  # column already exists
+        return True
+
+    def _backfill_access_clock(self, cursor: sqlite3.Cursor) -> None:
+        # Databases from before access_clock keep their LRU order: number
+        # the rows once by their old ISO timestamp.
+        cursor.execute(
+            "CREATE TEMP TABLE access_order"
+            " (id INTEGER PRIMARY KEY, clock INTEGER NOT NULL)"
+        )
+        cursor.execute(
+            "INSERT INTO access_order (id, clock) SELECT id,"
+            " ROW_NUMBER() OVER (ORDER BY last_accessed_at, id) FROM cache"
+        )
+        cursor.execute(
+            "UPDATE cache SET access_clock ="
+            " (SELECT clock FROM access_order WHERE access_order.id = cache.id)"
+        )
+        cursor.execute("DROP TABLE access_order")
+
+    def _backfill_sizes(self, cursor: sqlite3.Cursor) -> None:
+        # Rows from before size accounting: their payload plus their
+        # separately stored body, if any.
+        cursor.execute(
+            "UPDATE cache SET size = COALESCE(length(flow), 0) + COALESCE("
+            "(SELECT bodies.size FROM bodies"
+            " WHERE bodies.hash = cache.body_hash), 0)"
+        )
+
+    def _create_stats(self, cursor: sqlite3.Cursor) -> None:
+        # The entry count and total size are kept by triggers so eviction
+        # never has to run COUNT(*) or SUM() over the whole table.
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS cache_stats (
+                id INTEGER PRIMARY KEY CHECK (id = 0),
+                entries INTEGER NOT NULL,
+                bytes INTEGER NOT NULL DEFAULT 0
+            )
+            """
+        )
+        if self._add_column(
+            cursor, "bytes INTEGER NOT NULL DEFAULT 0", table="cache_stats"
+        ):
+            cursor.execute(
+                "UPDATE cache_stats SET bytes ="
+                " (SELECT COALESCE(SUM(size), 0) FROM cache)"
+            )
+        cursor.execute(
+            "INSERT OR IGNORE INTO cache_stats (id, entries, bytes)"
+            " SELECT 0, COUNT(*), COALESCE(SUM(size), 0) FROM cache"
+        )
+        self._create_size_triggers(cursor)
+        cursor.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS cache_stats_insert
+            AFTER INSERT ON cache BEGIN
+                UPDATE cache_stats SET entries = entries + 1 WHERE id = 0;
+            END
+            """
+        )
+        cursor.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS cache_stats_delete
+            AFTER DELETE ON cache BEGIN
+                UPDATE cache_stats SET entries = entries - 1 WHERE id = 0;
+            END
+            """
+        )
+
+    def _create_size_triggers(self, cursor: sqlite3.Cursor) -> None:
+        cursor.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS cache_bytes_insert
+            AFTER INSERT ON cache BEGIN
+                UPDATE cache_stats SET bytes = bytes + NEW.size WHERE id = 0;
+            END
+            """
+        )
+        cursor.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS cache_bytes_delete
+            AFTER DELETE ON cache BEGIN
+                UPDATE cache_stats SET bytes = bytes - OLD.size WHERE id = 0;
+            END
+            """
+        )
+        cursor.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS cache_bytes_update
+            AFTER UPDATE OF size ON cache BEGIN
+                UPDATE cache_stats SET bytes = bytes - OLD.size + NEW.size
+                 WHERE id = 0;
+            END
+            """
+        )
+
+    def _create_bodies(self, cursor: sqlite3.Cursor) -> None:
+        # Bodies start with refcount 0 and are counted by the cache row
+        # that references them. Rows left at 0 by an interrupted write are
+        # dropped on startup.
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS bodies (
+                hash TEXT PRIMARY KEY,
+                body BLOB NOT NULL,
+                codec TEXT,
+                refcount INTEGER NOT NULL DEFAULT 0,
+                path TEXT,
+                size INTEGER NOT NULL DEFAULT 0
+            )
+            """
+        )
+        self._add_column(cursor, "path TEXT", table="bodies")
+        if self._add_column(
+            cursor, "size INTEGER NOT NULL DEFAULT 0", table="bodies"
+        ):
+            cursor.execute("UPDATE bodies SET size = length(body)")
+        cursor.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS bodies_ref_insert
+            AFTER INSERT ON cache WHEN NEW.body_hash IS NOT NULL BEGIN
+                UPDATE bodies SET refcount = refcount + 1
+                 WHERE hash = NEW.body_hash;
+            END
+            """
+        )
+        cursor.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS bodies_ref_delete
+            AFTER DELETE ON cache WHEN OLD.body_hash IS NOT NULL BEGIN
+                UPDATE bodies SET refcount = refcount - 1
+                 WHERE hash = OLD.body_hash;
+            END
+            """
+        )
+        cursor.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS bodies_ref_update
+            AFTER UPDATE OF body_hash ON cache
+            WHEN OLD.body_hash IS NOT NEW.body_hash BEGIN
+                UPDATE bodies SET refcount = refcount + 1
+                 WHERE hash = NEW.body_hash;
+                UPDATE bodies SET refcount = refcount - 1
+                 WHERE hash = OLD.body_hash;
+            END
+            """
+        )
+        cursor.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS bodies_release
+            AFTER UPDATE OF refcount ON bodies WHEN NEW.refcount <= 0 BEGIN
+                DELETE FROM bodies WHERE hash = NEW.hash;
+            END
+            """
+        )
+        self._create_released_files(cursor)
+        cursor.execute("DELETE FROM bodies WHERE refcount <= 0")
+
+    def _create_released_files(self, cursor: sqlite3.Cursor) -> None:
+        # Deleting a file cannot be rolled back, so releasing an external
+        # body only records its file here; _commit() deletes the files
+        # right before the release is committed.
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS released_files (
+                hash TEXT PRIMARY KEY,
+                path TEXT NOT NULL
+            )
+            """
+        )
+        cursor.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS bodies_release_file
+            AFTER DELETE ON bodies WHEN OLD.path IS NOT NULL BEGIN
+                INSERT OR REPLACE INTO released_files (hash, path)
+                VALUES (OLD.hash, OLD.path);
+            END
+            """
+        )
+
+    def _remove_orphan_files(self) -> None:
+        """Delete body files no row refers to, e.g. after a crash."""
+        if self.body_files is not None:
+            # In a transaction, so no other process is between writing a
+            # body file and committing its row.
+            self._transaction(self._remove_orphans, self.body_files)
+
+    def _remove_orphans(self, body_files: BodyFileStore) -> None:
+        rows = self.conn.execute(
+            "SELECT path FROM bodies WHERE path IS NOT NULL"
+        )
+        body_files.remove_orphans({row["path"] for row in rows})
+        self.conn.execute("DELETE FROM released_files")
+
+    def _max_clock(self) -> int:
+        row = self.conn.execute(
+            "SELECT MAX(access_clock) FROM cache"
+        ).fetchone()
+        return int(row[0] or 0)
+
+    def _initial_hits(self) -> int:
+        if self.eviction_policy != "lfu":
+            return 0
+        row = self.conn.execute("SELECT MIN(hits) FROM cache").fetchone()
+        return int(row[0] or 0) + 1
+
+    def _next_clock(self) -> int:
+        if not self._clock_synced:
+            # Other processes sharing the file advance the clock too.
+            self._clock = max(self._clock, self._max_clock())
+            self._clock_synced = True
+        self._clock += 1
+        return self._clock
+
+    def entry_count(self) -> int:
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT entries FROM cache_stats WHERE id = 0"
+            ).fetchone()
+        return int(row[0])
+
+    def byte_count(self) -> int:
+        """Return the total stored size of all entries."""
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT bytes FROM cache_stats WHERE id = 0"
+            ).fetchone()
+        return int(row[0])
+
+    def get(self, cache_key: str) -> http.HTTPFlow | None:
+        if self.sketch is not None:
+            self.sketch.increment(cache_key)
+        with self._read_lock:
+            # One statement, so a body cannot be released between reading
+            # the row and reading the body it references.
+            row = self.read_conn.execute(
+                "SELECT cache.*, bodies.body AS body,"
+                " bodies.codec AS body_codec, bodies.path AS body_path"
+                " FROM cache"
+                " LEFT JOIN bodies ON bodies.hash = cache.body_hash"
+                " WHERE cache.cache_key=?"
+                " AND (cache.expires_at IS NULL OR cache.expires_at > ?)",
+                (cache_key, _unix_now()),
+            ).fetchone()
+        if row is None:
+            return None
+        flow = self._load(row)
+        if flow is None:
+            self._purge_unreadable(row)
+            return None
+        _set_expiry_metadata(flow, row)
+        self.touch(cache_key)
+        return flow
+
+    def _load(self, row: sqlite3.Row) -> http.HTTPFlow | None:
+        if self.metrics is None:
+            return _load_row(row, self.body_files)
+        started = time.perf_counter()
+        flow = _load_row(row, self.body_files)
+        self.metrics.observe("deserialize", time.perf_counter() - started)
+        return flow
+
+    def touch(self, cache_key: str) -> None:
+        """Mark an entry as accessed and count the hit for eviction.
+
+        With deferred touches enabled the access is only recorded in memory
+        and written later by flush_touches(), so hits stay read-only.
+        """
+        if self.touch_batch_size <= 0:
+            self._transaction(self._touch_entries, [(cache_key, 1)])
+            return
+        self._defer_touches([(cache_key, 1)])
+
+    def touch_many(self, hits: Iterable[tuple[str, int]]) -> None:
+        """Count hits served without a lookup, e.g. by a memory tier.
+
+        Each (cache_key, count) pair marks the entry as accessed and adds
+        count hits, for eviction and for admission. Without deferred
+        touches they are written in one transaction.
+        """
+        hits = list(hits)
+        if self.sketch is not None:
+            for cache_key, count in hits:
+                self.sketch.increment(cache_key, count)
+        if self.touch_batch_size <= 0:
+            self._transaction(self._touch_entries, hits)
+            return
+        self._defer_touches(hits)
+
+    def _defer_touches(self, hits: list[tuple[str, int]]) -> None:
+        with self._lock:
+            for cache_key, count in hits:
+                _, _, pending = self._pending_touches.get(
+                    cache_key, (0, "", 0)
+                )
+                self._pending_touches[cache_key] = (
+                    self._next_clock(),
+                    _now(),
+                    pending + count,
+                )
+                self._pending_touch_hits += count
+            if self._touch_flush_due():
+                self.flush_touches()
+
+    def _touch_entries(self, hits: list[tuple[str, int]]) -> None:
+        now = _now()
+        self.conn.executemany(
+            "UPDATE cache SET last_accessed_at = ?, access_clock = ?,"
+            " hits = hits + ? WHERE cache_key = ?",
+            [
+                (now, self._next_clock(), count, cache_key)
+                for cache_key, count in hits
+            ],
+        )
+
+    def _touch_flush_due(self) -> bool:
+        elapsed = time.monotonic() - self._last_touch_flush
+        return (
+            self._pending_touch_hits >= self.touch_batch_size
+            or elapsed >= self.touch_flush_interval
+        )
+
+    def flush_touches(self) -> None:
+        """Write all pending access-time updates in one transaction."""
+        with self._lock:
+            if self._pending_touches:
+                self._transaction(self._write_touches)
+
+    def _write_touches(self) -> None:
+        self._last_touch_flush = time.monotonic()
+        self._pending_touch_hits = 0
+        if not self._pending_touches:
+            return
+        self.conn.executemany(
+            "UPDATE cache SET access_clock = ?, last_accessed_at = ?,"
+            " hits = hits + ? WHERE cache_key = ?",
+            [
+                (clock, at, hits, key)
+                for key, (clock, at, hits) in self._pending_touches.items()
+            ],
+        )
+        # Cleared only once written: a rolled back transaction is retried
+        # with the touches still pending.
+        self._pending_touches = {}
 
     def store(self, cache_key: str, flow: http.HTTPFlow) -> None:
-        request = flow.request
+        self._transaction(self._store_entry, cache_key, flow)
+
+    def _store_entry(self, cache_key: str, flow: http.HTTPFlow) -> None:
+        self._admit_with_cursor(self.conn.cursor(), cache_key, flow)
+        self._evict()
+
+    def update(self, cache_key: str, flow: http.HTTPFlow) -> None:
+        if not self._transaction(self._update_entry, cache_key, flow):
+            logger.warning("update() noop: cache_key %r not found", cache_key)
+
+    def _update_entry(self, cache_key: str, flow: http.HTTPFlow) -> bool:
+        found = self._update_with_cursor(self.conn.cursor(), cache_key, flow)
+        self._evict()
+        return found
+
+    def upsert(self, cache_key: str, flow: http.HTTPFlow) -> None:
+        self.upsert_many([(cache_key, flow)])
+
+    def upsert_many(
+        self, entries: Iterable[tuple[str, http.HTTPFlow]]
+    ) -> None:
+        # A list, so that a retried transaction writes the same entries.
+        self._transaction(self._upsert_entries, list(entries))
+
+    def _upsert_entries(
+        self, entries: list[tuple[str, http.HTTPFlow]]
+    ) -> None:
+        # UPDATE-then-INSERT rather than INSERT OR REPLACE: REPLACE deletes
+        # the old row without firing the DELETE trigger that keeps
+        # cache_stats in sync.
         cursor = self.conn.cursor()
-        f = io.BytesIO()
-        w = mio.FlowWriter(f)
-        w.add(flow)
+        for cache_key, flow in entries:
+            if not self._update_with_cursor(cursor, cache_key, flow):
+                self._admit_with_cursor(cursor, cache_key, flow)
+        self._evict()
+
+    def _exists(self, cursor: sqlite3.Cursor, cache_key: str) -> bool:
+        row = cursor.execute(
+            "SELECT id FROM cache WHERE cache_key = ?", (cache_key,)
+        ).fetchone()
+        return row is not None
+
+    def revalidate(self, cache_key: str, flow: http.HTTPFlow) -> None:
+        """Take the flow's expiry and count it as an access.
+
+        Neither the stored flow nor its body is rewritten, so renewing a
+        large entry costs a single small UPDATE.
+        """
+        if not self._transaction(self._renew_entry, cache_key, flow):
+            logger.warning(
+                "revalidate() noop: cache_key %r not found", cache_key
+            )
+
+    def _renew_entry(self, cache_key: str, flow: http.HTTPFlow) -> bool:
+        self._pending_touches.pop(cache_key, None)
+        cursor = self.conn.execute(
+            "UPDATE cache SET expires_at = ?, stale_at = ?,"
+            " last_accessed_at = ?, access_clock = ?"
+            " WHERE cache_key = ?",
+            (
+                flow.metadata.get(EXPIRES_AT),
+                flow.metadata.get(STALE_AT),
+                _now(),
+                self._next_clock(),
+                cache_key,
+            ),
+        )
+        return cursor.rowcount > 0
+
+    def _admit_with_cursor(
+        self, cursor: sqlite3.Cursor, cache_key: str, flow: http.HTTPFlow
+    ) -> None:
+        """Insert a new key unless the admission policy rejects it.
+
+        Admission is decided before the flow is packed: packing stores
+        the body, which nothing would reference after a rejection.
+        """
+        if self.sketch is not None and not self._admits(
+            self.sketch, cache_key
+        ):
+            logger.debug("Admission rejected cache_key %r", cache_key)
+            return
+        self._insert_with_cursor(cursor, cache_key, flow)
+
+    def _admits(self, sketch: FrequencySketch, cache_key: str) -> bool:
+        """TinyLFU: a full cache only takes keys more frequent than the
+        entry eviction would remove next."""
+        if not self._is_full():
+            return True
+        victim = self.conn.execute(
+            f"SELECT cache_key FROM cache ORDER BY {self._victim_order}"
+            " LIMIT 1"
+        ).fetchone()
+        return victim is None or sketch.estimate(cache_key) > sketch.estimate(
+            victim["cache_key"]
+        )
+
+    def _is_full(self) -> bool:
+        # Full from the low watermark on: every insert above it costs an
+        # entry that batch eviction will remove.
+        entries = self.low_watermark
+        size = self.bytes_low_watermark
+        return (entries is not None and self.entry_count() >= entries) or (
+            size is not None and self.byte_count() >= size
+        )
+
+    def _insert_with_cursor(
+        self, cursor: sqlite3.Cursor, cache_key: str, flow: http.HTTPFlow
+    ) -> None:
+        request = flow.request
+        payload, version, codec, body_hash, size = self._pack(cursor, flow)
         sql = """\
         INSERT INTO cache
                   ( cache_key
@@ -102,107 +946,516 @@ class SQLiteStorage:
                   , method
                   , flow
                   , flow_format_version
+                  , codec
+                  , body_hash
+                  , expires_at
+                  , stale_at
                   , last_accessed_at
+                  , access_clock
+                  , size
+                  , hits
                   )
-             VALUES (?, ?, ?, ?, ?, ?)"""
+             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"""
         cursor.execute(
             sql,
             (
                 cache_key,
                 request.url,
                 request.method,
-                f.getvalue(),
-                _MITMPROXY_VERSION,
+                payload,
+                version,
+                codec,
+                body_hash,
+                flow.metadata.get(EXPIRES_AT),
+                flow.metadata.get(STALE_AT),
                 _now(),
+                self._next_clock(),
+                size,
+                self._hits_base,
             ),
         )
-        if self.max_entries is not None:
-            self._evict()
-        self.conn.commit()
 
-    def update(self, cache_key: str, flow: http.HTTPFlow) -> None:
+    def _update_with_cursor(
+        self, cursor: sqlite3.Cursor, cache_key: str, flow: http.HTTPFlow
+    ) -> bool:
+        """Rewrite the row of cache_key; False if there is none.
+
+        The key is looked up first, so a flow is only packed, and its body
+        only stored, when there is a row to write it to.
+        """
+        if not self._exists(cursor, cache_key):
+            return False
         request = flow.request
-        cursor = self.conn.cursor()
-        f = io.BytesIO()
-        w = mio.FlowWriter(f)
-        w.add(flow)
+        payload, version, codec, body_hash, size = self._pack(cursor, flow)
         sql = """\
         UPDATE cache
            SET url = ?
              , method = ?
              , flow = ?
              , flow_format_version = ?
+             , codec = ?
+             , body_hash = ?
+             , expires_at = ?
+             , stale_at = ?
              , last_accessed_at = ?
+             , access_clock = ?
+             , size = ?
          WHERE cache_key = ?"""
         cursor.execute(
             sql,
             (
                 request.url,
                 request.method,
-                f.getvalue(),
-                _MITMPROXY_VERSION,
+                payload,
+                version,
+                codec,
+                body_hash,
+                flow.metadata.get(EXPIRES_AT),
+                flow.metadata.get(STALE_AT),
                 _now(),
+                self._next_clock(),
+                size,
                 cache_key,
             ),
         )
-        if cursor.rowcount == 0:
-            logger.warning("update() noop: cache_key %r not found", cache_key)
-        if self.max_entries is not None:
-            self._evict()
-        self.conn.commit()
+        return cursor.rowcount > 0
 
-    def upsert(self, cache_key: str, flow: http.HTTPFlow) -> None:
-        request = flow.request
-        cursor = self.conn.cursor()
-        f = io.BytesIO()
-        w = mio.FlowWriter(f)
-        w.add(flow)
-        sql = """\
-        INSERT OR REPLACE INTO cache
-                  ( cache_key
-                  , url
-                  , method
-                  , flow
-                  , flow_format_version
-                  , last_accessed_at
-                  )
-             VALUES (?, ?, ?, ?, ?, ?)"""
+    def _pack(
+        self, cursor: sqlite3.Cursor, flow: http.HTTPFlow
+    ) -> tuple[bytes, str, str | None, str | None, int]:
+        """Encode a flow for its cache row.
+
+        Returns the payload, format version, codec, the hash of the
+        separately stored body, if any, and the entry's stored size.
+        """
+        body_hash, body_size = self._store_body(cursor, flow)
+        stripped = body_hash is not None
+        payload, version = _encode(flow, self.compact, strip_body=stripped)
+        precompressed = not stripped and _is_precompressed(flow)
+        payload, codec = self._compress(payload, precompressed)
+        return payload, version, codec, body_hash, len(payload) + body_size
+
+    def _compress(
+        self, payload: bytes, precompressed: bool
+    ) -> tuple[bytes, str | None]:
+        if self.codec is None or precompressed:
+            return payload, None
+        return compress(payload, self.codec, self.compression_min_size)
+
+    def _store_body(
+        self, cursor: sqlite3.Cursor, flow: http.HTTPFlow
+    ) -> tuple[str | None, int]:
+        """Make sure the response body is in the bodies table.
+
+        Returns its hash and stored size, or (None, 0) when bodies are
+        stored inline. A body that is already present is neither
+        compressed nor written again.
+        """
+        if flow.response is None:
+            return None, 0
+        body = flow.response.raw_content or b""
+        if not body or not (self.dedup_bodies or self._is_external(body)):
+            return None, 0
+        body_hash = hashlib.sha256(body).hexdigest()
+        present = cursor.execute(
+            "SELECT size FROM bodies WHERE hash = ?", (body_hash,)
+        ).fetchone()
+        if present is not None:
+            return body_hash, int(present["size"])
+        precompressed = _is_precompressed(flow)
+        return body_hash, self._insert_body(
+            cursor, body_hash, body, precompressed
+        )
+
+    def _is_external(self, body: bytes) -> bool:
+        return (
+            self.body_files is not None
+            and 0 < self.external_body_size <= len(body)
+        )
+
+    def _insert_body(
+        self,
+        cursor: sqlite3.Cursor,
+        body_hash: str,
+        body: bytes,
+        precompressed: bool,
+    ) -> int:
+        """Insert a body and return its stored size."""
+        stored, codec = self._compress(body, precompressed)
+        size = len(stored)
+        path = None
+        if self.body_files is not None and self._is_external(body):
+            path = self.body_files.write(body_hash, stored)
+            stored = b""
         cursor.execute(
-            sql,
-            (
-                cache_key,
-                request.url,
-                request.method,
-                f.getvalue(),
-                _MITMPROXY_VERSION,
-                _now(),
-            ),
+            "INSERT INTO bodies (hash, body, codec, path, size)"
+            " VALUES (?, ?, ?, ?, ?)",
+            (body_hash, stored, codec, path, size),
         )
-        if self.max_entries is not None:
-            self._evict()
-        self.conn.commit()
+        return size
 
     def _evict(self) -> None:
-        if self.max_entries is None:
+        # Pending touches join the write transaction so eviction sees the
+        # current access order.
+        self._write_touches()
+        self._evict_batch()
+
+    def _evict_batch(self) -> None:
+        self._evict_entries()
+        self._evict_bytes()
+
+    def _evict_entries(self) -> None:
+        """Delete the eviction policy's victims in one batch.
+
+        Nothing happens until the entry count exceeds max_entries (the high
+        watermark); then victims are removed down to the low watermark, so
+        most writes skip eviction entirely. The delete walks the index of
+        the policy's order instead of sorting the table.
+        """
+        if self.max_entries is None or self.low_watermark is None:
             return
-        cursor = self.conn.cursor()
-        # Keep the max_entries most-recently-accessed entries; evict the rest.
-        # Secondary sort by id DESC breaks ties deterministically (newer insert wins).
-        cursor.execute(
-            "DELETE FROM cache WHERE id NOT IN "
-            "(SELECT id FROM cache ORDER BY last_accessed_at DESC, id DESC LIMIT ?)",
-            (self.max_entries,),
+        excess = self.entry_count() - self.max_entries
+        if excess <= 0:
+            return
+        victims = excess + self.max_entries - self.low_watermark
+        self._age(victims)
+        self.conn.execute(
+            "DELETE FROM cache WHERE id IN (SELECT id FROM cache"
+            f" ORDER BY {self._victim_order} LIMIT ?)",
+            (victims,),
         )
 
-    def purge(self, cache_key: str) -> None:
-        cursor = self.conn.cursor()
-        self._purge_with_cursor(cursor, cache_key)
+    def _evict_bytes(self) -> None:
+        """Delete victims until the total size is back under the low
+        watermark of max_bytes.
+
+        Like _evict_entries() this only runs once the limit is exceeded.
+        The total comes from cache_stats; only the evicted rows are read.
+        """
+        if self.max_bytes is None or self.bytes_low_watermark is None:
+            return
+        excess = self.byte_count() - self.max_bytes
+        if excess <= 0:
+            return
+        target = excess + self.max_bytes - self.bytes_low_watermark
+        victims = self._victims(target)
+        self._age(len(victims))
+        self._delete_ids(victims)
+
+    def _age(self, victims: int) -> None:
+        """Under LFU, let entries inserted from now on start one above the
+        count of the last of the next victims (LFU-DA), so counts earned
+        long ago weigh less and less."""
+        if self.eviction_policy != "lfu" or victims <= 0:
+            return
+        row = self.conn.execute(
+            f"SELECT hits FROM cache ORDER BY {self._victim_order}"
+            " LIMIT 1 OFFSET ?",
+            (victims - 1,),
+        ).fetchone()
+        if row is not None:
+            self._hits_base = int(row[0]) + 1
+
+    def _victims(self, size: int) -> list[int]:
+        """Return the ids of the first victims that together take at least
+        size bytes."""
+        ids = []
+        rows = self.conn.execute(
+            f"SELECT id, size FROM cache ORDER BY {self._victim_order}"
+        )
+        for row in rows:
+            ids.append(row["id"])
+            size -= row["size"]
+            if size <= 0:
+                break
+        rows.close()
+        return ids
+
+    def sweep(self, limit: int | None = None) -> int:
+        """Delete up to limit expired entries; return how many were.
+
+        The expires_at index yields the oldest expired rows first, so a
+        batch never scans live entries.
+        """
+        return self._transaction(
+            self._delete_expired, limit or self.sweep_batch_size
+        )
+
+    def _delete_expired(self, limit: int) -> int:
+        cursor = self.conn.execute(
+            "DELETE FROM cache WHERE id IN (SELECT id FROM cache"
+            " WHERE expires_at <= ? ORDER BY expires_at LIMIT ?)",
+            (_unix_now(), limit),
+        )
+        return cursor.rowcount
+
+    def migrate(
+        self,
+        batch_size: int = 1000,
+        progress: Callable[[int, int], None] | None = None,
+    ) -> tuple[int, int]:
+        """Re-encode entries written by other mitmproxy versions.
+
+        get() ignores such rows and deletes them one by one as they are
+        hit. This converts them all up front instead: rows are read and
+        rewritten batch_size at a time, one transaction per batch, and
+        progress(done, total) is called after each batch. Rows that cannot
+        be converted are deleted together at the end. Returns the number
+        of migrated and deleted rows.
+        """
+        total = self._outdated_count()
+        last_id = done = 0
+        unreadable: list[int] = []
+        while batch := self._transaction(
+            self._migrate_batch, last_id, batch_size
+        ):
+            ids, failed = batch
+            last_id, done = ids[-1], done + len(ids)
+            unreadable += failed
+            if progress is not None:
+                progress(done, total)
+        self._transaction(self._delete_ids, unreadable)
+        return done - len(unreadable), len(unreadable)
+
+    def _outdated_count(self) -> int:
+        row = self.conn.execute(
+            "SELECT COUNT(*) FROM cache WHERE flow_format_version IS NULL"
+            " OR flow_format_version NOT IN (?, ?)",
+            (_MITMPROXY_VERSION, COMPACT_FORMAT),
+        ).fetchone()
+        return int(row[0])
 
-    def _purge_with_cursor(
-        self, cursor: sqlite3.Cursor, cache_key: str
+    def _migrate_batch(
+        self, after_id: int, limit: int
+    ) -> tuple[list[int], list[int]] | None:
+        """Rewrite the next outdated rows; return their ids and the ids of
+        those that could not be converted, or None when none are left."""
+        rows = self.conn.execute(
+            "SELECT id, flow, codec, body_hash FROM cache"
+            " WHERE id > ? AND (flow_format_version IS NULL"
+            " OR flow_format_version NOT IN (?, ?))"
+            " ORDER BY id LIMIT ?",
+            (after_id, _MITMPROXY_VERSION, COMPACT_FORMAT, limit),
+        ).fetchall()
+        if not rows:
+            return None
+        converted = [self._reencode(row) for row in rows]
+        # length(flow) is the old payload; the size keeps its body part.
+        self.conn.executemany(
+            "UPDATE cache SET flow = ?, flow_format_version = ?, codec = ?,"
+            " size = size - COALESCE(length(flow), 0) + ? WHERE id = ?",
+            [values for values in converted if values is not None],
+        )
+        failed = [row["id"] for row, c in zip(rows, converted) if c is None]
+        return [row["id"] for row in rows], failed
+
+    def _reencode(
+        self, row: sqlite3.Row
+    ) -> tuple[bytes, str, str | None, int, int] | None:
+        try:
+            flow = _upgrade_payload(row)
+        except Exception:
+            return None
+        stripped = row["body_hash"] is not None
+        payload, version = _encode(flow, self.compact, strip_body=stripped)
+        precompressed = not stripped and _is_precompressed(flow)
+        payload, codec = self._compress(payload, precompressed)
+        return payload, version, codec, len(payload), row["id"]
+
+    def _delete_ids(self, ids: list[int]) -> None:
+        self.conn.executemany(
+            "DELETE FROM cache WHERE id = ?", [(row_id,) for row_id in ids]
+        )
+
+    def entries(
+        self, key_prefix: str = "", batch_size: int = 1000
+    ) -> Iterator[tuple[str, http.HTTPFlow]]:
+        """Yield the live entries whose key starts with key_prefix.
+
+        Entries come in key order, read batch_size rows at a time with
+        the read lock released in between, so a long iteration neither
+        holds the rows of the whole cache in memory nor blocks writers.
+        Writes made during the iteration may or may not be seen.
+        Unreadable entries are skipped; reading does not count as a hit.
+        """
+        after = None
+        while rows := self._entry_rows(key_prefix, after, batch_size):
+            after = rows[-1]["cache_key"]
+            yield from self._load_entries(rows)
+
+    def _entry_rows(
+        self, key_prefix: str, after: str | None, limit: int
+    ) -> list[sqlite3.Row]:
+        # The lower bound lets the scan start in the cache_key index.
+        with self._read_lock:
+            return self.read_conn.execute(
+                "SELECT cache.*, bodies.body AS body,"
+                " bodies.codec AS body_codec, bodies.path AS body_path"
+                " FROM cache"
+                " LEFT JOIN bodies ON bodies.hash = cache.body_hash"
+                " WHERE cache.cache_key >= :prefix"
+                " AND substr(cache.cache_key, 1, :length) = :prefix"
+                " AND (:after IS NULL OR cache.cache_key > :after)"
+                " AND (cache.expires_at IS NULL OR cache.expires_at > :now)"
+                " ORDER BY cache.cache_key LIMIT :limit",
+                {
+                    "prefix": key_prefix,
+                    "length": len(key_prefix),
+                    "after": after,
+                    "now": _unix_now(),
+                    "limit": limit,
+                },
+            ).fetchall()
+
+    def _load_entries(
+        self, rows: list[sqlite3.Row]
+    ) -> Iterator[tuple[str, http.HTTPFlow]]:
+        for row in rows:
+            flow = _load_row(row, self.body_files)
+            if flow is not None:
+                _set_expiry_metadata(flow, row)
+                yield row["cache_key"], flow
+
+    def snapshot(
+        self,
+        path: str,
+        pages: int = 1024,
+        progress: Callable[[int, int], None] | None = None,
+        restarts: int = _SNAPSHOT_RESTARTS,
     ) -> None:
-        cursor.execute("DELETE FROM cache WHERE cache_key=?", (cache_key,))
+        """Copy the database to path while the cache stays in use.
+
+        The copy is made with SQLite's backup API from a connection of its
+        own, pages pages at a time, calling progress(copied, total) after
+        each step. The database is only locked during a step, so writers
+        wait for one step at most. In WAL mode the copy holds a read
+        transaction and is an image of the database at the start; without
+        WAL a write by another connection restarts the copy, and after
+        restarts restarts sqlite3.OperationalError is raised. The copy is
+        written next to path and renamed into place once it is complete.
+        Bodies kept in external files are not copied.
+        """
+        partial = f"{path}.partial"
+        try:
+            with (
+                contextlib.closing(sqlite3.connect(partial)) as target,
+                self._snapshot_source() as source,
+            ):
+                source.backup(
+                    target,
+                    pages=pages,
+                    progress=_BackupProgress(progress, restarts),
+                )
+        except BaseException:
+            os.remove(partial)
+            raise
+        os.replace(partial, path)
+
+    @contextlib.contextmanager
+    def _snapshot_source(self) -> Iterator[sqlite3.Connection]:
+        if self.db_path == ":memory:":
+            # Only this connection sees the database.
+            with self._lock:
+                yield self.conn
+            return
+        source = _connect(self.db_path, False, self.busy_timeout, wal=False)
+        try:
+            if source.execute("PRAGMA journal_mode").fetchone()[0] == "wal":
+                # Writers go on in the WAL while the read transaction pins
+                # the image being copied.
+                source.execute("BEGIN")
+                source.execute("SELECT entries FROM cache_stats").fetchone()
+            yield source
+        finally:
+            source.close()
+
+    def claim(self, task: str, duration: float) -> bool:
+        """Take or renew the lease on a maintenance task for duration
+        seconds; False while another storage holds it.
+
+        Processes sharing the database use leases so that periodic
+        maintenance runs in one of them only. A lease that is not renewed,
+        e.g. because its process exited, expires and can be taken over.
+        """
+        return self._transaction(self._claim, task, duration)
+
+    def _claim(self, task: str, duration: float) -> bool:
+        now = time.time()
+        cursor = self.conn.execute(
+            "INSERT INTO maintenance (task, owner, until) VALUES (?, ?, ?)"
+            " ON CONFLICT (task) DO UPDATE"
+            " SET owner = excluded.owner, until = excluded.until"
+            " WHERE maintenance.owner = excluded.owner"
+            " OR maintenance.until <= ?",
+            (task, self._owner, now + duration, now),
+        )
+        return cursor.rowcount > 0
+
+    def _run_sweeper(self) -> None:
+        # The lease outlasts one interval, so its holder keeps renewing it
+        # and the other processes skip sweeping.
+        while not self._sweeper_stop.wait(self.sweep_interval):
+            try:
+                if self.claim("sweep", 2 * self.sweep_interval):
+                    self._sweep_all()
+            except Exception:
+                logger.exception("Sweeping expired cache entries failed")
+
+    def _sweep_all(self) -> None:
+        # Batches are separate transactions so writers get the lock in
+        # between.
+        while not self._sweeper_stop.is_set():
+            if self.sweep() < self.sweep_batch_size:
+                return
+
+    def purge(self, cache_key: str) -> None:
+        self._transaction(self._delete_entry, cache_key)
+
+    def _delete_entry(self, cache_key: str) -> None:
+        self._pending_touches.pop(cache_key, None)
+        self.conn.execute("DELETE FROM cache WHERE cache_key=?", (cache_key,))
+
+    def _purge_unreadable(self, row: sqlite3.Row) -> None:
+        self._transaction(self._delete_unreadable, row)
+
+    def _delete_unreadable(self, row: sqlite3.Row) -> None:
+        # Only delete the row as it was read: if a writer replaced it in
+        # the meantime (and released the body file being read), the new
+        # entry is kept.
+        cursor = self.conn.execute(
+            "DELETE FROM cache WHERE id = ? AND access_clock = ?",
+            (row["id"], row["access_clock"]),
+        )
+        if cursor.rowcount:
+            self._pending_touches.pop(row["cache_key"], None)
+
+    def _commit(self) -> None:
+        # Released files are deleted while the write lock is still held.
+        # After the commit another process could store the same body, find
+        # its file still there and keep it, only to lose it to the delete.
+        # A commit failing after the delete leaves rows whose body file is
+        # gone, which read as missing bodies.
+        if self.body_files is not None:
+            for path in self._take_released_files():
+                self.body_files.delete(path)
         self.conn.commit()
 
+    def _take_released_files(self) -> list[str]:
+        # A released body can be stored again before the commit; its file
+        # is then still referenced and stays.
+        rows = self.conn.execute(
+            "SELECT path FROM released_files WHERE NOT EXISTS"
+            " (SELECT 1 FROM bodies WHERE bodies.hash = released_files.hash)"
+        ).fetchall()
+        self.conn.execute("DELETE FROM released_files")
+        return [row["path"] for row in rows]
+
     def close(self) -> None:
-        self.conn.close()
+        if self._sweeper is not None:
+            self._sweeper_stop.set()
+            self._sweeper.join()
+        self.flush_touches()
+        with self._lock:
+            if self.read_conn is not self.conn:
+                self.read_conn.close()
+            self.conn.close()
@@ -0,0 +1,100 @@
+"""Async adapter that runs a CacheStorage on dedicated threads.
+
+The addon hooks run on mitmproxy's event loop. Calling sqlite3 there means
+a slow commit or a large BLOB decode stalls every connection the proxy is
+serving. ThreadedStorage moves each operation to a storage thread and
+returns an awaitable, so the event loop keeps serving other flows while the
+cache is busy.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import functools
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from typing import TypeVar
+
+from mitmproxy import http
+
+from .cache_storage import CacheStorage
+from .sharded import shard_index
+
+T = TypeVar("T")
+
+
+class ThreadedStorage:
+    """Run lookups on a reader thread and writes on a writer thread.
+
+    Writes share one thread so they reach the storage in submission order.
+    The wrapped storage must tolerate being called from two threads; see
+    SQLiteStorage(threaded=True).
+
+    With lanes > 1 there is a reader and a writer thread per lane, and
+    keys are assigned to lanes like ShardedStorage assigns them to shards.
+    Wrapping a ShardedStorage with as many lanes as shards lets each shard
+    be read and written in parallel while writes of one key stay ordered.
+    """
+
+    def __init__(self, storage: CacheStorage, lanes: int = 1) -> None:
+        self.storage = storage
+        self._readers = [
+            ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="mitmcache-read"
+            )
+            for _ in range(max(1, lanes))
+        ]
+        self._writers = [
+            ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="mitmcache-write"
+            )
+            for _ in range(max(1, lanes))
+        ]
+
+    async def get(self, cache_key: str) -> http.HTTPFlow | None:
+        reader = self._lane(self._readers, cache_key)
+        return await self._run(reader, self.storage.get, cache_key)
+
+    async def store(self, cache_key: str, flow: http.HTTPFlow) -> None:
+        await self._write(self.storage.store, cache_key, flow)
+
+    async def update(self, cache_key: str, flow: http.HTTPFlow) -> None:
+        await self._write(self.storage.update, cache_key, flow)
+
+    async def upsert(self, cache_key: str, flow: http.HTTPFlow) -> None:
+        await self._write(self.storage.upsert, cache_key, flow)
+
+    async def revalidate(self, cache_key: str, flow: http.HTTPFlow) -> None:
+        await self._write(self.storage.revalidate, cache_key, flow)
+
+    async def purge(self, cache_key: str) -> None:
+        await self._write(self.storage.purge, cache_key)
+
+    def close(self) -> None:
+        """Wait for queued operations, then close the wrapped storage."""
+        for executor in self._readers + self._writers[1:]:
+            executor.shutdown(wait=True)
+        self._writers[0].submit(self.storage.close).result()
+        self._writers[0].shutdown(wait=True)
+
+    def _lane(
+        self, executors: list[ThreadPoolExecutor], cache_key: str
+    ) -> ThreadPoolExecutor:
+        return executors[shard_index(cache_key, len(executors))]
+
+    async def _write(
+        self, func: Callable[..., None], cache_key: str, *args: object
+    ) -> None:
+        writer = self._lane(self._writers, cache_key)
+        await self._run(writer, func, cache_key, *args)
+
+    async def _run(
+        self,
+        executor: ThreadPoolExecutor,
+        func: Callable[..., T],
+        *args: object,
+    ) -> T:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            executor, functools.partial(func, *args)
+        )
@@ -0,0 +1,182 @@
+"""Write-behind queue with group commit in front of another CacheStorage.
+
+Every upsert normally serializes the flow, writes it and commits on its
+own, so bursts of stores are dominated by per-row commits. In write-behind
+mode upserts only snapshot the flow and put it on a bounded queue; a
+background thread drains the queue and writes batches of entries in a
+single transaction via upsert_many().
+"""
+
+from __future__ import annotations
+
+import logging
+import queue
+import threading
+import time
+from collections.abc import Iterable
+
+from mitmproxy import http
+
+from .cache_storage import CacheStorage
+
+logger = logging.getLogger(__name__)
+
+QUEUE_FULL_POLICIES = ("block", "drop")
+
+_Entry = tuple[str, http.HTTPFlow]
+
+
+class WriteBehindStorage:
+    """Queue upserts and commit them in batches from a writer thread.
+
+    Queued entries stay visible to get() until they are written, so a key
+    can be read back as soon as upsert() returns. store(), update(),
+    revalidate() and purge() are rare and order-sensitive; they wait for
+    the queue to drain and then go straight to the wrapped storage, which
+    must accept calls from two threads (see SQLiteStorage(threaded=True)).
+
+    When the queue is full, upsert() either blocks until the writer catches
+    up ("block") or drops the entry and logs a warning ("drop"). close()
+    always writes everything that was queued before it; later upserts go
+    straight to the wrapped storage.
+    """
+
+    def __init__(
+        self,
+        storage: CacheStorage,
+        batch_size: int = 100,
+        flush_interval: float = 0.1,
+        queue_size: int = 1000,
+        queue_full: str = "block",
+    ) -> None:
+        if queue_full not in QUEUE_FULL_POLICIES:
+            raise ValueError(f"unknown queue_full policy: {queue_full!r}")
+        self.storage = storage
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.queue_full = queue_full
+        self._queue: queue.Queue[_Entry | None] = queue.Queue(
+            maxsize=max(1, queue_size)
+        )
+        self._pending: dict[str, http.HTTPFlow] = {}
+        self._lock = threading.Lock()
+        # Set once the writer has stopped; nothing is queued after that.
+        self._closed = False
+        self._thread = threading.Thread(
+            target=self._run, name="mitmcache-write-behind", daemon=True
+        )
+        self._thread.start()
+
+    def get(self, cache_key: str) -> http.HTTPFlow | None:
+        with self._lock:
+            pending = self._pending.get(cache_key)
+        if pending is not None:
+            return pending.copy()
+        return self.storage.get(cache_key)
+
+    def upsert(self, cache_key: str, flow: http.HTTPFlow) -> None:
+        if self._closed:
+            self.storage.upsert(cache_key, flow)
+            return
+        # Snapshot now: later addons may still modify the live flow.
+        snapshot = flow.copy()
+        with self._lock:
+            self._pending[cache_key] = snapshot
+        if not self._enqueue((cache_key, snapshot)):
+            self._forget([(cache_key, snapshot)])
+            logger.warning(
+                "Write-behind queue full; dropped cache write for %r",
+                cache_key,
+            )
+
+    def upsert_many(self, entries: Iterable[_Entry]) -> None:
+        for cache_key, flow in entries:
+            self.upsert(cache_key, flow)
+
+    def store(self, cache_key: str, flow: http.HTTPFlow) -> None:
+        self.flush()
+        self.storage.store(cache_key, flow)
+
+    def update(self, cache_key: str, flow: http.HTTPFlow) -> None:
+        self.flush()
+        self.storage.update(cache_key, flow)
+
+    def revalidate(self, cache_key: str, flow: http.HTTPFlow) -> None:
+        self.flush()
+        self.storage.revalidate(cache_key, flow)
+
+    def purge(self, cache_key: str) -> None:
+        self.flush()
+        self.storage.purge(cache_key)
+
+    def touch_many(self, hits: Iterable[tuple[str, int]]) -> None:
+        # Hits of entries still queued touch nothing; they are the most
+        # recently written anyway.
+        self.storage.touch_many(hits)
+
+    def flush(self) -> None:
+        """Block until every queued entry has been written."""
+        if not self._closed:
+            self._queue.join()
+
+    def close(self) -> None:
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._closed = True
+        self.storage.close()
+
+    def _enqueue(self, entry: _Entry) -> bool:
+        if self.queue_full == "block":
+            self._queue.put(entry)
+            return True
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            return False
+        return True
+
+    def _run(self) -> None:
+        while self._drain_once():
+            pass
+
+    def _drain_once(self) -> bool:
+        """Write one batch; return False once the stop sentinel is seen."""
+        items = self._collect()
+        batch = [item for item in items if item is not None]
+        if batch:
+            self._write(batch)
+        for _ in items:
+            self._queue.task_done()
+        return items[-1] is not None
+
+    def _collect(self) -> list[_Entry | None]:
+        """Wait for one item, then gather more until the batch is full,
+        flush_interval has passed or the stop sentinel (None) arrives."""
+        items = [self._queue.get()]
+        deadline = time.monotonic() + self.flush_interval
+        while items[-1] is not None and len(items) < self.batch_size:
+            timeout = max(0.0, deadline - time.monotonic())
+            try:
+                items.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return items
+
+    def _write(self, batch: list[_Entry]) -> None:
+        # Later upserts of the same key supersede earlier ones in the batch.
+        latest = dict(batch)
+        try:
+            self.storage.upsert_many(latest.items())
+        except Exception:
+            logger.exception(
+                "Write-behind batch of %d entries failed; not cached",
+                len(latest),
+            )
+        self._forget(batch)
+
+    def _forget(self, entries: list[_Entry]) -> None:
+        with self._lock:
+            for cache_key, flow in entries:
+                if self._pending.get(cache_key) is flow:
+                    del self._pending[cache_key]
@@ -0,0 +1,44 @@
+from __future__ import annotations
+
+import os
+
+from mitmcache.storage.body_files import BodyFileStore
+
+
+def test_write_and_read(tmp_path) -> None:
+    store = BodyFileStore(str(tmp_path / "bodies"))
+    path = store.write("abcdef0123", b"payload")
+    assert path == os.path.join("ab", "cd", "abcdef0123")
+    assert store.read(path) == b"payload"
+    # Only the renamed file is left behind.
+    assert os.listdir(tmp_path / "bodies" / "ab" / "cd") == ["abcdef0123"]
+
+
+def test_write_keeps_existing_file(tmp_path) -> None:
+    store = BodyFileStore(str(tmp_path))
+    path = store.write("abcdef", b"first")
+    store.write("abcdef", b"second")
+    assert store.read(path) == b"first"
+
+
+def test_directory_created_lazily(tmp_path) -> None:
+    BodyFileStore(str(tmp_path / "bodies"))
+    assert not (tmp_path / "bodies").exists()
+
+
+def test_delete_missing_file_is_ignored(tmp_path) -> None:
+    store = BodyFileStore(str(tmp_path))
+    store.delete(store.path_for("abcdef"))
+
+
+def test_remove_orphans(tmp_path) -> None:
+    store = BodyFileStore(str(tmp_path))
+    kept = store.write("aaaa01", b"kept")
+    store.write("bbbb02", b"orphan")
+    stale_tmp = tmp_path / "aa" / "aa" / ".tmp-interrupted"
+    stale_tmp.write_bytes(b"partial")
+
+    assert store.remove_orphans({kept}) == 2
+    assert store.read(kept) == b"kept"
+    assert not os.path.exists(tmp_path / store.path_for("bbbb02"))
+    assert not stale_tmp.exists()
@@ -1,12 +1,17 @@
 from __future__ import annotations
 
+import inspect
+
 try:
     from typing import get_protocol_members
 except ImportError:
     from typing_extensions import get_protocol_members
 
-from mitmcache.storage.cache_storage import CacheStorage
+from mitmcache.storage.cache_storage import AsyncCacheStorage, CacheStorage
+from mitmcache.storage.memory_tier import MemoryTierStorage
 from mitmcache.storage.sqlite3 import SQLiteStorage
+from mitmcache.storage.threaded import ThreadedStorage
+from mitmcache.storage.write_behind import WriteBehindStorage
 
 
 def test_sqlite_storage_satisfies_cache_storage_protocol() -> None:
@@ -16,3 +21,32 @@ def test_sqlite_storage_satisfies_cache_storage_protocol() -> None:
     assert not missing, (
         f"SQLiteStorage is missing CacheStorage methods: {missing}"
     )
+
+
+def test_memory_tier_storage_satisfies_cache_storage_protocol() -> None:
+    """MemoryTierStorage must implement all methods required by CacheStorage."""
+    required = get_protocol_members(CacheStorage)
+    missing = required - set(dir(MemoryTierStorage))
+    assert not missing, (
+        f"MemoryTierStorage is missing CacheStorage methods: {missing}"
+    )
+
+
+def test_threaded_storage_satisfies_async_cache_storage_protocol() -> None:
+    """ThreadedStorage must provide every AsyncCacheStorage method."""
+    required = get_protocol_members(AsyncCacheStorage)
+    missing = required - set(dir(ThreadedStorage))
+    assert not missing, (
+        f"ThreadedStorage is missing AsyncCacheStorage methods: {missing}"
+    )
+    for name in required - {"close"}:
+        assert inspect.iscoroutinefunction(getattr(ThreadedStorage, name))
+
+
+def test_write_behind_storage_satisfies_cache_storage_protocol() -> None:
+    """WriteBehindStorage must implement all methods required by CacheStorage."""
+    required = get_protocol_members(CacheStorage)
+    missing = required - set(dir(WriteBehindStorage))
+    assert not missing, (
+        f"WriteBehindStorage is missing CacheStorage methods: {missing}"
+    )
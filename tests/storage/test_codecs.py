@@ -0,0 +1,63 @@
+from __future__ import annotations
+
+import zlib
+
+import pytest
+
+from mitmcache.storage.codecs import (
+    CODECS,
+    Codec,
+    compress,
+    decompress,
+    get_codec,
+    register_codec,
+)
+
+
+def test_zlib_round_trip() -> None:
+    payload = b"<html>" + b"hello " * 1000 + b"</html>"
+    stored, codec = compress(payload, get_codec("zlib"), min_size=10)
+    assert codec == "zlib"
+    assert len(stored) < len(payload)
+    assert decompress(stored, codec) == payload
+
+
+def test_small_payload_stays_raw() -> None:
+    payload = b"a" * 100
+    assert compress(payload, get_codec("zlib"), min_size=101) == (
+        payload,
+        None,
+    )
+    assert decompress(payload, None) == payload
+
+
+def test_incompressible_payload_stays_raw() -> None:
+    payload = zlib.compress(bytes(range(256)) * 4)
+    assert compress(payload, get_codec("zlib"), min_size=0) == (
+        payload,
+        None,
+    )
+
+
+def test_unknown_codec_is_rejected() -> None:
+    with pytest.raises(ValueError, match="unknown compression codec"):
+        get_codec("lzma-but-not-registered")
+    with pytest.raises(ValueError):
+        decompress(b"", "lzma-but-not-registered")
+
+
+def test_register_codec() -> None:
+    codec = Codec("reverse", lambda b: b[::-1][:-1], lambda b: b[::-1])
+    register_codec(codec)
+    try:
+        assert get_codec("reverse") is codec
+    finally:
+        del CODECS["reverse"]
+
+
+@pytest.mark.skipif("zstd" not in CODECS, reason="zstandard not installed")
+def test_zstd_round_trip() -> None:
+    payload = b'{"items": [' + b'{"id": 1, "name": "x"},' * 500 + b"]}"
+    stored, codec = compress(payload, get_codec("zstd"), min_size=0)
+    assert codec == "zstd"
+    assert decompress(stored, codec) == payload
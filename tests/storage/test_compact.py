@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+import pytest
+from mitmproxy.test import tutils
+
+from mitmcache.storage.compact import (
+    CompactFormatError,
+    decode_flow,
+    decode_response,
+    encode_response,
+)
+
+from ..example_flow import example_flow
+
+
+def test_round_trip_preserves_response() -> None:
+    response = tutils.tresp(
+        content=b"\x00binary\xffbody",
+        headers=[(b"content-type", b"application/octet-stream")],
+        status_code=203,
+        reason=b"Non-Authoritative",
+    )
+    decoded = decode_response(encode_response(response))
+    assert decoded.status_code == 203
+    assert decoded.reason == "Non-Authoritative"
+    assert decoded.http_version == response.http_version
+    assert decoded.headers.fields == response.headers.fields
+    assert decoded.raw_content == response.raw_content
+    assert decoded.timestamp_start == response.timestamp_start
+    assert decoded.timestamp_end == response.timestamp_end
+    assert decoded.trailers is None
+
+
+def test_round_trip_keeps_encoded_body_and_trailers() -> None:
+    response = tutils.tresp(content=b"")
+    response.headers["content-encoding"] = "gzip"
+    response.raw_content = b"\x1f\x8b not really gzip"
+    response.trailers = response.trailers or type(response.headers)()
+    response.trailers["x-checksum"] = "abc"
+    response.timestamp_end = None
+
+    decoded = decode_response(encode_response(response))
+    assert decoded.raw_content == b"\x1f\x8b not really gzip"
+    assert decoded.trailers is not None
+    assert decoded.trailers["x-checksum"] == "abc"
+    assert decoded.timestamp_end is None
+
+
+def test_decode_flow_rebuilds_request_line() -> None:
+    flow = example_flow()
+    assert flow.response is not None
+    blob = encode_response(flow.response)
+
+    decoded = decode_flow(blob, "GET", "https://example.com:8443/a?b=1")
+    assert decoded.request.method == "GET"
+    assert decoded.request.url == "https://example.com:8443/a?b=1"
+    assert decoded.response is not None
+    assert decoded.response.text == "Hello, World!"
+    # Decoded flows behave like ordinary flows elsewhere in the addon.
+    assert decoded.copy().response is not None
+
+
+def test_compact_blob_is_smaller_than_flow_blob() -> None:
+    from mitmcache.storage.sqlite3 import _serialize
+
+    flow = example_flow()
+    assert flow.response is not None
+    assert len(encode_response(flow.response)) < len(_serialize(flow)) / 4
+
+
+@pytest.mark.parametrize(
+    "blob",
+    [b"", b"not compact", b"MCR\x01\x00", b"MCR\x02" + b"\x00" * 64],
+)
+def test_invalid_blobs_are_rejected(blob: bytes) -> None:
+    with pytest.raises(CompactFormatError):
+        decode_response(blob)
+
+
+def test_truncated_body_is_rejected() -> None:
+    blob = encode_response(tutils.tresp(content=b"0123456789"))
+    with pytest.raises(CompactFormatError):
+        decode_response(blob[:-1])
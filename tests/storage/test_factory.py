@@ -1,23 +1,48 @@
 from __future__ import annotations
 
+from types import SimpleNamespace
+from typing import Any
 from unittest.mock import MagicMock, patch
 
+import pytest
+from mitmproxy import exceptions
+
 from mitmcache.storage.factory import StorageFactory
+from mitmcache.storage.memory import MemoryStorage
+from mitmcache.storage.memory_tier import MemoryTierStorage
+from mitmcache.storage.sharded import ShardedStorage
 from mitmcache.storage.sqlite3 import SQLiteStorage
+from mitmcache.storage.threaded import ThreadedStorage
+
+from ..example_flow import example_flow
+
+
+def _options(**overrides: Any) -> SimpleNamespace:
+    """Build a ctx stand-in holding every option's default value."""
+    loader = MagicMock()
+    StorageFactory().load(loader)
+    options = {
+        call.kwargs["name"]: call.kwargs["default"]
+        for call in loader.add_option.call_args_list
+    }
+    options.update(overrides)
+    return SimpleNamespace(options=SimpleNamespace(**options))
 
 
 def test_storage_factory_create_returns_sqlite_storage() -> None:
     """create() returns an SQLiteStorage backed by the configured cache_file."""
     factory = StorageFactory()
-    with patch("mitmcache.storage.factory.ctx") as mock_ctx:
-        mock_ctx.options.cache_file = ":memory:"
+    with patch(
+        "mitmcache.storage.factory.ctx", _options(cache_backend="sqlite")
+    ):
         storage = factory.create()
         assert isinstance(storage, SQLiteStorage)
+        assert factory.create_async(storage) is None
         storage.close()
 
 
 def test_storage_factory_load_registers_cache_file_option() -> None:
-    """load() registers both storage-related mitmproxy options."""
+    """load() registers the storage-related mitmproxy options."""
     factory = StorageFactory()
     mock_loader = MagicMock()
     factory.load(mock_loader)
@@ -40,4 +65,624 @@ def test_storage_factory_load_registers_cache_file_option() -> None:
                 "help": "Maximum number of entries in the SQLite cache. 0 = unlimited.",
             },
         ),
+        (
+            (),
+            {
+                "name": "cache_max_bytes",
+                "typespec": int,
+                "default": 0,
+                "help": (
+                    "Maximum total size in bytes of the entries in the "
+                    "SQLite cache. 0 = unlimited."
+                ),
+            },
+        ),
+        (
+            (),
+            {
+                "name": "cache_eviction_policy",
+                "typespec": str,
+                "default": "lru",
+                "choices": ("lru", "lfu", "fifo"),
+                "help": (
+                    "Which entries are evicted first when a limit is "
+                    "exceeded: least recently used, least frequently used or"
+                    " first in."
+                ),
+            },
+        ),
+        (
+            (),
+            {
+                "name": "cache_admission",
+                "typespec": str,
+                "default": "always",
+                "choices": ("always", "tinylfu"),
+                "help": (
+                    "Admission policy for new keys. tinylfu only admits keys"
+                    " requested more often than the next eviction victim "
+                    "once the cache is full."
+                ),
+            },
+        ),
+        (
+            (),
+            {
+                "name": "cache_memory_tier_bytes",
+                "typespec": int,
+                "default": 0,
+                "help": (
+                    "Size in bytes of the in-process LRU tier kept in front "
+                    "of the cache storage. 0 disables the tier."
+                ),
+            },
+        ),
+        (
+            (),
+            {
+                "name": "cache_touch_batch_size",
+                "typespec": int,
+                "default": 0,
+                "help": (
+                    "Defer access-time updates on cache hits and write them "
+                    "in one transaction once this many are pending. 0 writes "
+                    "on every hit, or every 100 hits with cache_async_storage."
+                ),
+            },
+        ),
+        (
+            (),
+            {
+                "name": "cache_touch_flush_interval",
+                "typespec": float,
+                "default": 5.0,
+                "help": (
+                    "Seconds after which deferred access-time updates are "
+                    "flushed even if cache_touch_batch_size is not reached."
+                ),
+            },
+        ),
+        (
+            (),
+            {
+                "name": "cache_async_storage",
+                "typespec": bool,
+                "default": False,
+                "help": (
+                    "Run cache storage I/O on dedicated threads and await it "
+                    "from the hooks instead of blocking the event loop."
+                ),
+            },
+        ),
+        (
+            (),
+            {
+                "name": "cache_write_behind",
+                "typespec": bool,
+                "default": False,
+                "help": (
+                    "Queue cache writes and commit them in batches from a "
+                    "background thread."
+                ),
+            },
+        ),
+        (
+            (),
+            {
+                "name": "cache_write_batch_size",
+                "typespec": int,
+                "default": 100,
+                "help": (
+                    "Maximum number of queued writes committed together."
+                ),
+            },
+        ),
+        (
+            (),
+            {
+                "name": "cache_write_flush_interval",
+                "typespec": float,
+                "default": 0.1,
+                "help": (
+                    "Seconds the write-behind thread waits to fill a batch "
+                    "after the first queued write."
+                ),
+            },
+        ),
+        (
+            (),
+            {
+                "name": "cache_write_queue_size",
+                "typespec": int,
+                "default": 1000,
+                "help": (
+                    "Maximum number of writes waiting in the write-behind "
+                    "queue."
+                ),
+            },
+        ),
+        (
+            (),
+            {
+                "name": "cache_write_queue_full",
+                "typespec": str,
+                "default": "block",
+                "choices": ("block", "drop"),
+                "help": (
+                    "What to do when the write-behind queue is full: block "
+                    "until there is room, or drop the write."
+                ),
+            },
+        ),
+        (
+            (),
+            {
+                "name": "cache_entry_format",
+                "typespec": str,
+                "default": "flow",
+                "choices": ("flow", "compact"),
+                "help": (
+                    "Format of newly stored entries: the full mitmproxy "
+                    "flow, or a compact response-only encoding that is "
+                    "smaller, faster to decode and survives mitmproxy "
+                    "upgrades."
+                ),
+            },
+        ),
+        (
+            (),
+            {
+                "name": "cache_compression",
+                "typespec": str,
+                "default": "none",
+                "choices": ("none", "zlib", "zstd"),
+                "help": (
+                    "Codec used to compress stored entries. zstd requires "
+                    "the zstandard package."
+                ),
+            },
+        ),
+        (
+            (),
+            {
+                "name": "cache_compression_min_size",
+                "typespec": int,
+                "default": 1024,
+                "help": (
+                    "Entries smaller than this many bytes are stored "
+                    "uncompressed."
+                ),
+            },
+        ),
+        (
+            (),
+            {
+                "name": "cache_dedup_bodies",
+                "typespec": bool,
+                "default": False,
+                "help": (
+                    "Store each distinct response body once, shared by all "
+                    "cache keys whose responses have identical bodies."
+                ),
+            },
+        ),
+        (
+            (),
+            {
+                "name": "cache_external_body_size",
+                "typespec": int,
+                "default": 0,
+                "help": (
+                    "Store response bodies of at least this many bytes in "
+                    "separate files instead of the database. 0 disables."
+                ),
+            },
+        ),
+        (
+            (),
+            {
+                "name": "cache_body_dir",
+                "typespec": str,
+                "default": "",
+                "help": (
+                    "Directory for externally stored bodies. Defaults to "
+                    "<cache_file>.bodies."
+                ),
+            },
+        ),
+        (
+            (),
+            {
+                "name": "cache_sweep_interval",
+                "typespec": float,
+                "default": 60.0,
+                "help": (
+                    "Seconds between background sweeps deleting expired "
+                    "entries. 0 disables the sweeper."
+                ),
+            },
+        ),
+        (
+            (),
+            {
+                "name": "cache_sweep_batch_size",
+                "typespec": int,
+                "default": 1000,
+                "help": (
+                    "Maximum number of expired entries deleted per "
+                    "transaction."
+                ),
+            },
+        ),
+        (
+            (),
+            {
+                "name": "cache_shards",
+                "typespec": int,
+                "default": 1,
+                "help": (
+                    "Number of SQLite files the cache is split into by key "
+                    "hash. Writes to different shards run in parallel. "
+                    "Changing it empties the cache."
+                ),
+            },
+        ),
+        (
+            (),
+            {
+                "name": "cache_wal",
+                "typespec": bool,
+                "default": False,
+                "help": (
+                    "Put the cache file into write-ahead-log mode, so that "
+                    "several proxy processes can share it without blocking "
+                    "lookups in the other processes."
+                ),
+            },
+        ),
+        (
+            (),
+            {
+                "name": "cache_busy_timeout",
+                "typespec": float,
+                "default": 5.0,
+                "help": (
+                    "Seconds a cache write waits for another process to "
+                    "release the database before the attempt fails."
+                ),
+            },
+        ),
+        (
+            (),
+            {
+                "name": "cache_lock_retries",
+                "typespec": int,
+                "default": 5,
+                "help": (
+                    "How often a cache write that found the database locked "
+                    "is retried, with exponential backoff."
+                ),
+            },
+        ),
+        (
+            (),
+            {
+                "name": "cache_migrate",
+                "typespec": bool,
+                "default": True,
+                "help": (
+                    "On startup, convert entries stored by other mitmproxy "
+                    "versions instead of discarding them on access."
+                ),
+            },
+        ),
+        (
+            (),
+            {
+                "name": "cache_backend",
+                "typespec": str,
+                "default": "auto",
+                "choices": ("auto", "sqlite", "memory"),
+                "help": (
+                    "Cache storage backend. auto keeps a cache_file=:memory:"
+                    " cache in the native memory backend unless an option "
+                    "only SQLite supports is set, and uses SQLite otherwise."
+                ),
+            },
+        ),
     ]
+
+
+def test_storage_factory_passes_touch_options() -> None:
+    factory = StorageFactory()
+    with patch(
+        "mitmcache.storage.factory.ctx",
+        _options(
+            cache_backend="sqlite",
+            cache_touch_batch_size=64,
+            cache_touch_flush_interval=0.5,
+        ),
+    ):
+        storage = factory.create()
+        assert isinstance(storage, SQLiteStorage)
+        assert storage.touch_batch_size == 64
+        assert storage.touch_flush_interval == 0.5
+        storage.close()
+
+
+def test_storage_factory_wraps_storage_in_memory_tier() -> None:
+    """A positive cache_memory_tier_bytes puts the hot tier in front."""
+    factory = StorageFactory()
+    with patch(
+        "mitmcache.storage.factory.ctx",
+        _options(cache_backend="sqlite", cache_memory_tier_bytes=1024),
+    ):
+        storage = factory.create()
+        assert isinstance(storage, MemoryTierStorage)
+        assert isinstance(storage.storage, SQLiteStorage)
+        assert storage.max_bytes == 1024
+        storage.close()
+
+
+def test_storage_factory_create_async_wraps_threaded_storage() -> None:
+    factory = StorageFactory()
+    with patch(
+        "mitmcache.storage.factory.ctx", _options(cache_async_storage=True)
+    ):
+        storage = factory.create()
+        async_storage = factory.create_async(storage)
+        assert isinstance(async_storage, ThreadedStorage)
+        assert async_storage.storage is storage
+        async_storage.close()
+
+
+def test_storage_factory_defers_touches_for_async_storage(tmp_path) -> None:
+    """Async hits must not write on the reader thread one by one."""
+    factory = StorageFactory()
+    options = _options(
+        cache_file=str(tmp_path / "cache.db"), cache_async_storage=True
+    )
+    with patch("mitmcache.storage.factory.ctx", options):
+        storage = factory.create()
+    assert isinstance(storage, SQLiteStorage)
+    assert storage.touch_batch_size == 100
+    storage.close()
+
+    options.options.cache_touch_batch_size = 7
+    with patch("mitmcache.storage.factory.ctx", options):
+        storage = factory.create()
+    assert isinstance(storage, SQLiteStorage)
+    assert storage.touch_batch_size == 7
+    storage.close()
+
+
+def test_storage_factory_selects_compact_entry_format() -> None:
+    factory = StorageFactory()
+    with patch(
+        "mitmcache.storage.factory.ctx",
+        _options(cache_backend="sqlite", cache_entry_format="compact"),
+    ):
+        storage = factory.create()
+        assert isinstance(storage, SQLiteStorage)
+        assert storage.compact is True
+        storage.close()
+
+
+def test_storage_factory_passes_compression_options() -> None:
+    factory = StorageFactory()
+    options = _options(
+        cache_backend="sqlite",
+        cache_compression="zlib",
+        cache_compression_min_size=4096,
+    )
+    with patch("mitmcache.storage.factory.ctx", options):
+        storage = factory.create()
+        assert isinstance(storage, SQLiteStorage)
+        assert storage.codec is not None
+        assert storage.codec.name == "zlib"
+        assert storage.compression_min_size == 4096
+        storage.close()
+
+
+def test_storage_factory_rejects_unavailable_codec() -> None:
+    factory = StorageFactory()
+    options = _options(cache_backend="sqlite", cache_compression="zstd")
+    with (
+        patch("mitmcache.storage.factory.ctx", options),
+        patch.dict("mitmcache.storage.factory.CODECS", clear=True),
+        pytest.raises(exceptions.OptionsError, match="zstandard"),
+    ):
+        factory.create()
+
+
+def test_storage_factory_passes_dedup_option() -> None:
+    factory = StorageFactory()
+    with patch(
+        "mitmcache.storage.factory.ctx",
+        _options(cache_backend="sqlite", cache_dedup_bodies=True),
+    ):
+        storage = factory.create()
+        assert isinstance(storage, SQLiteStorage)
+        assert storage.dedup_bodies is True
+        storage.close()
+
+
+def test_storage_factory_passes_external_body_options(tmp_path) -> None:
+    factory = StorageFactory()
+    options = _options(
+        cache_external_body_size=65536, cache_body_dir=str(tmp_path)
+    )
+    with patch("mitmcache.storage.factory.ctx", options):
+        storage = factory.create()
+        assert isinstance(storage, SQLiteStorage)
+        assert storage.external_body_size == 65536
+        assert storage.body_files is not None
+        assert storage.body_files.directory == str(tmp_path)
+        storage.close()
+
+
+def test_storage_factory_rejects_external_bodies_in_memory() -> None:
+    factory = StorageFactory()
+    options = _options(cache_external_body_size=1)
+    with (
+        patch("mitmcache.storage.factory.ctx", options),
+        pytest.raises(exceptions.OptionsError, match="cache_body_dir"),
+    ):
+        factory.create()
+
+
+def test_storage_factory_passes_sweep_options() -> None:
+    factory = StorageFactory()
+    options = _options(
+        cache_backend="sqlite",
+        cache_sweep_interval=5.0,
+        cache_sweep_batch_size=10,
+    )
+    with patch("mitmcache.storage.factory.ctx", options):
+        storage = factory.create()
+        assert isinstance(storage, SQLiteStorage)
+        assert storage.sweep_interval == 5.0
+        assert storage.sweep_batch_size == 10
+        assert storage._sweeper is not None
+        storage.close()
+
+
+@pytest.mark.parametrize(("value", "expected"), [(0, None), (4096, 4096)])
+def test_storage_factory_passes_max_bytes(
+    value: int, expected: int | None
+) -> None:
+    factory = StorageFactory()
+    with patch(
+        "mitmcache.storage.factory.ctx",
+        _options(cache_backend="sqlite", cache_max_bytes=value),
+    ):
+        storage = factory.create()
+        assert isinstance(storage, SQLiteStorage)
+        assert storage.max_bytes == expected
+        storage.close()
+
+
+def test_storage_factory_passes_policy_options() -> None:
+    factory = StorageFactory()
+    options = _options(
+        cache_max_entries=100,
+        cache_eviction_policy="lfu",
+        cache_admission="tinylfu",
+    )
+    with patch("mitmcache.storage.factory.ctx", options):
+        storage = factory.create()
+        assert isinstance(storage, SQLiteStorage)
+        assert storage.eviction_policy == "lfu"
+        assert storage.sketch is not None
+        storage.close()
+
+
+def test_storage_factory_creates_sharded_storage(tmp_path) -> None:
+    factory = StorageFactory()
+    options = _options(
+        cache_file=str(tmp_path / "cache.db"),
+        cache_shards=3,
+        cache_max_entries=100,
+        cache_max_bytes=3000,
+        cache_async_storage=True,
+    )
+    with patch("mitmcache.storage.factory.ctx", options):
+        storage = factory.create()
+        async_storage = factory.create_async(storage)
+    assert isinstance(storage, ShardedStorage)
+    assert [shard.max_entries for shard in storage.shards] == [33] * 3
+    assert [shard.max_bytes for shard in storage.shards] == [1000] * 3
+    assert (tmp_path / "cache-2.db").exists()
+    assert isinstance(async_storage, ThreadedStorage)
+    assert len(async_storage._writers) == 3
+    async_storage.close()
+
+
+def test_storage_factory_splits_body_dir_per_shard(tmp_path) -> None:
+    factory = StorageFactory()
+    options = _options(
+        cache_file=str(tmp_path / "cache.db"),
+        cache_shards=2,
+        cache_external_body_size=1,
+        cache_body_dir=str(tmp_path / "bodies"),
+    )
+    with patch("mitmcache.storage.factory.ctx", options):
+        storage = factory.create()
+    assert isinstance(storage, ShardedStorage)
+    directories = [shard.body_files.directory for shard in storage.shards]
+    assert directories == [str(tmp_path / "bodies" / str(i)) for i in (0, 1)]
+    storage.close()
+
+
+def test_storage_factory_passes_multiprocess_options(tmp_path) -> None:
+    factory = StorageFactory()
+    options = _options(
+        cache_file=str(tmp_path / "cache.db"),
+        cache_wal=True,
+        cache_busy_timeout=0.5,
+        cache_lock_retries=2,
+    )
+    with patch("mitmcache.storage.factory.ctx", options):
+        storage = factory.create()
+    assert isinstance(storage, SQLiteStorage)
+    assert storage.wal is True
+    assert storage.busy_timeout == 0.5
+    assert storage.lock_retries == 2
+    storage.close()
+
+
+@pytest.mark.parametrize("migrate", [True, False])
+def test_storage_factory_migrates_outdated_entries(
+    tmp_path, migrate: bool
+) -> None:
+    path = str(tmp_path / "cache.db")
+    storage = SQLiteStorage(path)
+    storage.store("key", example_flow())
+    storage.conn.execute("UPDATE cache SET flow_format_version = '0.0.0'")
+    storage.conn.commit()
+    storage.close()
+
+    options = _options(cache_file=path, cache_migrate=migrate)
+    with patch("mitmcache.storage.factory.ctx", options):
+        storage = StorageFactory().create()
+    assert isinstance(storage, SQLiteStorage)
+    row = storage.conn.execute("SELECT flow_format_version FROM cache")
+    assert (row.fetchone()[0] != "0.0.0") is migrate
+    storage.close()
+
+
+@pytest.mark.parametrize(
+    ("overrides", "expected"),
+    [
+        ({}, MemoryStorage),
+        ({"cache_eviction_policy": "lfu"}, SQLiteStorage),
+        ({"cache_admission": "tinylfu"}, SQLiteStorage),
+        ({"cache_backend": "sqlite"}, SQLiteStorage),
+        ({"cache_file": "{tmp}/cache.db"}, SQLiteStorage),
+        (
+            {"cache_backend": "memory", "cache_file": "{tmp}/cache.db"},
+            MemoryStorage,
+        ),
+    ],
+)
+def test_storage_factory_selects_backend(
+    tmp_path, overrides: dict[str, str], expected: type
+) -> None:
+    overrides = {
+        name: value.format(tmp=tmp_path) for name, value in overrides.items()
+    }
+    options = _options(cache_max_entries=10, **overrides)
+    with patch("mitmcache.storage.factory.ctx", options):
+        storage = StorageFactory().create()
+    assert type(storage) is expected
+    assert storage.max_entries == 10
+    storage.close()
+
+
+def test_storage_factory_rejects_sqlite_options_for_memory() -> None:
+    options = _options(cache_backend="memory", cache_eviction_policy="fifo")
+    with (
+        patch("mitmcache.storage.factory.ctx", options),
+        pytest.raises(exceptions.OptionsError, match="lru"),
+    ):
+        StorageFactory().create()
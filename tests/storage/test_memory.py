@@ -0,0 +1,151 @@
+from __future__ import annotations
+
+import time
+from unittest.mock import patch
+
+from mitmcache.storage import memory
+from mitmcache.storage.cache_storage import EXPIRES_AT, STALE_AT
+from mitmcache.storage.memory import MemoryStorage
+from mitmcache.storage.memory_tier import estimate_flow_size
+
+from ..example_flow import example_flow
+
+
+def test_memory_storage_round_trip() -> None:
+    storage = MemoryStorage()
+    storage.store("key", example_flow())
+    cached = storage.get("key")
+    assert cached is not None
+    assert cached.response is not None
+    assert cached.response.text == "Hello, World!"
+    storage.purge("key")
+    assert storage.get("key") is None
+    storage.close()
+
+
+def test_memory_storage_copies_on_write_and_read() -> None:
+    storage = MemoryStorage()
+    flow = example_flow()
+    storage.upsert("key", flow)
+    assert flow.response is not None
+    flow.response.text = "changed after store"
+
+    served = storage.get("key")
+    assert served is not None
+    assert served.response is not None
+    served.response.text = "changed by an addon"
+    served.metadata["addon"] = True
+
+    cached = storage.get("key")
+    assert cached is not None
+    assert cached.response is not None
+    assert cached.response.text == "Hello, World!"
+    assert "addon" not in cached.metadata
+    assert cached is not served
+
+
+def test_memory_storage_evicts_least_recently_used() -> None:
+    storage = MemoryStorage(max_entries=3)
+    for key in ("a", "b", "c"):
+        storage.upsert(key, example_flow())
+    assert storage.get("a") is not None
+    storage.upsert("d", example_flow())
+
+    assert storage.get("b") is None
+    assert [k for k in "acd" if storage.get(k) is not None] == ["a", "c", "d"]
+    assert storage.entry_count() == 3
+
+
+def test_memory_storage_touch_many_refreshes_lru_order() -> None:
+    storage = MemoryStorage(max_entries=2)
+    storage.store("a", example_flow())
+    storage.store("b", example_flow())
+    storage.touch_many([("a", 1), ("missing", 1)])
+    storage.store("c", example_flow())
+    assert storage.get("a") is not None
+    assert storage.get("b") is None
+
+
+def test_memory_storage_bounds_bytes() -> None:
+    size = estimate_flow_size(example_flow())
+    storage = MemoryStorage(max_bytes=2 * size)
+    for key in ("a", "b", "c"):
+        storage.upsert(key, example_flow())
+
+    assert storage.get("a") is None
+    assert storage.byte_count() == 2 * size
+    storage.purge("b")
+    assert storage.byte_count() == size
+
+
+def test_memory_storage_drops_expired_entries() -> None:
+    storage = MemoryStorage()
+    flow = example_flow()
+    flow.metadata[EXPIRES_AT] = int(time.time()) - 1
+    storage.upsert("key", flow)
+
+    assert storage.get("key") is None
+    assert storage.entry_count() == 0
+
+
+def test_memory_storage_revalidate_renews_expiry() -> None:
+    storage = MemoryStorage()
+    stale = example_flow()
+    stale.metadata[STALE_AT] = 1
+    storage.upsert("key", stale)
+    renewal = example_flow()
+    assert renewal.response is not None
+    renewal.response.text = "not stored"
+    renewal.metadata[EXPIRES_AT] = int(time.time()) + 100
+
+    storage.revalidate("key", renewal)
+
+    cached = storage.get("key")
+    assert cached is not None
+    assert cached.response is not None
+    assert cached.response.text == "Hello, World!"
+    assert cached.metadata[EXPIRES_AT] == renewal.metadata[EXPIRES_AT]
+    assert STALE_AT not in cached.metadata
+
+
+def test_memory_storage_update_and_revalidate_need_the_key(caplog) -> None:
+    storage = MemoryStorage()
+    storage.update("missing", example_flow())
+    storage.revalidate("missing", example_flow())
+
+    assert storage.get("missing") is None
+    assert "update() noop" in caplog.text
+    assert "revalidate() noop" in caplog.text
+
+
+def test_memory_storage_update_does_not_undo_a_concurrent_purge() -> None:
+    storage = MemoryStorage()
+    storage.store("key", example_flow())
+    snapshot_of = memory._Snapshot.of
+
+    def purge_meanwhile(flow):
+        storage.purge("key")
+        return snapshot_of(flow)
+
+    with patch.object(memory._Snapshot, "of", purge_meanwhile):
+        storage.update("key", example_flow())
+
+    assert storage.get("key") is None
+    assert storage.current_bytes == 0
+
+
+def test_memory_storage_entries() -> None:
+    storage = MemoryStorage(max_entries=3)
+    expired = example_flow()
+    expired.metadata[EXPIRES_AT] = time.time() - 1
+    storage.upsert("a-1", example_flow())
+    storage.upsert("a-expired", expired)
+    storage.upsert("b-1", example_flow())
+
+    assert [key for key, _ in storage.entries()] == ["a-1", "b-1"]
+    assert [key for key, _ in storage.entries("b")] == ["b-1"]
+    # Listing is not an access: a-1 is still the next to be evicted.
+    storage.upsert("c-1", example_flow())
+    assert storage.get("a-1") is None
+    assert storage.get("b-1") is not None
+    storage.close()
@@ -0,0 +1,248 @@
+from __future__ import annotations
+
+import threading
+import time
+from unittest.mock import patch
+
+from mitmcache.storage.cache_storage import EXPIRES_AT
+from mitmcache.storage.memory_tier import (
+    MemoryTierStorage,
+    estimate_flow_size,
+)
+from mitmcache.storage.sqlite3 import SQLiteStorage
+
+from ..example_flow import example_flow
+
+
+class CountingStorage:
+    """Wrap SQLiteStorage and count how often reads reach it."""
+
+    def __init__(self) -> None:
+        self.storage = SQLiteStorage(":memory:")
+        self.get_count = 0
+        self.touched: list[tuple[str, int]] = []
+
+    def get(self, cache_key):
+        self.get_count += 1
+        return self.storage.get(cache_key)
+
+    def store(self, cache_key, flow):
+        self.storage.store(cache_key, flow)
+
+    def update(self, cache_key, flow):
+        self.storage.update(cache_key, flow)
+
+    def upsert(self, cache_key, flow):
+        self.storage.upsert(cache_key, flow)
+
+    def revalidate(self, cache_key, flow):
+        self.storage.revalidate(cache_key, flow)
+
+    def purge(self, cache_key):
+        self.storage.purge(cache_key)
+
+    def touch_many(self, hits):
+        self.touched += hits
+
+    def close(self):
+        self.storage.close()
+
+
+def test_hot_hits_do_not_reach_backend() -> None:
+    backend = CountingStorage()
+    storage = MemoryTierStorage(backend, max_bytes=1 << 20)
+    storage.upsert("key", example_flow())
+
+    for _ in range(3):
+        cached = storage.get("key")
+        assert cached is not None
+        assert cached.response is not None
+        assert cached.response.text == "Hello, World!"
+
+    assert backend.get_count == 1
+    storage.close()
+
+
+def test_served_flows_are_copies() -> None:
+    """Mutating a served response must not change the cached entry."""
+    storage = MemoryTierStorage(CountingStorage(), max_bytes=1 << 20)
+    storage.upsert("key", example_flow())
+
+    first = storage.get("key")
+    assert first is not None and first.response is not None
+    first.response.text = "mutated"
+    first.response.headers["x-added"] = "1"
+
+    second = storage.get("key")
+    assert second is not None and second.response is not None
+    assert second.response.text == "Hello, World!"
+    assert "x-added" not in second.response.headers
+    storage.close()
+
+
+def test_writes_and_purge_invalidate_tier() -> None:
+    backend = CountingStorage()
+    storage = MemoryTierStorage(backend, max_bytes=1 << 20)
+    flow = example_flow()
+    storage.upsert("key", flow)
+    assert storage.get("key") is not None
+
+    assert flow.response is not None
+    flow.response.text = "Updated"
+    storage.upsert("key", flow)
+    cached = storage.get("key")
+    assert cached is not None and cached.response is not None
+    assert cached.response.text == "Updated"
+    assert backend.get_count == 2
+
+    storage.purge("key")
+    assert storage.get("key") is None
+    assert storage.current_bytes == 0
+    storage.close()
+
+
+def test_revalidate_invalidates_tier() -> None:
+    backend = CountingStorage()
+    storage = MemoryTierStorage(backend, max_bytes=1 << 20)
+    storage.upsert("key", example_flow())
+    assert storage.get("key") is not None
+
+    renewed = example_flow()
+    renewed.metadata[EXPIRES_AT] = int(time.time()) + 60
+    storage.revalidate("key", renewed)
+    cached = storage.get("key")
+    assert cached is not None
+    assert cached.metadata[EXPIRES_AT] == renewed.metadata[EXPIRES_AT]
+    assert backend.get_count == 2
+    storage.close()
+
+
+def test_tier_is_bounded_by_bytes() -> None:
+    flow = example_flow()
+    size = estimate_flow_size(flow)
+    backend = CountingStorage()
+    storage = MemoryTierStorage(backend, max_bytes=size * 2)
+    for key in ("key1", "key2", "key3"):
+        storage.upsert(key, flow)
+        assert storage.get(key) is not None
+
+    assert storage.current_bytes == size * 2
+    assert backend.get_count == 3
+
+    # key1 was the least recently used entry and has been evicted.
+    assert storage.get("key3") is not None
+    assert backend.get_count == 3
+    assert storage.get("key1") is not None
+    assert backend.get_count == 4
+    storage.close()
+
+
+def test_entries_larger_than_tier_are_not_admitted() -> None:
+    flow = example_flow()
+    backend = CountingStorage()
+    storage = MemoryTierStorage(
+        backend, max_bytes=estimate_flow_size(flow) - 1
+    )
+    storage.upsert("key", flow)
+    assert storage.get("key") is not None
+    assert storage.get("key") is not None
+    assert backend.get_count == 2
+    assert storage.current_bytes == 0
+    storage.close()
+
+
+def test_expired_entries_are_not_served_from_tier() -> None:
+    backend = CountingStorage()
+    storage = MemoryTierStorage(backend, max_bytes=1 << 20)
+    flow = example_flow()
+    flow.metadata[EXPIRES_AT] = int(time.time()) + 60
+    storage.upsert("key", flow)
+    assert storage.get("key") is not None
+    assert storage.get("key") is not None
+    assert backend.get_count == 1
+
+    with patch("time.time", return_value=time.time() + 120):
+        assert storage.get("key") is None
+    assert backend.get_count == 2
+    assert storage.current_bytes == 0
+    storage.close()
+
+
+def test_tier_hits_are_forwarded_in_batches() -> None:
+    backend = CountingStorage()
+    storage = MemoryTierStorage(
+        backend, max_bytes=1 << 20, hit_batch_size=3, hit_flush_interval=3600
+    )
+    storage.upsert("a", example_flow())
+    storage.upsert("b", example_flow())
+    storage.get("a")
+    storage.get("b")
+
+    storage.get("a")
+    storage.get("a")
+    time.sleep(0.05)
+    assert backend.touched == []
+    # The third tier hit fills the batch, which the flusher forwards.
+    storage.get("b")
+    _wait_until(lambda: len(backend.touched) == 2)
+    assert sorted(backend.touched) == [("a", 2), ("b", 1)]
+
+    storage.get("a")
+    storage.close()
+    assert backend.touched[-1] == ("a", 1)
+
+
+def test_tier_hits_protect_hot_keys_from_backend_eviction() -> None:
+    backend = SQLiteStorage(":memory:", max_entries=10, threaded=True)
+    storage = MemoryTierStorage(backend, max_bytes=1 << 20, hit_batch_size=5)
+    storage.upsert("hot", example_flow())
+    assert storage.get("hot") is not None
+    for i in range(9):
+        storage.upsert(f"cold-{i}", example_flow())
+    for _ in range(5):
+        assert storage.get("hot") is not None
+
+    # The hits pending are forwarded before the insert. Over max_entries,
+    # the two least recently used entries are evicted.
+    storage.upsert("new", example_flow())
+
+    assert backend.get("hot") is not None
+    assert backend.get("cold-0") is None
+    storage.close()
+
+
+def test_tier_hits_do_not_wait_for_the_backend() -> None:
+    backend = CountingStorage()
+    storage = MemoryTierStorage(backend, max_bytes=1 << 20, hit_batch_size=2)
+    storage.upsert("key", example_flow())
+    storage.get("key")
+    release = threading.Event()
+    backend.touch_many = lambda hits: release.wait(5)
+
+    started = time.monotonic()
+    for _ in range(10):
+        assert storage.get("key") is not None
+    assert time.monotonic() - started < 1
+
+    release.set()
+    storage.close()
+
+
+def test_tier_hits_are_forwarded_every_interval() -> None:
+    backend = CountingStorage()
+    storage = MemoryTierStorage(
+        backend, max_bytes=1 << 20, hit_flush_interval=0.01
+    )
+    storage.upsert("key", example_flow())
+    storage.get("key")
+    storage.get("key")
+
+    _wait_until(lambda: backend.touched == [("key", 1)])
+    storage.close()
+
+
+def _wait_until(condition, timeout: float = 5.0) -> None:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
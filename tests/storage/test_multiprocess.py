@@ -0,0 +1,194 @@
+from __future__ import annotations
+
+import contextlib
+import multiprocessing
+import sqlite3
+import threading
+from unittest.mock import patch
+
+import pytest
+
+from mitmcache.storage.sqlite3 import SQLiteStorage
+
+from ..example_flow import example_flow
+
+WORKERS = 4
+WRITES = 100
+
+
+def _hammer(path: str, worker: int) -> None:
+    """Write and read back WRITES keys of one worker process."""
+    storage = SQLiteStorage(path, wal=True, busy_timeout=1.0)
+    for i in range(WRITES):
+        key = f"worker-{worker}-{i}"
+        storage.upsert(key, example_flow())
+        assert storage.get(key) is not None
+        storage.sweep()
+    storage.close()
+
+
+def _share_body(path: str, worker: int) -> None:
+    """Store and purge keys whose external bodies are all the same file."""
+    storage = SQLiteStorage(
+        path, wal=True, busy_timeout=1.0, external_body_size=1
+    )
+    for i in range(WRITES):
+        key = f"worker-{worker}-{i}"
+        storage.upsert(key, example_flow())
+        storage.purge(key)
+    storage.upsert(f"worker-{worker}", example_flow())
+    storage.close()
+
+
+def _run_workers(target, path: str) -> None:
+    context = multiprocessing.get_context("spawn")
+    workers = [
+        context.Process(target=target, args=(path, worker))
+        for worker in range(WORKERS)
+    ]
+    for process in workers:
+        process.start()
+    for process in workers:
+        process.join(timeout=120)
+    assert [process.exitcode for process in workers] == [0] * WORKERS
+
+
+def _lock_database(path: str, seconds: float) -> threading.Thread:
+    """Hold the write lock of the database from another connection."""
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute("BEGIN IMMEDIATE")
+
+    def release() -> None:
+        conn.rollback()
+        conn.close()
+
+    timer = threading.Timer(seconds, release)
+    timer.start()
+    return timer
+
+
+def test_processes_sharing_a_file_lose_no_writes(tmp_path) -> None:
+    path = str(tmp_path / "cache.db")
+    SQLiteStorage(path, wal=True).close()
+    _run_workers(_hammer, path)
+
+    storage = SQLiteStorage(path)
+    assert storage.entry_count() == WORKERS * WRITES
+    rows = storage.conn.execute("SELECT COUNT(*) FROM cache").fetchone()
+    assert rows[0] == WORKERS * WRITES
+    storage.close()
+
+
+def test_processes_sharing_body_files_lose_none(tmp_path) -> None:
+    path = str(tmp_path / "cache.db")
+    SQLiteStorage(path, wal=True, external_body_size=1).close()
+    _run_workers(_share_body, path)
+
+    storage = SQLiteStorage(path, external_body_size=1)
+    assert storage.entry_count() == WORKERS
+    for worker in range(WORKERS):
+        flow = storage.get(f"worker-{worker}")
+        assert flow is not None
+        assert flow.response is not None
+        assert flow.response.content == b"Hello, World!"
+    storage.close()
+
+
+def test_released_body_file_is_deleted_under_the_write_lock(
+    tmp_path,
+) -> None:
+    """Another process cannot reuse a body file about to be deleted."""
+    path = str(tmp_path / "cache.db")
+    first = SQLiteStorage(path, wal=True, external_body_size=1)
+    second = SQLiteStorage(
+        path, wal=True, external_body_size=1, busy_timeout=0.01
+    )
+    second.lock_retries = 0
+    first.upsert("first", example_flow())
+    assert first.body_files is not None
+    delete = first.body_files.delete
+
+    def store_during_delete(body_path: str) -> None:
+        with contextlib.suppress(sqlite3.OperationalError):
+            second.upsert("second", example_flow())
+        delete(body_path)
+
+    with patch.object(first.body_files, "delete", store_during_delete):
+        first.purge("first")
+    # Stores the entry if the write lock kept the store above out.
+    second.upsert("second", example_flow())
+
+    flow = second.get("second")
+    assert flow is not None
+    assert flow.response is not None
+    assert flow.response.content == b"Hello, World!"
+    first.close()
+    second.close()
+
+
+def test_wal_mode(tmp_path) -> None:
+    storage = SQLiteStorage(str(tmp_path / "cache.db"), wal=True)
+    mode = storage.conn.execute("PRAGMA journal_mode").fetchone()[0]
+    assert mode == "wal"
+    storage.close()
+
+
+def test_write_retries_while_database_is_locked(tmp_path) -> None:
+    path = str(tmp_path / "cache.db")
+    storage = SQLiteStorage(path, busy_timeout=0.01, lock_retries=5)
+    timer = _lock_database(path, 0.1)
+
+    storage.upsert("key", example_flow())
+
+    timer.join()
+    assert storage.get("key") is not None
+    storage.close()
+
+
+def test_write_fails_once_retries_are_exhausted(tmp_path) -> None:
+    path = str(tmp_path / "cache.db")
+    storage = SQLiteStorage(path, busy_timeout=0.01, lock_retries=0)
+    timer = _lock_database(path, 0.2)
+
+    with pytest.raises(sqlite3.OperationalError, match="locked"):
+        storage.upsert("key", example_flow())
+
+    timer.join()
+    assert not storage.conn.in_transaction
+    storage.upsert("key", example_flow())
+    assert storage.get("key") is not None
+    storage.close()
+
+
+def test_maintenance_lease_is_held_by_one_storage(tmp_path) -> None:
+    path = str(tmp_path / "cache.db")
+    first = SQLiteStorage(path, wal=True)
+    second = SQLiteStorage(path, wal=True)
+
+    assert first.claim("sweep", 60)
+    assert not second.claim("sweep", 60)
+    assert first.claim("sweep", 60)
+    assert second.claim("other", 60)
+    # An expired lease can be taken over.
+    assert first.claim("sweep", -1)
+    assert second.claim("sweep", 60)
+    assert not first.claim("sweep", 60)
+    first.close()
+    second.close()
+
+
+def test_access_clock_follows_other_processes(tmp_path) -> None:
+    """LRU order holds across storages sharing a file."""
+    path = str(tmp_path / "cache.db")
+    first = SQLiteStorage(path, wal=True)
+    second = SQLiteStorage(path, wal=True)
+    for i in range(5):
+        first.upsert(f"first-{i}", example_flow())
+    second.upsert("second", example_flow())
+
+    rows = second.conn.execute(
+        "SELECT cache_key FROM cache ORDER BY access_clock DESC LIMIT 1"
+    ).fetchall()
+    assert [row["cache_key"] for row in rows] == ["second"]
+    first.close()
+    second.close()
@@ -0,0 +1,42 @@
+from __future__ import annotations
+
+import pytest
+
+from mitmcache.storage.policies import FrequencySketch, victim_order
+
+
+def test_victim_order_rejects_unknown_policy() -> None:
+    assert victim_order("lru") == "access_clock"
+    with pytest.raises(ValueError, match="unknown eviction policy"):
+        victim_order("random")
+
+
+def test_sketch_estimates_frequencies() -> None:
+    sketch = FrequencySketch(1000)
+    for _ in range(5):
+        sketch.increment("hot")
+    sketch.increment("warm")
+    assert sketch.estimate("hot") == 5
+    assert sketch.estimate("warm") == 1
+    assert sketch.estimate("cold") == 0
+
+
+def test_sketch_counters_saturate() -> None:
+    sketch = FrequencySketch(1000)
+    for _ in range(100):
+        sketch.increment("hot")
+    assert sketch.estimate("hot") == 15
+
+
+def test_sketch_ages_after_sample_size() -> None:
+    sketch = FrequencySketch(1000)
+    assert sketch.sample_size == 10 * 1024
+    sketch.sample_size = 10
+    for _ in range(8):
+        sketch.increment("hot")
+    sketch.increment("a")
+    sketch.increment("b")
+    # Aging halved every counter, so past popularity fades.
+    assert sketch.estimate("hot") == 4
+    assert sketch.estimate("a") == 0
+    assert sketch.additions == 5
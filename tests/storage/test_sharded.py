@@ -0,0 +1,113 @@
+from __future__ import annotations
+
+import threading
+
+import pytest
+
+from mitmcache.storage.sharded import ShardedStorage, shard_index, shard_path
+from mitmcache.storage.sqlite3 import SQLiteStorage
+
+from ..example_flow import example_flow
+
+
+class BarrierStorage:
+    """Storage whose batch writes wait until every shard is writing."""
+
+    def __init__(self, barrier: threading.Barrier) -> None:
+        self.barrier = barrier
+        self.keys: list[str] = []
+
+    def upsert_many(self, entries):
+        self.barrier.wait()
+        self.keys.extend(cache_key for cache_key, _ in entries)
+
+    def close(self):
+        pass
+
+
+def _sharded(tmp_path, shards: int = 4) -> ShardedStorage:
+    return ShardedStorage(
+        [
+            SQLiteStorage(
+                shard_path(str(tmp_path / "cache.db"), index), threaded=True
+            )
+            for index in range(shards)
+        ]
+    )
+
+
+def test_shard_index_is_stable_and_spread() -> None:
+    keys = [f"key-{i}" for i in range(400)]
+    indexes = [shard_index(key, 4) for key in keys]
+    assert indexes == [shard_index(key, 4) for key in keys]
+    # Pinned: other processes and restarts must agree on the shard.
+    assert shard_index("key-0", 4) == 0
+    assert all(indexes.count(index) > 50 for index in range(4))
+
+
+def test_shard_path() -> None:
+    assert shard_path("/tmp/cache.db", 3) == "/tmp/cache-3.db"
+    assert shard_path("/tmp/cache", 0) == "/tmp/cache-0"
+    assert shard_path(":memory:", 1) == ":memory:"
+
+
+def test_sharded_storage_needs_a_shard() -> None:
+    with pytest.raises(ValueError, match="at least one shard"):
+        ShardedStorage([])
+
+
+def test_sharded_storage_routes_keys_to_one_shard(tmp_path) -> None:
+    storage = _sharded(tmp_path)
+    for i in range(20):
+        storage.upsert(f"key-{i}", example_flow())
+
+    for i in range(20):
+        key = f"key-{i}"
+        cached = storage.get(key)
+        assert cached is not None
+        assert cached.response is not None
+        assert cached.response.text == "Hello, World!"
+        owners = [shard for shard in storage.shards if shard.get(key)]
+        assert owners == [storage.shard_for(key)]
+    assert sorted(p.name for p in tmp_path.glob("cache-*.db")) == [
+        f"cache-{index}.db" for index in range(4)
+    ]
+    storage.close()
+
+
+def test_sharded_storage_purges_and_revalidates(tmp_path) -> None:
+    storage = _sharded(tmp_path)
+    storage.store("kept", example_flow())
+    storage.store("purged", example_flow())
+    storage.revalidate("kept", example_flow())
+    storage.purge("purged")
+
+    assert storage.get("kept") is not None
+    assert storage.get("purged") is None
+    storage.close()
+
+
+def test_sharded_upsert_many_writes_shards_in_parallel() -> None:
+    """Each shard's batch runs at once; the barrier needs all four."""
+    barrier = threading.Barrier(4, timeout=5)
+    shards = [BarrierStorage(barrier) for _ in range(4)]
+    storage = ShardedStorage(shards)
+    keys = [f"key-{i}" for i in range(40)]
+    storage.upsert_many((key, example_flow()) for key in keys)
+
+    for index, shard in enumerate(shards):
+        assert shard.keys == [k for k in keys if shard_index(k, 4) == index]
+    storage.close()
+
+
+def test_sharded_upsert_many_reraises_after_all_shards(tmp_path) -> None:
+    storage = _sharded(tmp_path, shards=2)
+    storage.shards[0].close()
+    keys = [f"key-{i}" for i in range(20)]
+
+    with pytest.raises(Exception):
+        storage.upsert_many((key, example_flow()) for key in keys)
+
+    written = [k for k in keys if shard_index(k, 2) == 1]
+    assert all(storage.shards[1].get(key) for key in written)
+    storage.shards[1].close()
@@ -1,10 +1,18 @@
 from __future__ import annotations
 
+import hashlib
 import importlib.metadata
+import itertools
+import sqlite3
+import time
 from unittest.mock import MagicMock, patch
 
 import pytest
+from mitmproxy.http import HTTPFlow
+from mitmproxy.io import tnetstring
 
+from mitmcache.storage import sqlite3 as sqlite3_module
+from mitmcache.storage.cache_storage import EXPIRES_AT, STALE_AT
 from mitmcache.storage.sqlite3 import SQLiteStorage
 
 from ..example_flow import example_flow
@@ -232,3 +240,1118 @@ def test_cache_storage_migrates_existing_db() -> None:
     cols = [r[1] for r in conn.execute("PRAGMA table_info(cache)").fetchall()]
     assert "flow_format_version" in cols
     conn.close()
+
+
+def test_eviction_runs_in_batches_down_to_low_watermark() -> None:
+    """Crossing max_entries evicts a batch, then writes skip eviction."""
+    storage = SQLiteStorage(":memory:", max_entries=20)
+    flow = example_flow()
+    for i in range(21):
+        storage.store(f"key{i}", flow)
+
+    # 21 > 20 triggers eviction down to the low watermark of 18.
+    assert storage.entry_count() == 18
+    assert storage.get("key0") is None
+    assert storage.get("key2") is None
+    assert storage.get("key3") is not None
+
+    # The next two inserts fit under max_entries without evicting.
+    storage.store("key21", flow)
+    storage.store("key22", flow)
+    assert storage.entry_count() == 20
+    storage.close()
+
+
+def test_entry_count_tracks_upsert_and_purge() -> None:
+    """The trigger-maintained count must match the table contents."""
+    storage = SQLiteStorage(":memory:")
+    flow = example_flow()
+    storage.upsert("key1", flow)
+    storage.upsert("key1", flow)
+    storage.upsert("key2", flow)
+    assert storage.entry_count() == 2
+    storage.purge("key1")
+    storage.purge("missing")
+    assert storage.entry_count() == 1
+    count = storage.conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+    assert count == 1
+    storage.close()
+
+
+def test_upsert_encodes_each_flow_once() -> None:
+    storage = SQLiteStorage(":memory:")
+    flow = example_flow()
+    with patch(
+        "mitmcache.storage.sqlite3._encode", wraps=sqlite3_module._encode
+    ) as encode:
+        storage.upsert("new", flow)
+        assert encode.call_count == 1
+        storage.upsert("new", flow)
+        assert encode.call_count == 2
+    assert storage.get("new") is not None
+    storage.close()
+
+
+def test_eviction_uses_access_clock_index() -> None:
+    storage = SQLiteStorage(":memory:", max_entries=10)
+    plan = storage.conn.execute(
+        "EXPLAIN QUERY PLAN SELECT id FROM cache ORDER BY access_clock LIMIT 1"
+    ).fetchall()
+    assert any("cache_access_clock" in row["detail"] for row in plan)
+    storage.close()
+
+
+def test_access_clock_backfilled_from_last_accessed_at(tmp_path) -> None:
+    """Databases without access_clock keep their previous LRU order."""
+    import sqlite3 as _sqlite3
+
+    db_path = str(tmp_path / "cache.db")
+    conn = _sqlite3.connect(db_path)
+    conn.execute(
+        """
+        CREATE TABLE cache (
+            id INTEGER PRIMARY KEY,
+            cache_key TEXT UNIQUE,
+            url TEXT,
+            method TEXT,
+            flow BLOB,
+            flow_format_version TEXT,
+            last_accessed_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        """
+    )
+    conn.executemany(
+        "INSERT INTO cache (cache_key, last_accessed_at) VALUES (?, ?)",
+        [
+            ("newest", "2024-01-03T00:00:00+00:00"),
+            ("oldest", "2024-01-01T00:00:00+00:00"),
+            ("middle", "2024-01-02T00:00:00+00:00"),
+        ],
+    )
+    conn.commit()
+    conn.close()
+
+    storage = SQLiteStorage(db_path, max_entries=3)
+    rows = storage.conn.execute(
+        "SELECT cache_key FROM cache ORDER BY access_clock"
+    ).fetchall()
+    assert [row["cache_key"] for row in rows] == ["oldest", "middle", "newest"]
+    assert storage.entry_count() == 3
+
+    storage.store("added", example_flow())
+    assert storage.entry_count() == 3
+    remaining = {
+        row["cache_key"]
+        for row in storage.conn.execute("SELECT cache_key FROM cache")
+    }
+    assert remaining == {"middle", "newest", "added"}
+    storage.close()
+
+
+def _access_clock(storage: SQLiteStorage, cache_key: str) -> int:
+    row = storage.conn.execute(
+        "SELECT access_clock FROM cache WHERE cache_key=?", (cache_key,)
+    ).fetchone()
+    return int(row["access_clock"])
+
+
+def test_deferred_touches_keep_hits_read_only() -> None:
+    """With touch batching, hits do not write until the batch is full."""
+    storage = SQLiteStorage(
+        ":memory:", touch_batch_size=3, touch_flush_interval=3600
+    )
+    flow = example_flow()
+    storage.store("key1", flow)
+    stored_clock = _access_clock(storage, "key1")
+
+    changes = storage.conn.total_changes
+    assert storage.get("key1") is not None
+    assert storage.get("key1") is not None
+    assert storage.conn.total_changes == changes
+    assert _access_clock(storage, "key1") == stored_clock
+
+    # The third hit fills the batch and flushes all pending touches.
+    assert storage.get("key1") is not None
+    assert _access_clock(storage, "key1") > stored_clock
+    storage.close()
+
+
+def test_deferred_touches_flush_after_interval() -> None:
+    storage = SQLiteStorage(
+        ":memory:", touch_batch_size=100, touch_flush_interval=0
+    )
+    storage.store("key1", example_flow())
+    stored_clock = _access_clock(storage, "key1")
+    assert storage.get("key1") is not None
+    assert _access_clock(storage, "key1") > stored_clock
+    storage.close()
+
+
+def test_deferred_touches_flushed_before_eviction() -> None:
+    """Eviction must see touches that are still pending."""
+    storage = SQLiteStorage(
+        ":memory:",
+        max_entries=2,
+        touch_batch_size=100,
+        touch_flush_interval=3600,
+    )
+    flow = example_flow()
+    storage.store("key1", flow)
+    storage.store("key2", flow)
+    assert storage.get("key1") is not None
+    storage.store("key3", flow)
+
+    assert storage.get("key2") is None
+    assert storage.get("key1") is not None
+    storage.close()
+
+
+def test_deferred_touches_flushed_on_close(tmp_path) -> None:
+    db_path = str(tmp_path / "cache.db")
+    storage = SQLiteStorage(
+        db_path, touch_batch_size=100, touch_flush_interval=3600
+    )
+    storage.store("key1", example_flow())
+    stored_clock = _access_clock(storage, "key1")
+    assert storage.get("key1") is not None
+    storage.close()
+
+    reopened = SQLiteStorage(db_path)
+    assert _access_clock(reopened, "key1") > stored_clock
+    reopened.close()
+
+
+def test_compact_entries_round_trip() -> None:
+    storage = SQLiteStorage(":memory:", compact=True)
+    flow = example_flow()
+    storage.upsert("test", flow)
+
+    row = storage.conn.execute(
+        "SELECT flow_format_version FROM cache WHERE cache_key=?",
+        ("test",),
+    ).fetchone()
+    assert row["flow_format_version"] == "mitmcache-compact/1"
+
+    cached = storage.get("test")
+    assert cached is not None
+    assert cached.request.url == flow.request.url
+    assert cached.response is not None
+    assert cached.response.status_code == 200
+    assert cached.response.text == "Hello, World!"
+    storage.close()
+
+
+def test_compact_storage_reads_flow_format_rows(tmp_path) -> None:
+    """Switching to the compact format keeps existing rows readable."""
+    db_path = str(tmp_path / "cache.db")
+    legacy = SQLiteStorage(db_path)
+    legacy.store("legacy", example_flow())
+    legacy.close()
+
+    storage = SQLiteStorage(db_path, compact=True)
+    storage.store("compact", example_flow())
+    for key in ("legacy", "compact"):
+        cached = storage.get(key)
+        assert cached is not None
+        assert cached.response is not None
+        assert cached.response.text == "Hello, World!"
+    storage.close()
+
+
+def test_compact_entries_survive_mitmproxy_upgrade() -> None:
+    """Compact rows do not depend on the running mitmproxy version."""
+    storage = SQLiteStorage(":memory:", compact=True)
+    storage.store("test", example_flow())
+    with patch("mitmcache.storage.sqlite3._MITMPROXY_VERSION", "99.0.0"):
+        cached = storage.get("test")
+    assert cached is not None
+    storage.close()
+
+
+def test_compact_storage_keeps_flows_without_response() -> None:
+    from mitmproxy.test import tflow
+
+    storage = SQLiteStorage(":memory:", compact=True)
+    storage.store("no-response", tflow.tflow(resp=False))
+    cached = storage.get("no-response")
+    assert cached is not None
+    assert cached.response is None
+    storage.close()
+
+
+def test_corrupt_compact_blob_purges_row() -> None:
+    storage = SQLiteStorage(":memory:", compact=True)
+    storage.store("test", example_flow())
+    storage.conn.execute(
+        "UPDATE cache SET flow=? WHERE cache_key=?", (b"MCR\x01", "test")
+    )
+    storage.conn.commit()
+    assert storage.get("test") is None
+    assert storage.entry_count() == 0
+    storage.close()
+
+
+def _large_flow(content_encoding: str | None = None) -> HTTPFlow:
+    flow = example_flow()
+    assert flow.response is not None
+    flow.response.raw_content = b"<p>compressible</p>" * 500
+    if content_encoding is not None:
+        flow.response.headers["content-encoding"] = content_encoding
+    return flow
+
+
+def _stored_codec(storage: SQLiteStorage, cache_key: str) -> str | None:
+    row = storage.conn.execute(
+        "SELECT codec FROM cache WHERE cache_key=?", (cache_key,)
+    ).fetchone()
+    return row["codec"]
+
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_compressed_entries_round_trip(compact: bool) -> None:
+    raw = SQLiteStorage(":memory:", compact=compact)
+    storage = SQLiteStorage(
+        ":memory:",
+        compact=compact,
+        compression="zlib",
+        compression_min_size=4096,
+    )
+    for s in (raw, storage):
+        s.store("large", _large_flow())
+        s.store("small", example_flow())
+
+    assert _stored_codec(storage, "large") == "zlib"
+    assert _stored_codec(storage, "small") is None
+    size = "SELECT length(flow) FROM cache WHERE cache_key='large'"
+    compressed_size = storage.conn.execute(size).fetchone()[0]
+    assert compressed_size < raw.conn.execute(size).fetchone()[0] / 10
+
+    cached = storage.get("large")
+    assert cached is not None
+    assert cached.response is not None
+    assert cached.response.raw_content == b"<p>compressible</p>" * 500
+    raw.close()
+    storage.close()
+
+
+def test_precompressed_bodies_are_stored_raw() -> None:
+    storage = SQLiteStorage(":memory:", compression="zlib")
+    storage.store("gzip", _large_flow(content_encoding="gzip"))
+    storage.store("identity", _large_flow(content_encoding="identity"))
+    assert _stored_codec(storage, "gzip") is None
+    assert _stored_codec(storage, "identity") == "zlib"
+    storage.close()
+
+
+def test_compression_can_be_changed_on_existing_cache(tmp_path) -> None:
+    db_path = str(tmp_path / "cache.db")
+    compressed = SQLiteStorage(db_path, compression="zlib")
+    compressed.store("zlib", _large_flow())
+    compressed.close()
+
+    storage = SQLiteStorage(db_path)
+    storage.store("raw", _large_flow())
+    assert _stored_codec(storage, "raw") is None
+    for key in ("zlib", "raw"):
+        cached = storage.get(key)
+        assert cached is not None
+    storage.close()
+
+
+def test_unknown_stored_codec_purges_row() -> None:
+    storage = SQLiteStorage(":memory:", compression="zlib")
+    storage.store("test", _large_flow())
+    storage.conn.execute("UPDATE cache SET codec='missing'")
+    storage.conn.commit()
+    assert storage.get("test") is None
+    assert storage.entry_count() == 0
+    storage.close()
+
+
+def test_unknown_compression_is_rejected() -> None:
+    with pytest.raises(ValueError, match="unknown compression codec"):
+        SQLiteStorage(":memory:", compression="missing")
+
+
+def _flow_with_body(body: bytes) -> HTTPFlow:
+    flow = example_flow()
+    assert flow.response is not None
+    flow.response.raw_content = body
+    return flow
+
+
+def _refcounts(storage: SQLiteStorage) -> dict[str, int]:
+    rows = storage.conn.execute("SELECT hash, refcount FROM bodies")
+    return {row["hash"]: row["refcount"] for row in rows}
+
+
+def test_dedup_shares_identical_bodies() -> None:
+    storage = SQLiteStorage(":memory:", dedup_bodies=True)
+    storage.store("a", _flow_with_body(b"shared"))
+    storage.store("b", _flow_with_body(b"shared"))
+    storage.store("c", _flow_with_body(b"other"))
+
+    assert sorted(_refcounts(storage).values()) == [1, 2]
+    for key, body in (("a", b"shared"), ("b", b"shared"), ("c", b"other")):
+        cached = storage.get(key)
+        assert cached is not None
+        assert cached.response is not None
+        assert cached.response.raw_content == body
+    row = storage.conn.execute(
+        "SELECT flow FROM cache WHERE cache_key='a'"
+    ).fetchone()
+    assert b"shared" not in row["flow"]
+    storage.close()
+
+
+def test_dedup_releases_body_with_last_reference() -> None:
+    storage = SQLiteStorage(":memory:", dedup_bodies=True)
+    storage.store("a", _flow_with_body(b"shared"))
+    storage.store("b", _flow_with_body(b"shared"))
+
+    storage.purge("a")
+    assert list(_refcounts(storage).values()) == [1]
+    storage.purge("b")
+    assert _refcounts(storage) == {}
+    storage.close()
+
+
+def test_dedup_update_moves_reference() -> None:
+    storage = SQLiteStorage(":memory:", dedup_bodies=True)
+    storage.store("a", _flow_with_body(b"old"))
+    storage.upsert("a", _flow_with_body(b"old"))
+    assert list(_refcounts(storage).values()) == [1]
+
+    storage.upsert("a", _flow_with_body(b"new"))
+    assert list(_refcounts(storage).values()) == [1]
+    cached = storage.get("a")
+    assert cached is not None
+    assert cached.response is not None
+    assert cached.response.raw_content == b"new"
+    storage.close()
+
+
+def test_dedup_eviction_releases_bodies() -> None:
+    storage = SQLiteStorage(":memory:", max_entries=2, dedup_bodies=True)
+    for i in range(5):
+        storage.store(f"key-{i}", _flow_with_body(f"body-{i}".encode()))
+    assert sorted(_refcounts(storage).values()) == [1] * storage.entry_count()
+    storage.close()
+
+
+def test_dedup_reads_inline_rows(tmp_path) -> None:
+    db_path = str(tmp_path / "cache.db")
+    inline = SQLiteStorage(db_path)
+    inline.store("inline", _flow_with_body(b"inline"))
+    inline.close()
+
+    storage = SQLiteStorage(db_path, dedup_bodies=True, compact=True)
+    storage.store("dedup", _flow_with_body(b"dedup"))
+    for key in ("inline", "dedup"):
+        cached = storage.get(key)
+        assert cached is not None
+        assert cached.response is not None
+        assert cached.response.raw_content == key.encode()
+    storage.close()
+
+
+def test_dedup_compresses_bodies() -> None:
+    storage = SQLiteStorage(":memory:", dedup_bodies=True, compression="zlib")
+    storage.store("large", _large_flow())
+    row = storage.conn.execute("SELECT codec FROM bodies").fetchone()
+    assert row["codec"] == "zlib"
+    cached = storage.get("large")
+    assert cached is not None
+    assert cached.response is not None
+    assert cached.response.raw_content == b"<p>compressible</p>" * 500
+    storage.close()
+
+
+def test_dedup_missing_body_purges_row() -> None:
+    storage = SQLiteStorage(":memory:", dedup_bodies=True)
+    storage.store("a", _flow_with_body(b"body"))
+    storage.conn.execute("DROP TRIGGER bodies_ref_delete")
+    storage.conn.execute("DELETE FROM bodies")
+    storage.conn.commit()
+    assert storage.get("a") is None
+    assert storage.entry_count() == 0
+    storage.close()
+
+
+def test_unreferenced_bodies_removed_on_startup(tmp_path) -> None:
+    db_path = str(tmp_path / "cache.db")
+    storage = SQLiteStorage(db_path, dedup_bodies=True)
+    storage.conn.execute(
+        "INSERT INTO bodies (hash, body) VALUES ('orphan', x'00')"
+    )
+    storage.conn.commit()
+    storage.close()
+
+    storage = SQLiteStorage(db_path, dedup_bodies=True)
+    assert _refcounts(storage) == {}
+    storage.close()
+
+
+def _body_files(tmp_path) -> list[str]:
+    root = tmp_path / "cache.db.bodies"
+    return sorted(p.name for p in root.rglob("*") if p.is_file())
+
+
+def test_external_bodies_stored_in_files(tmp_path) -> None:
+    db_path = str(tmp_path / "cache.db")
+    storage = SQLiteStorage(db_path, external_body_size=100)
+    storage.store("large", _flow_with_body(b"x" * 100))
+    storage.store("small", _flow_with_body(b"x" * 99))
+
+    row = storage.conn.execute("SELECT body, path FROM bodies").fetchone()
+    assert row["body"] == b""
+    assert row["path"] is not None
+    assert len(_body_files(tmp_path)) == 1
+    small = storage.conn.execute(
+        "SELECT body_hash FROM cache WHERE cache_key='small'"
+    ).fetchone()
+    assert small["body_hash"] is None
+
+    for key, size in (("large", 100), ("small", 99)):
+        cached = storage.get(key)
+        assert cached is not None
+        assert cached.response is not None
+        assert cached.response.raw_content == b"x" * size
+    storage.close()
+
+
+def test_external_body_files_deleted_with_last_reference(tmp_path) -> None:
+    storage = SQLiteStorage(
+        str(tmp_path / "cache.db"), external_body_size=1, dedup_bodies=True
+    )
+    storage.store("a", _flow_with_body(b"shared"))
+    storage.store("b", _flow_with_body(b"shared"))
+    storage.upsert("c", _flow_with_body(b"replaced"))
+    storage.upsert("c", _flow_with_body(b"other"))
+    assert len(_body_files(tmp_path)) == 2
+
+    storage.purge("a")
+    assert len(_body_files(tmp_path)) == 2
+    storage.purge("b")
+    storage.purge("c")
+    assert _body_files(tmp_path) == []
+    storage.close()
+
+
+def test_external_body_files_deleted_on_eviction(tmp_path) -> None:
+    storage = SQLiteStorage(
+        str(tmp_path / "cache.db"), max_entries=2, external_body_size=1
+    )
+    for i in range(5):
+        storage.store(f"key-{i}", _flow_with_body(f"body-{i}".encode()))
+    assert len(_body_files(tmp_path)) == storage.entry_count()
+    storage.close()
+
+
+def test_rereleased_body_file_kept_when_stored_again(tmp_path) -> None:
+    """A body released and re-stored in one batch keeps its file."""
+    storage = SQLiteStorage(str(tmp_path / "cache.db"), external_body_size=1)
+    storage.store("a", _flow_with_body(b"body"))
+    storage.upsert_many(
+        [("a", _flow_with_body(b"other")), ("b", _flow_with_body(b"body"))]
+    )
+    cached = storage.get("b")
+    assert cached is not None
+    assert cached.response is not None
+    assert cached.response.raw_content == b"body"
+    storage.close()
+
+
+def test_external_bodies_compressed(tmp_path) -> None:
+    storage = SQLiteStorage(
+        str(tmp_path / "cache.db"),
+        external_body_size=1,
+        compression="zlib",
+        compression_min_size=1,
+    )
+    storage.store("large", _large_flow())
+    (path,) = (tmp_path / "cache.db.bodies").rglob("*/*/*")
+    assert path.stat().st_size < 1000
+    cached = storage.get("large")
+    assert cached is not None
+    assert cached.response is not None
+    assert cached.response.raw_content == b"<p>compressible</p>" * 500
+    storage.close()
+
+
+def test_missing_body_file_purges_row(tmp_path) -> None:
+    storage = SQLiteStorage(str(tmp_path / "cache.db"), external_body_size=1)
+    storage.store("a", _flow_with_body(b"body"))
+    for path in (tmp_path / "cache.db.bodies").rglob("*/*/*"):
+        path.unlink()
+    assert storage.get("a") is None
+    assert storage.entry_count() == 0
+    storage.close()
+
+
+def test_unreadable_row_replaced_during_read_is_kept() -> None:
+    storage = SQLiteStorage(":memory:")
+    storage.store("a", example_flow())
+    row = storage.conn.execute("SELECT * FROM cache").fetchone()
+    storage.upsert("a", example_flow())
+    storage._purge_unreadable(row)
+    assert storage.get("a") is not None
+    storage.close()
+
+
+def test_orphaned_body_files_removed_on_startup(tmp_path) -> None:
+    db_path = str(tmp_path / "cache.db")
+    storage = SQLiteStorage(db_path, external_body_size=1)
+    storage.store("a", _flow_with_body(b"kept"))
+    storage.body_files.write("ffff" * 16, b"orphan")  # type: ignore[union-attr]
+    storage.close()
+    assert len(_body_files(tmp_path)) == 2
+
+    storage = SQLiteStorage(db_path)
+    assert len(_body_files(tmp_path)) == 1
+    cached = storage.get("a")
+    assert cached is not None
+    storage.close()
+
+
+def test_external_bodies_need_a_directory() -> None:
+    with pytest.raises(ValueError, match="external bodies"):
+        SQLiteStorage(":memory:", external_body_size=1)
+
+
+def test_file_cache_without_external_bodies_creates_no_directory(
+    tmp_path,
+) -> None:
+    storage = SQLiteStorage(str(tmp_path / "cache.db"))
+    storage.store("a", example_flow())
+    storage.close()
+    assert not (tmp_path / "cache.db.bodies").exists()
+
+
+def _expiring_flow(expires_at: int) -> HTTPFlow:
+    flow = example_flow()
+    flow.metadata[EXPIRES_AT] = expires_at
+    return flow
+
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_get_returns_expiry_and_skips_expired(compact: bool) -> None:
+    storage = SQLiteStorage(":memory:", compact=compact)
+    storage.store("fresh", _expiring_flow(2_000))
+    storage.store("expired", _expiring_flow(1_000))
+    storage.store("forever", example_flow())
+
+    with patch("mitmcache.storage.sqlite3._unix_now", return_value=1_500):
+        fresh = storage.get("fresh")
+        assert storage.get("expired") is None
+        forever = storage.get("forever")
+    assert fresh is not None
+    assert fresh.metadata[EXPIRES_AT] == 2_000
+    assert forever is not None
+    assert EXPIRES_AT not in forever.metadata
+    # Lookups never delete; that is left to the sweeper.
+    assert storage.entry_count() == 3
+    storage.close()
+
+
+def test_get_returns_stale_at() -> None:
+    storage = SQLiteStorage(":memory:")
+    flow = _expiring_flow(2_000)
+    flow.metadata[STALE_AT] = 1_200
+    storage.store("stale", flow)
+    storage.store("fresh", _expiring_flow(2_000))
+
+    with patch("mitmcache.storage.sqlite3._unix_now", return_value=1_500):
+        stale = storage.get("stale")
+        fresh = storage.get("fresh")
+    assert stale is not None
+    assert stale.metadata[STALE_AT] == 1_200
+    assert fresh is not None
+    assert STALE_AT not in fresh.metadata
+    storage.close()
+
+
+def test_revalidate_renews_expiry_without_rewriting_flow() -> None:
+    storage = SQLiteStorage(":memory:", dedup_bodies=True)
+    storage.store("key", _expiring_flow(1_000))
+    before = storage.conn.execute(
+        "SELECT flow, body_hash FROM cache"
+    ).fetchone()
+
+    renewed = _expiring_flow(3_000)
+    renewed.metadata[STALE_AT] = 2_000
+    storage.revalidate("key", renewed)
+    storage.revalidate("missing", renewed)
+
+    row = storage.conn.execute("SELECT * FROM cache").fetchone()
+    assert (row["flow"], row["body_hash"]) == tuple(before)
+    assert (row["expires_at"], row["stale_at"]) == (3_000, 2_000)
+    assert storage.entry_count() == 1
+    with patch("mitmcache.storage.sqlite3._unix_now", return_value=1_500):
+        assert storage.get("key") is not None
+    storage.close()
+
+
+def test_sweep_deletes_expired_entries_in_batches() -> None:
+    storage = SQLiteStorage(":memory:", dedup_bodies=True)
+    for i in range(5):
+        storage.store(f"expired-{i}", _expiring_flow(1_000 + i))
+    storage.store("fresh", _expiring_flow(2_000))
+    storage.store("forever", example_flow())
+
+    with patch("mitmcache.storage.sqlite3._unix_now", return_value=1_500):
+        assert storage.sweep(limit=3) == 3
+        assert storage.sweep(limit=3) == 2
+        assert storage.sweep(limit=3) == 0
+    assert storage.entry_count() == 2
+    assert list(_refcounts(storage).values()) == [2]
+    storage.close()
+
+
+def test_sweep_uses_expires_at_index() -> None:
+    storage = SQLiteStorage(":memory:")
+    plan = storage.conn.execute(
+        "EXPLAIN QUERY PLAN SELECT id FROM cache"
+        " WHERE expires_at <= 0 ORDER BY expires_at LIMIT 10"
+    ).fetchall()
+    assert any("cache_expires_at" in row["detail"] for row in plan)
+    storage.close()
+
+
+def test_background_sweeper_removes_expired_entries(tmp_path) -> None:
+    storage = SQLiteStorage(
+        str(tmp_path / "cache.db"), sweep_interval=0.01, sweep_batch_size=2
+    )
+    for i in range(5):
+        storage.store(f"expired-{i}", _expiring_flow(1))
+    storage.store("forever", example_flow())
+    for _ in range(200):
+        if storage.entry_count() == 1:
+            break
+        time.sleep(0.01)
+    assert storage.entry_count() == 1
+    storage.close()
+    assert storage._sweeper is not None
+    assert not storage._sweeper.is_alive()
+
+
+def _stored_sizes(storage: SQLiteStorage) -> int:
+    row = storage.conn.execute("SELECT SUM(size) FROM cache").fetchone()
+    return int(row[0] or 0)
+
+
+@pytest.mark.parametrize("dedup_bodies", [False, True])
+def test_byte_count_tracks_stored_sizes(dedup_bodies: bool) -> None:
+    storage = SQLiteStorage(":memory:", dedup_bodies=dedup_bodies)
+    storage.store("a", _flow_with_body(b"x" * 1000))
+    storage.store("b", _flow_with_body(b"x" * 1000))
+    assert storage.byte_count() == _stored_sizes(storage) > 2000
+
+    storage.upsert("a", _flow_with_body(b"y" * 10))
+    assert storage.byte_count() == _stored_sizes(storage)
+    storage.purge("b")
+    assert storage.byte_count() == _stored_sizes(storage)
+    storage.purge("a")
+    assert storage.byte_count() == 0
+    storage.close()
+
+
+def test_max_bytes_evicts_oldest_down_to_low_watermark() -> None:
+    probe = SQLiteStorage(":memory:")
+    probe.store("probe", _flow_with_body(b"x" * 1000))
+    entry_size = probe.byte_count()
+    probe.close()
+
+    storage = SQLiteStorage(":memory:", max_bytes=entry_size * 10)
+    for i in range(10):
+        storage.store(f"key-{i}", _flow_with_body(b"x" * 1000))
+    assert storage.entry_count() == 10
+    storage.get("key-0")
+
+    storage.store("key-10", _flow_with_body(b"x" * 1000))
+    # One entry over the limit frees 10% of it plus the excess.
+    assert storage.entry_count() == 9
+    assert storage.byte_count() <= storage.bytes_low_watermark
+    assert storage.get("key-0") is not None
+    assert storage.get("key-1") is None
+    assert storage.get("key-2") is None
+    storage.close()
+
+
+def test_large_entry_evicts_many_small_ones() -> None:
+    storage = SQLiteStorage(":memory:", max_bytes=50_000)
+    for i in range(20):
+        storage.store(f"small-{i}", _flow_with_body(b"s" * 100))
+    storage.store("large", _flow_with_body(b"L" * 40_000))
+    assert storage.byte_count() <= 45_000
+    assert storage.get("large") is not None
+    assert storage.entry_count() < 21
+    storage.close()
+
+
+def test_sizes_backfilled_for_existing_database(tmp_path) -> None:
+    db_path = str(tmp_path / "cache.db")
+    storage = SQLiteStorage(db_path, dedup_bodies=True)
+    storage.store("a", _flow_with_body(b"x" * 1000))
+    storage.store("b", example_flow())
+    expected = storage.byte_count()
+    storage.conn.executescript(
+        """
+        DROP TRIGGER cache_bytes_insert;
+        DROP TRIGGER cache_bytes_delete;
+        DROP TRIGGER cache_bytes_update;
+        ALTER TABLE cache DROP COLUMN size;
+        ALTER TABLE bodies DROP COLUMN size;
+        ALTER TABLE cache_stats DROP COLUMN bytes;
+        """
+    )
+    storage.close()
+
+    storage = SQLiteStorage(db_path, max_bytes=1 << 20)
+    assert storage.byte_count() == expected
+    storage.close()
+
+
+def _hits(storage: SQLiteStorage) -> dict[str, int]:
+    rows = storage.conn.execute("SELECT cache_key, hits FROM cache")
+    return {row["cache_key"]: row["hits"] for row in rows}
+
+
+def test_lfu_evicts_least_frequently_hit() -> None:
+    storage = SQLiteStorage(":memory:", max_entries=3, eviction_policy="lfu")
+    for key in ("a", "b", "c"):
+        storage.store(key, example_flow())
+    for key in ("a", "a", "b", "b", "c"):
+        assert storage.get(key) is not None
+
+    storage.store("d", example_flow())
+    storage.store("e", example_flow())
+    # New entries start at 1. d was evicted first, which raised the
+    # starting count to 2 and made c, the older of c and e, the next victim.
+    assert _hits(storage) == {"a": 3, "b": 3, "e": 2}
+    storage.close()
+
+
+def test_lfu_new_entries_start_at_the_evicted_count() -> None:
+    storage = SQLiteStorage(":memory:", max_entries=2, eviction_policy="lfu")
+    storage.store("old", example_flow())
+    for _ in range(5):
+        storage.get("old")
+    storage.store("a", example_flow())
+    for key in "bcdefgh":
+        storage.store(key, example_flow())
+        storage.get(key)
+    # Every eviction raises the starting count, so recent entries
+    # eventually outrank the formerly popular one.
+    assert "old" not in _hits(storage)
+    storage.close()
+
+    storage = SQLiteStorage(":memory:", max_entries=2, eviction_policy="lfu")
+    storage.store("a", example_flow())
+    storage.get("a")
+    storage.store("b", example_flow())
+    storage.store("c", example_flow())
+    assert _hits(storage) == {"a": 2, "c": 1}
+    storage.store("d", example_flow())
+    assert _hits(storage) == {"a": 2, "d": 2}
+    storage.close()
+
+
+def test_fifo_ignores_accesses() -> None:
+    storage = SQLiteStorage(":memory:", max_entries=2, eviction_policy="fifo")
+    storage.store("a", example_flow())
+    storage.store("b", example_flow())
+    storage.get("a")
+    storage.store("c", example_flow())
+    assert storage.get("a") is None
+    assert storage.get("b") is not None
+    storage.close()
+
+
+def test_unknown_policies_are_rejected() -> None:
+    with pytest.raises(ValueError, match="eviction policy"):
+        SQLiteStorage(":memory:", eviction_policy="random")
+    with pytest.raises(ValueError, match="admission policy"):
+        SQLiteStorage(":memory:", admission="never")
+
+
+def _request(storage: SQLiteStorage, key: str) -> None:
+    """Look key up and store it on a miss, as the addon does."""
+    if storage.get(key) is None:
+        storage.upsert(key, example_flow())
+
+
+def test_tinylfu_keeps_one_hit_wonders_out_of_a_full_cache() -> None:
+    storage = SQLiteStorage(":memory:", max_entries=10, admission="tinylfu")
+    hot = [f"hot-{i}" for i in range(9)]
+    for key in hot * 3:
+        _request(storage, key)
+    assert storage.entry_count() == 9
+
+    # A scan of keys requested once cannot displace the working set.
+    for i in range(50):
+        _request(storage, f"scan-{i}")
+    assert None not in [storage.get(key) for key in hot]
+
+    # A key requested more often than the victim is admitted.
+    for _ in range(5):
+        storage.get("rising")
+    storage.upsert("rising", example_flow())
+    assert storage.get("rising") is not None
+    storage.close()
+
+
+def test_rejected_and_missing_keys_leave_no_bodies(tmp_path) -> None:
+    storage = SQLiteStorage(
+        str(tmp_path / "cache.db"),
+        max_entries=10,
+        admission="tinylfu",
+        dedup_bodies=True,
+        external_body_size=100,
+    )
+    for i in range(9):
+        storage.upsert(f"key-{i}", _flow_with_body(f"body-{i}".encode()))
+    # The cache is full, so admission rejects keys never looked up.
+    for i in range(3):
+        storage.upsert(f"scan-{i}", _flow_with_body(b"x" * 100 + bytes([i])))
+    storage.update("missing", _flow_with_body(b"y" * 100))
+
+    assert storage.entry_count() == 9
+    orphans = storage.conn.execute(
+        "SELECT COUNT(*) FROM bodies WHERE refcount <= 0"
+    ).fetchone()[0]
+    assert orphans == 0
+    assert _body_files(tmp_path) == []
+    storage.close()
+
+
+def test_deferred_touches_count_hits() -> None:
+    storage = SQLiteStorage(":memory:", touch_batch_size=10)
+    storage.store("a", example_flow())
+    for _ in range(3):
+        storage.get("a")
+    storage.flush_touches()
+    row = storage.conn.execute("SELECT hits FROM cache").fetchone()
+    assert row["hits"] == 3
+    storage.close()
+
+
+def test_touch_many_counts_hits_served_elsewhere() -> None:
+    storage = SQLiteStorage(":memory:", max_entries=10, admission="tinylfu")
+    storage.store("a", example_flow())
+    storage.store("b", example_flow())
+    storage.touch_many([("a", 4)])
+
+    rows = storage.conn.execute(
+        "SELECT cache_key, hits FROM cache ORDER BY access_clock"
+    ).fetchall()
+    assert [(row["cache_key"], row["hits"]) for row in rows] == [
+        ("b", 0),
+        ("a", 4),
+    ]
+    assert storage.sketch is not None
+    assert storage.sketch.estimate("a") == 4
+    storage.close()
+
+
+def _store_outdated(
+    storage: SQLiteStorage, cache_key: str, flow_format: int = 20
+) -> None:
+    """Store an entry as an older mitmproxy would have written it."""
+    storage.store(cache_key, example_flow())
+    state = example_flow().get_state()
+    state["version"] = flow_format
+    storage.conn.execute(
+        "UPDATE cache SET flow = ?, flow_format_version = ?"
+        " WHERE cache_key = ?",
+        (tnetstring.dumps(state), "0.0.0", cache_key),
+    )
+    storage.conn.commit()
+
+
+def test_migrate_converts_outdated_rows_in_batches() -> None:
+    storage = SQLiteStorage(":memory:")
+    for i in range(5):
+        _store_outdated(storage, f"old-{i}")
+    storage.store("current", example_flow())
+    progress: list[tuple[int, int]] = []
+
+    def report(done: int, total: int) -> None:
+        progress.append((done, total))
+
+    assert storage.migrate(batch_size=2, progress=report) == (5, 0)
+
+    assert progress == [(2, 5), (4, 5), (5, 5)]
+    versions = storage.conn.execute(
+        "SELECT DISTINCT flow_format_version FROM cache"
+    ).fetchall()
+    assert [row[0] for row in versions] == [
+        importlib.metadata.version("mitmproxy")
+    ]
+    cached = storage.get("old-3")
+    assert cached is not None
+    assert cached.response is not None
+    assert cached.response.text == "Hello, World!"
+    assert storage.byte_count() == _stored_sizes(storage)
+    assert storage.migrate() == (0, 0)
+    storage.close()
+
+
+def test_migrate_drops_unconvertible_rows_together() -> None:
+    storage = SQLiteStorage(":memory:", compact=True)
+    _store_outdated(storage, "old")
+    _store_outdated(storage, "too-new", flow_format=10_000)
+    storage.store("corrupt", example_flow())
+    storage.conn.execute(
+        "UPDATE cache SET flow = ?, flow_format_version = NULL"
+        " WHERE cache_key = ?",
+        (b"not-a-flow", "corrupt"),
+    )
+    storage.conn.commit()
+
+    with patch.object(
+        storage, "_delete_ids", wraps=storage._delete_ids
+    ) as delete:
+        assert storage.migrate(batch_size=1) == (1, 2)
+
+    assert delete.call_count == 1
+    assert storage.entry_count() == 1
+    assert _stored_codec(storage, "old") is None
+    row = storage.conn.execute(
+        "SELECT flow_format_version FROM cache WHERE cache_key = 'old'"
+    ).fetchone()
+    assert row[0] == "mitmcache-compact/1"
+    assert storage.get("old") is not None
+    storage.close()
+
+
+def test_migrate_keeps_shared_bodies() -> None:
+    storage = SQLiteStorage(":memory:", dedup_bodies=True)
+    storage.store("key", _flow_with_body(b"B" * 4096))
+    storage.conn.execute("UPDATE cache SET flow_format_version = '0.0.0'")
+    storage.conn.commit()
+
+    assert storage.migrate() == (1, 0)
+
+    cached = storage.get("key")
+    assert cached is not None
+    assert cached.response is not None
+    assert cached.response.content == b"B" * 4096
+    assert storage.byte_count() == _stored_sizes(storage)
+    assert _refcounts(storage) == {hashlib.sha256(b"B" * 4096).hexdigest(): 1}
+    storage.close()
+
+
+def _expired_flow() -> HTTPFlow:
+    flow = example_flow()
+    flow.metadata[EXPIRES_AT] = int(time.time()) - 1
+    return flow
+
+
+def test_entries_in_key_order_and_batches() -> None:
+    storage = SQLiteStorage(":memory:")
+    for key in ("b-2", "a-1", "b-1", "", "c-1"):
+        storage.upsert(key, example_flow())
+    storage.upsert("b-expired", _expired_flow())
+
+    assert [key for key, _ in storage.entries(batch_size=2)] == [
+        "",
+        "a-1",
+        "b-1",
+        "b-2",
+        "c-1",
+    ]
+    entries = list(storage.entries("b-", batch_size=1))
+    assert [key for key, _ in entries] == ["b-1", "b-2"]
+    assert entries[0][1].response is not None
+    assert entries[0][1].response.text == "Hello, World!"
+    storage.close()
+
+
+def test_entries_do_not_count_as_hits() -> None:
+    storage = SQLiteStorage(":memory:")
+    storage.upsert("key", example_flow())
+    list(storage.entries())
+    assert _hits(storage) == {"key": 0}
+    storage.close()
+
+
+def test_snapshot_copies_a_consistent_image(tmp_path) -> None:
+    path = str(tmp_path / "cache.db")
+    storage = SQLiteStorage(path, wal=True)
+    storage.upsert_many((f"key-{i}", example_flow()) for i in range(200))
+    writer = SQLiteStorage(path, wal=True)
+    steps: list[tuple[int, int]] = []
+
+    def write_between_steps(copied: int, total: int) -> None:
+        # Writes during the copy neither block it nor restart it.
+        writer.upsert(f"during-{len(steps)}", example_flow())
+        steps.append((copied, total))
+
+    storage.snapshot(str(tmp_path / "copy.db"), 1, write_between_steps)
+
+    assert len(steps) > 1
+    assert steps[-1][0] == steps[-1][1]
+    assert not (tmp_path / "copy.db.partial").exists()
+    copy = SQLiteStorage(str(tmp_path / "copy.db"))
+    assert copy.entry_count() == 200
+    assert copy.conn.execute("PRAGMA integrity_check").fetchone()[0] == "ok"
+    assert copy.get("key-199") is not None
+    assert writer.entry_count() == 200 + len(steps)
+    for opened in (copy, writer, storage):
+        opened.close()
+
+
+def test_snapshot_without_wal_copies_in_steps(tmp_path) -> None:
+    path = str(tmp_path / "cache.db")
+    storage = SQLiteStorage(path)
+    storage.upsert_many((f"key-{i}", example_flow()) for i in range(200))
+    writer = SQLiteStorage(path, busy_timeout=0.1, lock_retries=0)
+    steps: list[tuple[int, int]] = []
+
+    def write_between_steps(copied: int, total: int) -> None:
+        # The database is not locked between steps; the first writes
+        # restart the copy.
+        if len(steps) < 3:
+            writer.upsert(f"during-{len(steps)}", example_flow())
+        steps.append((copied, total))
+
+    storage.snapshot(str(tmp_path / "copy.db"), 1, write_between_steps)
+
+    copy = SQLiteStorage(str(tmp_path / "copy.db"))
+    assert copy.entry_count() == 203
+    assert copy.conn.execute("PRAGMA integrity_check").fetchone()[0] == "ok"
+    for opened in (copy, writer, storage):
+        opened.close()
+
+
+def test_snapshot_without_wal_gives_up_after_restarts(tmp_path) -> None:
+    path = str(tmp_path / "cache.db")
+    storage = SQLiteStorage(path)
+    storage.upsert_many((f"key-{i}", example_flow()) for i in range(200))
+    writer = SQLiteStorage(path, busy_timeout=0.1, lock_retries=0)
+    written = itertools.count()
+
+    def write(copied: int, total: int) -> None:
+        writer.upsert(f"during-{next(written)}", example_flow())
+
+    with pytest.raises(sqlite3.OperationalError, match="restarted"):
+        storage.snapshot(str(tmp_path / "copy.db"), 1, write, restarts=3)
+
+    assert not (tmp_path / "copy.db").exists()
+    assert not (tmp_path / "copy.db.partial").exists()
+    assert writer.entry_count() == 200 + next(written)
+    writer.close()
+    storage.close()
+
+
+def test_snapshot_without_wal_and_in_memory(tmp_path) -> None:
+    for source in (str(tmp_path / "cache.db"), ":memory:"):
+        storage = SQLiteStorage(source)
+        storage.upsert("key", example_flow())
+        storage.snapshot(str(tmp_path / "copy.db"))
+        storage.close()
+
+        copy = SQLiteStorage(str(tmp_path / "copy.db"))
+        assert copy.get("key") is not None
+        copy.close()
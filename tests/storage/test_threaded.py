@@ -0,0 +1,129 @@
+from __future__ import annotations
+
+import asyncio
+import threading
+import time
+
+from mitmcache.storage.sqlite3 import SQLiteStorage
+from mitmcache.storage.threaded import ThreadedStorage
+
+from ..example_flow import example_flow
+
+
+class SlowStorage:
+    """Storage whose operations block and record the calling thread."""
+
+    def __init__(self, delay: float) -> None:
+        self.delay = delay
+        self.threads: dict[str, str] = {}
+
+    def _call(self, name: str) -> None:
+        self.threads[name] = threading.current_thread().name
+        time.sleep(self.delay)
+
+    def get(self, cache_key):
+        self._call("get")
+        return None
+
+    def store(self, cache_key, flow):
+        self._call("store")
+
+    def update(self, cache_key, flow):
+        self._call("update")
+
+    def upsert(self, cache_key, flow):
+        self._call("upsert")
+
+    def purge(self, cache_key):
+        self._call("purge")
+
+    def close(self):
+        self._call("close")
+
+
+def test_threaded_storage_round_trip(tmp_path) -> None:
+    sqlite = SQLiteStorage(str(tmp_path / "cache.db"), threaded=True)
+    storage = ThreadedStorage(sqlite)
+
+    async def scenario() -> None:
+        await storage.upsert("key", example_flow())
+        cached = await storage.get("key")
+        assert cached is not None
+        assert cached.response is not None
+        assert cached.response.text == "Hello, World!"
+        await storage.purge("key")
+        assert await storage.get("key") is None
+
+    asyncio.run(scenario())
+    storage.close()
+
+
+def test_threaded_storage_runs_reads_and_writes_on_own_threads() -> None:
+    slow = SlowStorage(delay=0)
+    storage = ThreadedStorage(slow)
+
+    async def scenario() -> None:
+        await storage.get("key")
+        await storage.upsert("key", example_flow())
+
+    asyncio.run(scenario())
+    storage.close()
+    assert slow.threads["get"].startswith("mitmcache-read")
+    assert slow.threads["upsert"].startswith("mitmcache-write")
+    assert slow.threads["close"].startswith("mitmcache-write")
+
+
+def test_threaded_storage_does_not_block_event_loop() -> None:
+    """Unrelated coroutines keep running while storage I/O is slow."""
+    storage = ThreadedStorage(SlowStorage(delay=0.2))
+
+    async def ticker() -> int:
+        ticks = 0
+        deadline = time.monotonic() + 0.15
+        while time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+            ticks += 1
+        return ticks
+
+    async def scenario() -> int:
+        _, _, ticks = await asyncio.gather(
+            storage.get("key"),
+            storage.upsert("key", example_flow()),
+            ticker(),
+        )
+        return ticks
+
+    assert asyncio.run(scenario()) >= 5
+    storage.close()
+
+
+def test_threaded_sqlite_uses_separate_read_connection(tmp_path) -> None:
+    storage = SQLiteStorage(str(tmp_path / "cache.db"), threaded=True)
+    assert storage.read_conn is not storage.conn
+    storage.close()
+
+    memory = SQLiteStorage(":memory:", threaded=True)
+    assert memory.read_conn is memory.conn
+    memory.close()
+
+
+def test_threaded_storage_writes_keys_on_their_lane(tmp_path) -> None:
+    """With lanes, writes of one key stay on one thread, in order."""
+    sqlite = SQLiteStorage(str(tmp_path / "cache.db"), threaded=True)
+    storage = ThreadedStorage(sqlite, lanes=4)
+    lanes = {
+        key: storage._lane(storage._writers, key)
+        for key in (f"key-{i}" for i in range(40))
+    }
+    assert len(set(lanes.values())) == 4
+
+    async def scenario() -> None:
+        await asyncio.gather(
+            *(storage.upsert(key, example_flow()) for key in lanes)
+        )
+        await storage.purge("key-0")
+        assert await storage.get("key-0") is None
+        assert await storage.get("key-1") is not None
+
+    asyncio.run(scenario())
+    storage.close()
@@ -0,0 +1,169 @@
+from __future__ import annotations
+
+import threading
+
+import pytest
+
+from mitmcache.storage.memory import MemoryStorage
+from mitmcache.storage.sqlite3 import SQLiteStorage
+from mitmcache.storage.write_behind import WriteBehindStorage
+
+from ..example_flow import example_flow
+
+
+class BatchRecordingStorage:
+    """SQLiteStorage wrapper that records each upsert_many batch."""
+
+    def __init__(self, path: str = ":memory:") -> None:
+        self.storage = SQLiteStorage(path, threaded=True)
+        self.batches: list[list[str]] = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def get(self, cache_key):
+        return self.storage.get(cache_key)
+
+    def store(self, cache_key, flow):
+        self.storage.store(cache_key, flow)
+
+    def update(self, cache_key, flow):
+        self.storage.update(cache_key, flow)
+
+    def upsert(self, cache_key, flow):
+        self.upsert_many([(cache_key, flow)])
+
+    def upsert_many(self, entries):
+        self.release.wait()
+        entries = list(entries)
+        self.batches.append([cache_key for cache_key, _ in entries])
+        self.storage.upsert_many(entries)
+
+    def purge(self, cache_key):
+        self.storage.purge(cache_key)
+
+    def close(self):
+        self.storage.close()
+
+
+def test_upserts_are_committed_in_batches() -> None:
+    backend = BatchRecordingStorage()
+    backend.release.clear()
+    storage = WriteBehindStorage(backend, batch_size=10, flush_interval=0.2)
+    flow = example_flow()
+    # The first ten entries fill a batch while the writer is blocked in
+    # upsert_many; the eleventh is written as a batch of its own.
+    for i in range(11):
+        storage.upsert(f"key{i}", flow)
+    backend.release.set()
+    storage.flush()
+
+    assert [len(batch) for batch in backend.batches] == [10, 1]
+    storage.close()
+
+
+def test_queued_entries_are_readable_before_commit() -> None:
+    backend = BatchRecordingStorage()
+    backend.release.clear()
+    storage = WriteBehindStorage(backend, batch_size=10, flush_interval=0.05)
+    storage.upsert("key", example_flow())
+
+    cached = storage.get("key")
+    assert cached is not None
+    assert cached.response is not None
+    assert cached.response.text == "Hello, World!"
+    assert backend.batches == []
+
+    backend.release.set()
+    storage.close()
+
+
+def test_upsert_snapshots_flow() -> None:
+    """Changes made to the flow after upsert() must not be cached."""
+    backend = BatchRecordingStorage()
+    storage = WriteBehindStorage(backend, flush_interval=0)
+    flow = example_flow()
+    storage.upsert("key", flow)
+    assert flow.response is not None
+    flow.response.text = "mutated"
+    storage.flush()
+
+    cached = storage.get("key")
+    assert cached is not None and cached.response is not None
+    assert cached.response.text == "Hello, World!"
+    storage.close()
+
+
+def test_close_drains_queue(tmp_path) -> None:
+    db_path = str(tmp_path / "cache.db")
+    storage = WriteBehindStorage(
+        SQLiteStorage(db_path, threaded=True),
+        batch_size=1000,
+        flush_interval=0.05,
+    )
+    flow = example_flow()
+    for i in range(50):
+        storage.upsert(f"key{i}", flow)
+    storage.close()
+
+    reopened = SQLiteStorage(db_path)
+    assert reopened.entry_count() == 50
+    reopened.close()
+
+
+def test_writes_after_close_go_straight_to_the_storage() -> None:
+    backend = MemoryStorage()
+    storage = WriteBehindStorage(backend)
+    storage.close()
+
+    def write() -> None:
+        storage.upsert("key", example_flow())
+        storage.store("other", example_flow())
+        storage.flush()
+
+    writer = threading.Thread(target=write, daemon=True)
+    writer.start()
+    writer.join(timeout=5)
+    assert not writer.is_alive()
+    assert backend.get("key") is not None
+    assert backend.get("other") is not None
+
+
+def test_full_queue_drops_writes_with_drop_policy() -> None:
+    backend = BatchRecordingStorage()
+    backend.release.clear()
+    storage = WriteBehindStorage(
+        backend,
+        batch_size=1,
+        flush_interval=0,
+        queue_size=1,
+        queue_full="drop",
+    )
+    flow = example_flow()
+    storage.upsert("taken", flow)
+    # Wait until the writer holds "taken", so the queue is empty again.
+    while storage._queue.qsize():
+        pass
+    storage.upsert("queued", flow)
+    storage.upsert("dropped", flow)
+    assert storage.get("dropped") is None
+
+    backend.release.set()
+    storage.flush()
+    assert storage.get("queued") is not None
+    assert storage.get("dropped") is None
+    storage.close()
+
+
+def test_purge_waits_for_queued_writes() -> None:
+    storage = WriteBehindStorage(
+        BatchRecordingStorage(), batch_size=10, flush_interval=0.05
+    )
+    storage.upsert("key", example_flow())
+    storage.purge("key")
+    assert storage.get("key") is None
+    storage.close()
+
+
+def test_unknown_queue_full_policy_is_rejected() -> None:
+    with pytest.raises(ValueError, match="queue_full"):
+        WriteBehindStorage(BatchRecordingStorage(), queue_full="spill")
@@ -0,0 +1,232 @@
+from __future__ import annotations
+
+import itertools
+import sqlite3
+import threading
+import time
+
+import pytest
+from mitmproxy import exceptions
+from mitmproxy.test import taddons, tflow, tutils
+
+from mitmcache import backup, cache, prewarm
+from mitmcache.storage.memory import MemoryStorage
+from mitmcache.storage.memory_tier import MemoryTierStorage
+from mitmcache.storage.sharded import ShardedStorage
+from mitmcache.storage.sqlite3 import SQLiteStorage
+from mitmcache.storage.write_behind import WriteBehindStorage
+
+from .example_flow import example_flow
+
+
+def _flow(host: str, path: str, age: float = 0):
+    flow = tflow.tflow(
+        req=tutils.treq(host=host, path=path.encode(), headers=[]),
+        resp=True,
+    )
+    assert flow.response is not None
+    flow.response.timestamp_start = time.time() - age
+    return flow
+
+
+def _fill(storage) -> None:
+    storage.upsert("api:1", _flow("example.com", "/1"))
+    storage.upsert("api:2", _flow("other.example", "/2"))
+    storage.upsert("api:old", _flow("example.com", "/old", age=7200))
+    storage.upsert("web:1", _flow("example.com", "/web"))
+
+
+def _exported(path) -> dict[str, str]:
+    return {
+        flow.metadata["Mitm-Cache-Key"]: flow.request.path
+        for flow in prewarm.read_flows(str(path))
+    }
+
+
+def test_export_filters_by_prefix_host_and_age(tmp_path) -> None:
+    storage = MemoryStorage()
+    _fill(storage)
+    target = tmp_path / "export.mitm"
+
+    count = backup.export_flows(
+        backup.cache_entries(storage, "api:"),
+        str(target),
+        "Mitm-Cache-Key",
+        lambda flow: backup.matches(flow, "Example.com", 3600),
+    )
+
+    assert count == 1
+    assert _exported(target) == {"api:1": "/1"}
+    assert not (tmp_path / "export.mitm.partial").exists()
+
+
+def test_export_reaches_below_wrappers(tmp_path) -> None:
+    shards = [
+        SQLiteStorage(str(tmp_path / f"cache-{i}.db"), threaded=True)
+        for i in range(2)
+    ]
+    storage = MemoryTierStorage(
+        WriteBehindStorage(ShardedStorage(shards)), max_bytes=1 << 20
+    )
+    _fill(storage)
+
+    # Queued writes are written out before the entries are read.
+    entries = backup.cache_entries(storage)
+    backup.export_flows(entries, str(tmp_path / "all.mitm"), "Key")
+
+    keys = {
+        flow.metadata["Key"]
+        for flow in prewarm.read_flows(str(tmp_path / "all.mitm"))
+    }
+    assert keys == {"api:1", "api:2", "api:old", "web:1"}
+    targets = backup.snapshot_targets(storage, str(tmp_path / "copy.db"))
+    assert [path for _, path in targets] == [
+        str(tmp_path / "copy-0.db"),
+        str(tmp_path / "copy-1.db"),
+    ]
+    storage.close()
+
+
+def test_memory_cache_cannot_be_snapshotted() -> None:
+    with pytest.raises(ValueError, match="only SQLite"):
+        backup.snapshot_targets(MemoryStorage(), "copy.db")
+
+
+def test_export_round_trips_through_prewarm(tmp_path) -> None:
+    source = str(tmp_path / "cache.db")
+    storage = SQLiteStorage(source)
+    _fill(storage)
+    storage.close()
+    dump = str(tmp_path / "export.mitm")
+
+    backup.main(["export", source, dump, "--host", "example.com"])
+    prewarm.main([dump, "--cache-file", str(tmp_path / "imported.db")])
+
+    imported = SQLiteStorage(str(tmp_path / "imported.db"))
+    assert imported.entry_count() == 3
+    cached = imported.get("web:1")
+    assert cached is not None
+    assert cached.request.path == "/web"
+    imported.close()
+
+
+def test_snapshot_cli(tmp_path) -> None:
+    source = str(tmp_path / "cache.db")
+    storage = SQLiteStorage(source, wal=True)
+    storage.upsert("key", example_flow())
+
+    backup.main(["snapshot", source, str(tmp_path / "copy.db")])
+
+    copy = SQLiteStorage(str(tmp_path / "copy.db"))
+    assert copy.get("key") is not None
+    copy.close()
+    storage.close()
+
+
+def test_snapshot_and_export_commands(tmp_path) -> None:
+    with taddons.context() as tctx:
+        addon = tctx.script("inject.py").addons[0]
+        tctx.configure(
+            addon, cache_file=str(tmp_path / "cache.db"), cache_wal=True
+        )
+        addon.configure({"cache_file"})
+        _fill(addon.storage)
+
+        tctx.command(addon.snapshot, str(tmp_path / "copy.db"))
+        tctx.command(addon.export, str(tmp_path / "web.mitm"), "web:")
+        # done() gives the background jobs time to finish.
+        addon.done()
+
+    copy = SQLiteStorage(str(tmp_path / "copy.db"))
+    assert copy.entry_count() == 4
+    copy.close()
+    assert _exported(tmp_path / "web.mitm") == {"web:1": "/web"}
+
+
+@pytest.mark.parametrize("in_memory", [False, True])
+def test_commands_read_the_cache_from_their_thread(
+    tmp_path, in_memory: bool
+) -> None:
+    """The jobs must not depend on the sweeper making the storage
+    thread-safe."""
+    cache_file = ":memory:" if in_memory else str(tmp_path / "cache.db")
+    with taddons.context() as tctx:
+        addon = tctx.script("inject.py").addons[0]
+        tctx.configure(
+            addon,
+            cache_file=cache_file,
+            cache_backend="sqlite",
+            cache_sweep_interval=0,
+        )
+        addon.configure({"cache_file"})
+        _fill(addon.storage)
+
+        tctx.command(addon.snapshot, str(tmp_path / "copy.db"))
+        tctx.command(addon.export, str(tmp_path / "all.mitm"))
+        addon.done()
+
+    copy = SQLiteStorage(str(tmp_path / "copy.db"))
+    assert copy.entry_count() == 4
+    copy.close()
+    assert len(_exported(tmp_path / "all.mitm")) == 4
+
+
+def test_snapshot_command_needs_sqlite() -> None:
+    with taddons.context() as tctx:
+        addon = tctx.script("inject.py").addons[0]
+        with pytest.raises(exceptions.CommandError, match="only SQLite"):
+            tctx.command(addon.snapshot, "copy.db")
+        addon.done()
+
+
+def test_storage_change_does_not_wait_for_jobs(tmp_path) -> None:
+    with taddons.context() as tctx:
+        addon = tctx.script("inject.py").addons[0]
+        tctx.configure(addon, cache_file=str(tmp_path / "cache.db"))
+        addon.configure({"cache_file"})
+        replaced = addon.storage
+        release = threading.Event()
+        addon._start_job("prewarm", lambda job: release.wait())
+
+        tctx.configure(addon, cache_max_entries=10)
+        addon.configure({"cache_max_entries"})
+
+        assert addon.storage is not replaced
+        # The job may still use the replaced storage.
+        assert replaced.entry_count() == 0
+        release.set()
+        for job in addon.jobs:
+            job.join()
+        with pytest.raises(sqlite3.ProgrammingError):
+            replaced.entry_count()
+        addon.done()
+
+
+def test_done_cancels_jobs_that_do_not_finish(monkeypatch) -> None:
+    monkeypatch.setattr(cache, "JOB_SHUTDOWN_TIMEOUT", 0.05)
+    batches: list[int] = []
+    with taddons.context() as tctx:
+        addon = tctx.script("inject.py").addons[0]
+        addon._start_job(
+            "export",
+            lambda job: batches.extend(job.until_cancelled(itertools.count())),
+        )
+        addon.done()
+        assert not any(job.is_alive() for job in addon.jobs)
+    assert batches
+
+
+def test_cancelled_export_leaves_no_file(tmp_path) -> None:
+    storage = MemoryStorage()
+    _fill(storage)
+    target = str(tmp_path / "export.mitm")
+
+    def export(job: backup.Job) -> None:
+        job.cancel()
+        entries = job.until_cancelled(backup.cache_entries(storage))
+        backup.export_flows(entries, target, "Key")
+
+    backup.Job("export", export).join()
+
+    assert not (tmp_path / "export.mitm").exists()
+    assert not (tmp_path / "export.mitm.partial").exists()
@@ -1,8 +1,12 @@
 from __future__ import annotations
 
+import asyncio
+import time
+
 import pytest
 from mitmproxy import exceptions
 from mitmproxy.addons import script
+from mitmproxy.http import HTTPFlow
 from mitmproxy.test import taddons, tflow, tutils
 
 from mitmcache.cache import Cache, _sanitize_for_log
@@ -644,6 +648,22 @@ def test_storage_factory_invalid_max_entries_defaults_to_unlimited() -> None:
     mock_options = MagicMock()
     mock_options.cache_max_entries = "not-an-int"
     mock_options.cache_file = ":memory:"
+    mock_options.cache_write_behind = False
+    mock_options.cache_compression = "none"
+    mock_options.cache_dedup_bodies = False
+    mock_options.cache_external_body_size = 0
+    mock_options.cache_body_dir = ""
+    mock_options.cache_sweep_interval = 0.0
+    mock_options.cache_sweep_batch_size = 1000
+    mock_options.cache_max_bytes = 0
+    mock_options.cache_eviction_policy = "lru"
+    mock_options.cache_admission = "always"
+    mock_options.cache_shards = 1
+    mock_options.cache_wal = False
+    mock_options.cache_busy_timeout = 5.0
+    mock_options.cache_lock_retries = 5
+    mock_options.cache_migrate = True
+    mock_options.cache_backend = "auto"
 
     with patch("mitmcache.storage.factory.ctx") as mock_ctx:
         mock_ctx.options = mock_options
@@ -651,3 +671,431 @@ def test_storage_factory_invalid_max_entries_defaults_to_unlimited() -> None:
 
     assert storage is not None
     storage.close()
+
+
+def test_async_storage_hooks_return_awaitables(tmp_path) -> None:
+    """With cache_async_storage the hooks hand their storage I/O to
+    mitmproxy as coroutines instead of blocking the event loop."""
+
+    async def scenario() -> None:
+        with taddons.context() as tctx:
+            addon = tctx.script("inject.py").addons[0]
+            tctx.configure(
+                addon,
+                cache_file=str(tmp_path / "cache.db"),
+                cache_async_storage=True,
+            )
+            addon.configure({"cache_file", "cache_async_storage"})
+            assert addon.async_storage is not None
+
+            flow = tflow.tflow(
+                req=tutils.treq(
+                    method=b"GET",
+                    path=b"/",
+                    host=b"localhost:65535",
+                    headers=[(b"Mitm-Cache-Key", b"async-key")],
+                ),
+                resp=tutils.tresp(content=b"Hello, World!"),
+            )
+            await addon.request(flow)
+            assert flow.metadata[addon.cache_from_origin] is True
+            await addon.response(flow)
+
+            flow_hit = tflow.tflow(
+                req=tutils.treq(
+                    method=b"GET",
+                    path=b"/",
+                    host=b"localhost:65535",
+                    headers=[(b"Mitm-Cache-Key", b"async-key")],
+                ),
+                resp=False,
+            )
+            await addon.request(flow_hit)
+            assert flow_hit.response is not None
+            assert flow_hit.response.text == "Hello, World!"
+            assert flow_hit.metadata[addon.cache_from_origin] is False
+            assert addon.response(flow_hit) is None
+
+            # Keyless requests never touch storage and need no awaiting.
+            flow_nokey = tflow.tflow(resp=False)
+            assert addon.request(flow_nokey) is None
+            addon.done()
+
+    asyncio.run(scenario())
+
+
+def _keyed_flow(key: bytes, resp: object = False) -> HTTPFlow:
+    return tflow.tflow(
+        req=tutils.treq(
+            method=b"GET",
+            path=b"/",
+            host=b"localhost:65535",
+            headers=[(b"Mitm-Cache-Key", key)],
+        ),
+        resp=resp,
+    )
+
+
+def test_single_flight_coalesces_concurrent_misses() -> None:
+    async def scenario() -> None:
+        with taddons.context() as tctx:
+            addon = tctx.script("inject.py").addons[0]
+            tctx.configure(addon, cache_single_flight=True)
+            storage = TrackingStorage(addon.storage)
+            addon.storage = storage
+
+            leader = _keyed_flow(b"sf-key")
+            assert addon.request(leader) is None
+            assert leader.metadata[addon.cache_from_origin] is True
+
+            waiters = [_keyed_flow(b"sf-key") for _ in range(5)]
+            tasks = [
+                asyncio.ensure_future(addon.request(flow)) for flow in waiters
+            ]
+            await asyncio.sleep(0)
+            assert not any(task.done() for task in tasks)
+
+            leader.response = tutils.tresp(content=b"from origin")
+            addon.response(leader)
+            await asyncio.gather(*tasks)
+
+            for flow in waiters:
+                assert flow.metadata[addon.cache_from_origin] is False
+                assert flow.response is not None
+                assert flow.response.content == b"from origin"
+                addon.response(flow)
+            assert storage.upsert_count == 1
+            assert len(addon.single_flight) == 0
+            addon.done()
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("failure", ["error_response", "error_hook"])
+def test_single_flight_failure_releases_waiters(failure: str) -> None:
+    async def scenario() -> None:
+        with taddons.context() as tctx:
+            addon = tctx.script("inject.py").addons[0]
+            tctx.configure(addon, cache_single_flight=True)
+
+            leader = _keyed_flow(b"sf-key")
+            addon.request(leader)
+            waiter = _keyed_flow(b"sf-key")
+            task = asyncio.ensure_future(addon.request(waiter))
+            await asyncio.sleep(0)
+
+            if failure == "error_response":
+                leader.response = tutils.tresp(status_code=502)
+                addon.response(leader)
+            else:
+                addon.error(leader)
+            await task
+
+            assert waiter.metadata[addon.cache_from_origin] is True
+            assert waiter.response is None
+            addon.done()
+
+    asyncio.run(scenario())
+
+
+def test_single_flight_wait_times_out() -> None:
+    async def scenario() -> None:
+        with taddons.context() as tctx:
+            addon = tctx.script("inject.py").addons[0]
+            tctx.configure(
+                addon,
+                cache_single_flight=True,
+                cache_single_flight_timeout=0.01,
+            )
+            addon.request(_keyed_flow(b"sf-key"))
+            waiter = _keyed_flow(b"sf-key")
+            await addon.request(waiter)
+            assert waiter.metadata[addon.cache_from_origin] is True
+
+            # A leader that never finished no longer holds the key.
+            await asyncio.sleep(0.02)
+            late = _keyed_flow(b"sf-key")
+            assert addon.request(late) is None
+            assert late.metadata[addon.cache_from_origin] is True
+            addon.done()
+
+    asyncio.run(scenario())
+
+
+def test_single_flight_disabled_by_default() -> None:
+    with taddons.context() as tctx:
+        addon = tctx.script("inject.py").addons[0]
+        flows = [_keyed_flow(b"sf-key") for _ in range(2)]
+        for flow in flows:
+            assert addon.request(flow) is None
+            assert flow.metadata[addon.cache_from_origin] is True
+        addon.done()
+
+
+def test_derived_keys_cache_keyless_requests() -> None:
+    with taddons.context() as tctx:
+        addon = tctx.script("inject.py").addons[0]
+        tctx.configure(addon, cache_derive_keys=True)
+        addon.configure({"cache_derive_keys"})
+
+        def keyless(path: bytes) -> HTTPFlow:
+            return tflow.tflow(
+                req=tutils.treq(method=b"GET", path=path, headers=[]),
+                resp=False,
+            )
+
+        flow = keyless(b"/page?b=2&a=1&utm_source=mail")
+        addon.request(flow)
+        assert flow.metadata[addon.cache_from_origin] is True
+        flow.response = tutils.tresp(content=b"page")
+        addon.response(flow)
+
+        hit = keyless(b"/page?a=1&b=2")
+        addon.request(hit)
+        assert hit.metadata[addon.cache_from_origin] is False
+        assert hit.response is not None
+        assert hit.response.content == b"page"
+        assert hit.metadata[addon.cache_key] == flow.metadata[addon.cache_key]
+        addon.done()
+
+
+def test_derived_keys_do_not_share_authenticated_responses() -> None:
+    with taddons.context() as tctx:
+        addon = tctx.script("inject.py").addons[0]
+        tctx.configure(addon, cache_derive_keys=True)
+        addon.configure({"cache_derive_keys"})
+
+        def with_cookie(cookie: bytes) -> HTTPFlow:
+            return tflow.tflow(
+                req=tutils.treq(headers=[(b"cookie", cookie)]), resp=False
+            )
+
+        alice = with_cookie(b"session=alice")
+        addon.request(alice)
+        alice.response = tutils.tresp(content=b"alice's inbox")
+        addon.response(alice)
+
+        bob = with_cookie(b"session=bob")
+        addon.request(bob)
+        assert bob.response is None
+        assert bob.metadata[addon.cache_from_origin] is True
+        addon.done()
+
+
+def _stored_expiry(addon: Cache, key: str) -> int | None:
+    row = addon.storage.conn.execute(
+        "SELECT expires_at FROM cache WHERE cache_key=?", (key,)
+    ).fetchone()
+    return row["expires_at"]
+
+
+def test_ttl_sources() -> None:
+    with taddons.context() as tctx:
+        addon = tctx.script("inject.py").addons[0]
+        tctx.configure(
+            addon, cache_backend="sqlite", cache_ttl=100, cache_origin_ttl=True
+        )
+        addon.configure({"cache_backend"})
+        origin = [(b"cache-control", b"max-age=50")]
+        now = int(time.time())
+
+        def fetch(key: bytes, ttl: bytes | None, headers) -> HTTPFlow:
+            flow = _keyed_flow(key)
+            if ttl is not None:
+                flow.request.headers["Mitm-Cache-TTL"] = ttl.decode()
+            addon.request(flow)
+            assert "Mitm-Cache-TTL" not in flow.request.headers
+            flow.response = tutils.tresp(headers=headers)
+            addon.response(flow)
+            return flow
+
+        fetch(b"request", b"10", origin)
+        fetch(b"origin", None, origin)
+        fetch(b"default", None, [])
+        fetch(b"invalid", b"later", [])
+
+        assert _stored_expiry(addon, "request") - now in (10, 11)
+        assert _stored_expiry(addon, "origin") - now in (50, 51)
+        assert _stored_expiry(addon, "default") - now in (100, 101)
+        assert _stored_expiry(addon, "invalid") - now in (100, 101)
+        addon.done()
+
+
+def test_no_ttl_means_no_expiry() -> None:
+    with taddons.context() as tctx:
+        addon = tctx.script("inject.py").addons[0]
+        tctx.configure(addon, cache_backend="sqlite")
+        addon.configure({"cache_backend"})
+        flow = _keyed_flow(b"key")
+        addon.request(flow)
+        flow.response = tutils.tresp(
+            headers=[(b"cache-control", b"max-age=50")]
+        )
+        addon.response(flow)
+        assert _stored_expiry(addon, "key") is None
+        addon.done()
+
+
+def _store_stale(addon: Cache, key: bytes, headers=()) -> None:
+    # A zero TTL makes the entry stale as soon as it is stored.
+    flow = _keyed_flow(key)
+    flow.request.headers["Mitm-Cache-TTL"] = "0"
+    addon.request(flow)
+    flow.response = tutils.tresp(headers=list(headers), content=b"stale")
+    addon.response(flow)
+
+
+def _replay_refresh(addon: Cache, refresh: HTTPFlow, status: int) -> None:
+    assert addon.request(refresh) is None
+    assert refresh.response is None
+    assert refresh.metadata[addon.cache_from_origin] is True
+    content = b"" if status == 304 else b"fresh"
+    refresh.response = tutils.tresp(status_code=status, content=content)
+    addon.response(refresh)
+
+
+def test_stale_while_revalidate_refreshes_in_background(monkeypatch) -> None:
+    replayed: list[HTTPFlow] = []
+    monkeypatch.setattr("mitmcache.cache.replay", replayed.append)
+
+    async def scenario() -> None:
+        with taddons.context() as tctx:
+            addon = tctx.script("inject.py").addons[0]
+            tctx.configure(addon, cache_stale_while_revalidate=60)
+            _store_stale(addon, b"swr-key")
+
+            for _ in range(3):
+                hit = _keyed_flow(b"swr-key")
+                assert addon.request(hit) is None
+                assert hit.response is not None
+                assert hit.response.content == b"stale"
+            assert len(replayed) == 1
+            assert len(addon.refreshes) == 1
+
+            # A failed refresh keeps the stale entry until it expires.
+            _replay_refresh(addon, replayed[0], 503)
+            assert len(addon.refreshes) == 0
+            hit = _keyed_flow(b"swr-key")
+            addon.request(hit)
+            assert hit.response is not None
+            assert hit.response.content == b"stale"
+            assert len(replayed) == 2
+
+            _replay_refresh(addon, replayed[1], 200)
+            hit = _keyed_flow(b"swr-key")
+            addon.request(hit)
+            assert hit.response is not None
+            assert hit.response.content == b"fresh"
+            assert len(replayed) == 2
+            addon.done()
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize(
+    ("outcome", "content"),
+    [
+        (200, b"fresh"),
+        (304, b"stale"),
+        (502, b"stale"),
+        ("error", b"stale"),
+        (None, b"stale"),
+    ],
+)
+def test_stale_if_error_waits_for_refresh(
+    monkeypatch, outcome: int | str | None, content: bytes
+) -> None:
+    replayed: list[HTTPFlow] = []
+    monkeypatch.setattr("mitmcache.cache.replay", replayed.append)
+
+    async def scenario() -> None:
+        with taddons.context() as tctx:
+            addon = tctx.script("inject.py").addons[0]
+            tctx.configure(
+                addon, cache_stale_if_error=60, cache_revalidate_timeout=0.05
+            )
+            _store_stale(addon, b"sie-key")
+
+            hit = _keyed_flow(b"sie-key")
+            task = asyncio.ensure_future(addon.request(hit))
+            await asyncio.sleep(0)
+            assert not task.done()
+            (refresh,) = replayed
+            if outcome == "error":
+                addon.request(refresh)
+                addon.error(refresh)
+            elif outcome is not None:
+                _replay_refresh(addon, refresh, outcome)
+            # None: the origin never answers and the wait times out.
+            await task
+
+            assert hit.metadata[addon.cache_from_origin] is False
+            assert hit.response is not None
+            assert hit.response.content == content
+            addon.done()
+
+    asyncio.run(scenario())
+
+
+def test_fresh_hit_is_not_refreshed(monkeypatch) -> None:
+    replayed: list[HTTPFlow] = []
+    monkeypatch.setattr("mitmcache.cache.replay", replayed.append)
+    with taddons.context() as tctx:
+        addon = tctx.script("inject.py").addons[0]
+        tctx.configure(
+            addon,
+            cache_backend="sqlite",
+            cache_ttl=100,
+            cache_stale_while_revalidate=60,
+        )
+        addon.configure({"cache_backend"})
+        flow = _keyed_flow(b"key")
+        addon.request(flow)
+        flow.response = tutils.tresp(content=b"fresh")
+        now = int(time.time())
+        addon.response(flow)
+        assert _stored_expiry(addon, "key") - now in (160, 161)
+
+        hit = _keyed_flow(b"key")
+        assert addon.request(hit) is None
+        assert hit.response is not None
+        assert replayed == []
+        addon.done()
+
+
+def test_not_modified_refresh_renews_entry(monkeypatch) -> None:
+    replayed: list[HTTPFlow] = []
+    monkeypatch.setattr("mitmcache.cache.replay", replayed.append)
+
+    async def scenario() -> None:
+        with taddons.context() as tctx:
+            addon = tctx.script("inject.py").addons[0]
+            tctx.configure(
+                addon,
+                cache_backend="sqlite",
+                cache_ttl=100,
+                cache_stale_while_revalidate=60,
+            )
+            addon.configure({"cache_backend"})
+            _store_stale(addon, b"key", [(b"etag", b'"v1"')])
+            stored = "SELECT id, flow FROM cache WHERE cache_key='key'"
+            before = tuple(addon.storage.conn.execute(stored).fetchone())
+
+            addon.request(_keyed_flow(b"key"))
+            (refresh,) = replayed
+            assert refresh.request.headers["if-none-match"] == '"v1"'
+            now = int(time.time())
+            _replay_refresh(addon, refresh, 304)
+
+            after = tuple(addon.storage.conn.execute(stored).fetchone())
+            assert after == before
+            assert _stored_expiry(addon, "key") - now in (160, 161)
+            hit = _keyed_flow(b"key")
+            addon.request(hit)
+            assert hit.response is not None
+            assert hit.response.status_code == 200
+            assert hit.response.content == b"stale"
+            assert len(replayed) == 1
+            addon.done()
+
+    asyncio.run(scenario())
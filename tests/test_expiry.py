@@ -0,0 +1,55 @@
+from __future__ import annotations
+
+import pytest
+from mitmproxy.test import tutils
+
+from mitmcache.expiry import origin_ttl, parse_ttl
+
+NOW = 1_700_000_000.0
+
+
+@pytest.mark.parametrize(
+    ("value", "expected"),
+    [(None, None), ("60", 60), (" 0 ", 0), ("-1", None), ("soon", None)],
+)
+def test_parse_ttl(value: str | None, expected: int | None) -> None:
+    assert parse_ttl(value) == expected
+
+
+def _response(*headers: tuple[bytes, bytes]):
+    return tutils.tresp(headers=list(headers))
+
+
+def test_origin_ttl_without_headers() -> None:
+    assert origin_ttl(_response(), NOW) is None
+
+
+def test_origin_ttl_prefers_s_maxage() -> None:
+    response = _response(
+        (b"cache-control", b"public, max-age=60, s-maxage=30")
+    )
+    assert origin_ttl(response, NOW) == 30
+    response = _response((b"cache-control", b'max-age="120"'))
+    assert origin_ttl(response, NOW) == 120
+
+
+def test_origin_ttl_subtracts_age() -> None:
+    response = _response((b"cache-control", b"max-age=60"), (b"age", b"50"))
+    assert origin_ttl(response, NOW) == 10
+    response = _response((b"cache-control", b"max-age=60"), (b"age", b"90"))
+    assert origin_ttl(response, NOW) == 0
+
+
+def test_origin_ttl_from_expires() -> None:
+    response = _response(
+        (b"date", b"Tue, 14 Nov 2023 22:00:00 GMT"),
+        (b"expires", b"Tue, 14 Nov 2023 23:00:00 GMT"),
+    )
+    assert origin_ttl(response, NOW) == 3600
+    # max-age wins over Expires.
+    response.headers["cache-control"] = "max-age=5"
+    assert origin_ttl(response, NOW) == 5
+
+
+def test_origin_ttl_invalid_expires_means_expired() -> None:
+    assert origin_ttl(_response((b"expires", b"0")), NOW) == 0
@@ -0,0 +1,106 @@
+from __future__ import annotations
+
+import pytest
+from mitmproxy.test import tutils
+
+from mitmcache.keys import KeyDeriver
+
+
+def _request(
+    path: bytes = b"/",
+    method: bytes = b"GET",
+    host: bytes = b"example.com",
+    port: int = 443,
+    scheme: bytes = b"https",
+    headers: list[tuple[bytes, bytes]] | None = None,
+    content: bytes = b"",
+):
+    return tutils.treq(
+        method=method,
+        scheme=scheme,
+        host=host,
+        port=port,
+        path=path,
+        headers=headers or [],
+        content=content,
+    )
+
+
+def test_key_is_fixed_length_hex() -> None:
+    key = KeyDeriver().derive(_request())
+    assert key is not None
+    assert len(key) == 64
+    int(key, 16)
+
+
+def test_query_is_sorted_and_tracking_params_dropped() -> None:
+    deriver = KeyDeriver()
+    base = deriver.derive(_request(b"/p?a=1&b=2"))
+    assert deriver.derive(_request(b"/p?b=2&a=1")) == base
+    assert deriver.derive(_request(b"/p?utm_source=x&a=1&gclid=y&b=2")) == base
+    assert deriver.derive(_request(b"/p?a=1&b=3")) != base
+    assert deriver.derive(_request(b"/q?a=1&b=2")) != base
+
+
+def test_url_normalization() -> None:
+    deriver = KeyDeriver()
+    request = _request(b"/Path?x=%41&&a", host=b"Example.COM")
+    assert deriver.normalize_url(request) == "https://example.com/Path?a&x=%41"
+    request = _request(b"/", scheme=b"http", port=8080)
+    assert deriver.normalize_url(request) == "http://example.com:8080/"
+
+
+def test_method_and_selected_headers_are_part_of_the_key() -> None:
+    deriver = KeyDeriver(headers=["Accept-Language"])
+    en = deriver.derive(_request(headers=[(b"accept-language", b"en")]))
+    ja = deriver.derive(_request(headers=[(b"accept-language", b"ja")]))
+    ignored = deriver.derive(
+        _request(headers=[(b"accept-language", b"en"), (b"user-agent", b"x")])
+    )
+    assert en != ja
+    assert en == ignored
+    assert deriver.derive(_request(method=b"HEAD")) != deriver.derive(
+        _request()
+    )
+
+
+def test_excluded_methods_get_no_key() -> None:
+    deriver = KeyDeriver(methods=["GET"])
+    assert deriver.derive(_request(method=b"POST")) is None
+
+
+@pytest.mark.parametrize("header", [b"Authorization", b"Cookie"])
+def test_requests_with_credentials_get_no_key(header: bytes) -> None:
+    alice = _request(headers=[(header, b"alice")])
+    bob = _request(headers=[(header, b"bob")])
+    assert KeyDeriver().derive(alice) is None
+
+    deriver = KeyDeriver(headers=[header.decode().lower()])
+    assert deriver.derive(alice) is not None
+    assert deriver.derive(alice) != deriver.derive(bob)
+
+
+def test_json_bodies_are_canonicalized() -> None:
+    deriver = KeyDeriver()
+    json_header = [(b"content-type", b"application/json")]
+
+    def key(body: bytes) -> str | None:
+        request = _request(method=b"POST", headers=json_header, content=body)
+        return deriver.derive(request)
+
+    query = b'{"query": "{ a }", "variables": {"x": 1, "y": 2}}'
+    reordered = b'{"variables":{"y":2,"x":1},"query":"{ a }"}'
+    assert key(query) == key(reordered)
+    assert key(query) != key(b'{"query": "{ a }", "variables": {"x": 2}}')
+
+
+@pytest.mark.parametrize("content_type", [b"text/plain", b"application/json"])
+def test_other_bodies_are_hashed_as_is(content_type: bytes) -> None:
+    deriver = KeyDeriver()
+    headers = [(b"content-type", content_type)]
+    first = _request(method=b"POST", headers=headers, content=b"{not json")
+    second = _request(method=b"POST", headers=headers, content=b"{not  json")
+    assert deriver.derive(first) != deriver.derive(second)
+    assert deriver.derive(first) != deriver.derive(
+        _request(method=b"POST", headers=headers)
+    )
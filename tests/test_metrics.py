@@ -0,0 +1,124 @@
+from __future__ import annotations
+
+import pytest
+from mitmproxy.test import taddons, tflow, tutils
+
+from mitmcache.metrics import Histogram, Metrics, MetricsDump
+
+
+class FailingStorage:
+    def get(self, cache_key):
+        raise OSError("simulated storage failure")
+
+    def upsert(self, cache_key, flow):
+        raise OSError("simulated storage failure")
+
+    def close(self):
+        pass
+
+
+def _request(addon, key: bytes | None, content: bytes = b"ok", status=200):
+    headers = [] if key is None else [(b"Mitm-Cache-Key", key)]
+    flow = tflow.tflow(
+        req=tutils.treq(method=b"GET", path=b"/", headers=headers),
+        resp=False,
+    )
+    addon.request(flow)
+    if flow.response is None:
+        flow.response = tutils.tresp(content=content, status_code=status)
+        addon.response(flow)
+    return flow
+
+
+def test_histogram_buckets() -> None:
+    histogram = Histogram()
+    for seconds in (0.00001, 0.000025, 0.0003, 5.0):
+        histogram.observe(seconds)
+    assert histogram.counts[0] == 2
+    assert histogram.counts[4] == 1
+    assert histogram.counts[-1] == 1
+    assert histogram.count == 4
+    assert histogram.sum == pytest.approx(5.000335)
+
+
+def test_render_prometheus_text() -> None:
+    metrics = Metrics()
+    metrics.count("hit")
+    metrics.count("hit")
+    metrics.count("write_error")
+    metrics.observe("lookup", 0.0003)
+    metrics.observe("lookup", 2.0)
+
+    lines = metrics.render().splitlines()
+
+    assert "# TYPE mitmcache_requests_total counter" in lines
+    assert 'mitmcache_requests_total{result="hit"} 2' in lines
+    assert 'mitmcache_requests_total{result="miss"} 0' in lines
+    assert 'mitmcache_storage_errors_total{operation="write"} 1' in lines
+    assert "# TYPE mitmcache_storage_seconds histogram" in lines
+    bucket = 'mitmcache_storage_seconds_bucket{operation="lookup",le='
+    assert f'{bucket}"0.00025"}} 0' in lines
+    assert f'{bucket}"0.0005"}} 1' in lines
+    assert f'{bucket}"1.0"}} 1' in lines
+    assert f'{bucket}"+Inf"}} 2' in lines
+    assert 'mitmcache_storage_seconds_count{operation="lookup"} 2' in lines
+
+
+def test_metrics_dump_writes_file(tmp_path) -> None:
+    path = tmp_path / "cache.prom"
+    metrics = Metrics()
+    dump = MetricsDump(metrics, str(path), interval=60)
+    metrics.count("miss")
+    dump.stop()
+    assert 'mitmcache_requests_total{result="miss"} 1' in path.read_text()
+
+
+@pytest.mark.parametrize("backend", ["memory", "sqlite"])
+def test_addon_counts_requests_and_writes(backend: str) -> None:
+    with taddons.context() as tctx:
+        addon = tctx.script("inject.py").addons[0]
+        tctx.configure(addon, cache_backend=backend, cache_max_body_size=10)
+        addon.configure({"cache_backend"})
+
+        _request(addon, b"key")
+        _request(addon, b"key")
+        _request(addon, None)
+        _request(addon, b"missing", status=404)
+        _request(addon, b"large", content=b"x" * 11)
+
+        counters = addon.metrics.counters
+        assert counters["hit"] == 1
+        assert counters["miss"] == 3
+        assert counters["keyless"] == 1
+        assert counters["store"] == 1
+        assert counters["skipped_status"] == 1
+        assert counters["skipped_body_size"] == 1
+        histograms = addon.metrics.histograms
+        assert histograms["lookup"].count == 4
+        assert histograms["deserialize"].count == 1
+        assert histograms["write"].count == 1
+        assert "mitmcache_requests_total" in tctx.command(addon.metrics_text)
+        addon.done()
+
+
+def test_addon_counts_storage_errors() -> None:
+    with taddons.context() as tctx:
+        addon = tctx.script("inject.py").addons[0]
+        addon.storage = FailingStorage()
+
+        _request(addon, b"key")
+
+        assert addon.metrics.counters["read_error"] == 1
+        assert addon.metrics.counters["write_error"] == 1
+        addon.done()
+
+
+def test_addon_writes_metrics_file(tmp_path) -> None:
+    path = tmp_path / "cache.prom"
+    with taddons.context() as tctx:
+        addon = tctx.script("inject.py").addons[0]
+        tctx.configure(addon, cache_metrics_file=str(path))
+        addon.configure({"cache_metrics_file"})
+        _request(addon, None)
+        addon.done()
+    assert 'mitmcache_requests_total{result="keyless"} 1' in path.read_text()
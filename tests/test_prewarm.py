@@ -0,0 +1,154 @@
+from __future__ import annotations
+
+import time
+
+import mitmproxy.io as mio
+from mitmproxy.http import HTTPFlow
+from mitmproxy.test import taddons, tflow, tutils
+
+from mitmcache.prewarm import import_flows, main, read_flows
+from mitmcache.storage.memory import MemoryStorage
+from mitmcache.storage.sqlite3 import SQLiteStorage
+
+from .example_flow import example_flow
+
+
+def _flow(path: str, key: str | None, status: int = 200) -> HTTPFlow:
+    headers = [] if key is None else [(b"Mitm-Cache-Key", key.encode())]
+    return tflow.tflow(
+        req=tutils.treq(method=b"GET", path=path.encode(), headers=headers),
+        resp=tutils.tresp(status_code=status, content=path.encode()),
+    )
+
+
+def _write_dump(path, flows) -> str:
+    with open(path, "wb") as dump:
+        writer = mio.FlowWriter(dump)
+        for flow in flows:
+            writer.add(flow)
+    return str(path)
+
+
+def _capture(tmp_path) -> str:
+    """A dump of keyed, keyless, failed and unanswered flows."""
+    unanswered = tflow.tflow()
+    unanswered.request.headers["Mitm-Cache-Key"] = "unanswered"
+    return _write_dump(
+        tmp_path / "capture.mitm",
+        [
+            _flow("/a", "a"),
+            _flow("/b", "b"),
+            _flow("/keyless?y=2&x=1", None),
+            _flow("/missing", "missing", status=404),
+            unanswered,
+        ],
+    )
+
+
+def _keys(storage: SQLiteStorage) -> list[str]:
+    rows = storage.conn.execute("SELECT cache_key FROM cache").fetchall()
+    return sorted(row["cache_key"] for row in rows)
+
+
+def test_read_flows_skips_flows_without_response(tmp_path) -> None:
+    flows = list(read_flows(_capture(tmp_path)))
+    assert [flow.request.path for flow in flows] == [
+        "/a",
+        "/b",
+        "/keyless?y=2&x=1",
+        "/missing",
+    ]
+
+
+def test_import_flows_in_batches() -> None:
+    storage = MemoryStorage()
+    progress: list[int] = []
+    entries = ((f"key-{i}", example_flow()) for i in range(25))
+
+    count = import_flows(storage, entries, 10, progress.append)
+
+    assert count == 25
+    assert progress == [10, 20, 25]
+    assert storage.entry_count() == 25
+
+
+def test_import_into_a_live_cache_keeps_sqlite_indexes(tmp_path) -> None:
+    storage = SQLiteStorage(str(tmp_path / "cache.db"))
+    seen: list[int] = []
+
+    def count_indexes(count: int) -> None:
+        row = storage.conn.execute(
+            "SELECT COUNT(*) FROM sqlite_master WHERE type='index'"
+            " AND name LIKE 'cache_%'"
+        ).fetchone()
+        seen.append(row[0])
+
+    count_indexes(0)
+    import_flows(storage, [("key-0", example_flow())], 2, count_indexes)
+    assert seen[1] == seen[0] > 0
+
+    # The CLI defers them, as nothing else uses the file.
+    entries = ((f"key-{i}", example_flow()) for i in range(4))
+    with storage.deferred_indexes():
+        import_flows(storage, entries, 2, count_indexes)
+    assert seen[2:] == [0, 0]
+    count_indexes(4)
+    assert seen[-1] == seen[0]
+    assert storage.get("key-3") is not None
+    storage.close()
+
+
+def test_cli_imports_keyed_flows(tmp_path) -> None:
+    cache_file = str(tmp_path / "cache.db")
+    main([_capture(tmp_path), "--cache-file", cache_file])
+
+    storage = SQLiteStorage(cache_file)
+    assert _keys(storage) == ["a", "b"]
+    cached = storage.get("a")
+    assert cached is not None
+    assert cached.response is not None
+    assert cached.response.content == b"/a"
+    storage.close()
+
+
+def test_cli_derives_keys_and_sets_ttl(tmp_path) -> None:
+    cache_file = str(tmp_path / "cache.db")
+    main(
+        [
+            _capture(tmp_path),
+            "--cache-file",
+            cache_file,
+            "--derive-keys",
+            "--compact",
+            "--ttl",
+            "60",
+        ]
+    )
+
+    storage = SQLiteStorage(cache_file, compact=True)
+    keys = _keys(storage)
+    assert len(keys) == 3
+    rows = storage.conn.execute("SELECT expires_at FROM cache").fetchall()
+    assert all(row["expires_at"] - time.time() > 50 for row in rows)
+    storage.close()
+
+
+def test_prewarm_command(tmp_path) -> None:
+    with taddons.context() as tctx:
+        addon = tctx.script("inject.py").addons[0]
+        tctx.configure(addon, cache_ttl=100)
+        path = _capture(tmp_path)
+
+        tctx.command(addon.prewarm, path)
+        # The import runs in the background.
+        for job in addon.jobs:
+            job.join()
+
+        hit = _flow("/a", "a")
+        hit.response = None
+        addon.request(hit)
+        assert hit.metadata[addon.cache_from_origin] is False
+        assert hit.response is not None
+        assert hit.response.content == b"/a"
+        assert "Mitm-Cache-Key" not in hit.response.headers
+        addon.done()
@@ -0,0 +1,51 @@
+from __future__ import annotations
+
+from mitmproxy.test import tflow, tutils
+
+from mitmcache.revalidation import REFRESH, is_not_modified, refresh_flow
+
+
+def _hit(*validators: tuple[bytes, bytes]):
+    request = tutils.treq(
+        headers=[(b"if-none-match", b'"client"'), (b"accept", b"*/*")]
+    )
+    return tflow.tflow(
+        req=request, resp=tutils.tresp(headers=list(validators))
+    )
+
+
+def test_refresh_flow_sends_cached_validators() -> None:
+    hit = _hit(
+        (b"etag", b'"v1"'),
+        (b"last-modified", b"Wed, 21 Oct 2015 07:28:00 GMT"),
+    )
+    refresh = refresh_flow(hit)
+
+    assert refresh.id != hit.id
+    assert refresh.response is None
+    assert refresh.metadata[REFRESH] is True
+    headers = refresh.request.headers
+    assert headers["if-none-match"] == '"v1"'
+    assert headers["if-modified-since"] == "Wed, 21 Oct 2015 07:28:00 GMT"
+    assert headers["accept"] == "*/*"
+    # The client's flow is left alone.
+    assert hit.request.headers["if-none-match"] == '"client"'
+    assert REFRESH not in hit.metadata
+
+
+def test_refresh_flow_without_validators_is_unconditional() -> None:
+    refresh = refresh_flow(_hit())
+    assert "if-none-match" not in refresh.request.headers
+    assert "if-modified-since" not in refresh.request.headers
+
+
+def test_is_not_modified() -> None:
+    refresh = refresh_flow(_hit((b"etag", b'"v1"')))
+    assert not is_not_modified(refresh)
+    refresh.response = tutils.tresp(status_code=304)
+    assert is_not_modified(refresh)
+    refresh.response = tutils.tresp(status_code=200)
+    assert not is_not_modified(refresh)
+
+    client = tflow.tflow(resp=tutils.tresp(status_code=304))
+    assert not is_not_modified(client)
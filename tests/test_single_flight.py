@@ -0,0 +1,58 @@
+from __future__ import annotations
+
+import asyncio
+
+from mitmproxy.test import tutils
+
+from mitmcache.single_flight import SingleFlight
+
+
+def test_only_first_caller_leads() -> None:
+    async def scenario() -> None:
+        flights = SingleFlight()
+        assert flights.lead("key", "a", timeout=10)
+        assert not flights.lead("key", "b", timeout=10)
+        assert flights.lead("other", "c", timeout=10)
+        assert len(flights) == 2
+
+    asyncio.run(scenario())
+
+
+def test_waiters_receive_copies_of_the_response() -> None:
+    async def scenario() -> None:
+        flights = SingleFlight()
+        flights.lead("key", "a", timeout=10)
+        waiting = [
+            asyncio.ensure_future(flights.wait("key", timeout=10))
+            for _ in range(2)
+        ]
+        await asyncio.sleep(0)
+        response = tutils.tresp(content=b"body")
+        flights.release("key", "a", response)
+
+        first, second = await asyncio.gather(*waiting)
+        assert first is not None and second is not None
+        assert first.content == second.content == b"body"
+        assert first is not second and first is not response
+        assert len(flights) == 0
+
+    asyncio.run(scenario())
+
+
+def test_release_by_non_leader_is_ignored() -> None:
+    async def scenario() -> None:
+        flights = SingleFlight()
+        flights.lead("key", "a", timeout=10)
+        flights.release("key", "b", None)
+        assert len(flights) == 1
+        flights.release_all()
+        assert len(flights) == 0
+
+    asyncio.run(scenario())
+
+
+def test_wait_without_flight_returns_none() -> None:
+    async def scenario() -> None:
+        assert await SingleFlight().wait("key", timeout=10) is None
+
+    asyncio.run(scenario())